@@ -1,10 +1,18 @@
 """
 file_ops.py - Operations for loading/saving tags and images, and building folder tree.
 """
+import json
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from image_store import ImageStore, TagVocab
 
 
 SUPPORTED_FORMATS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+CACHE_DIRNAME = '.tktagger'   # Thư mục cache ẩn trong mỗi folder dataset (tagger, index…)
+INDEX_FILENAME = 'index.json' # {filename ảnh: [txt mtime_ns, txt size, tags]}
+INDEX_VERSION = 1
+SIDECAR_WORKERS = 8           # Số thread đọc .txt song song (NFS / ổ mạng)
 
 
 def load_tags(txt_path: str) -> list:
@@ -29,25 +37,91 @@ def save_tags(txt_path: str, tags: list) -> bool:
         return False
 
 
-def load_folder_images(folder: str) -> list:
-    """Tải danh sách ảnh từ một thư mục."""
-    images = []
+def load_folder_images(folder: str, use_index: bool = True, vocab: TagVocab = None) -> ImageStore:
+    """Tải danh sách ảnh từ một thư mục thành ImageStore.
+
+    Quét bằng os.scandir; tags của .txt không đổi (mtime + size) được lấy lại
+    từ index trong .tktagger/, chỉ các .txt mới / đã sửa mới được đọc (song song).
+    *vocab* dùng chung giữa các folder để mỗi tag chỉ được lưu một lần.
+    """
+    image_names, sidecars = _scan_folder(folder)
+    index = _load_index(folder) if use_index else {}
+
+    filenames = sorted(image_names)
+    tag_lists = [()] * len(filenames)
+    to_read = []                                # (vị trí, tên file, stat của .txt)
+    entries = {}
+    for pos, file in enumerate(filenames):
+        txt_name = os.path.splitext(file)[0] + '.txt'
+        stat = sidecars.get(txt_name)
+        if stat is None:                        # không có .txt → không có tags
+            continue
+        cached = index.get(file)
+        if cached and cached[0] == stat[0] and cached[1] == stat[1]:
+            tag_lists[pos] = cached[2]
+            entries[file] = cached
+        else:
+            to_read.append((pos, file, stat))
+
+    if to_read:
+        txt_paths = [os.path.join(folder, os.path.splitext(file)[0] + '.txt') for _, file, _ in to_read]
+        if len(to_read) > SIDECAR_WORKERS:
+            with ThreadPoolExecutor(max_workers=SIDECAR_WORKERS) as pool:
+                read = list(pool.map(load_tags, txt_paths))
+        else:
+            read = [load_tags(path) for path in txt_paths]
+        for (pos, file, stat), tags in zip(to_read, read):
+            tag_lists[pos] = tags
+            entries[file] = [stat[0], stat[1], tags]
+
+    if use_index and entries != index:
+        _save_index(folder, entries)
+    return ImageStore(folder, filenames, tag_lists, vocab)
+
+
+def _scan_folder(folder: str) -> tuple:
+    """Một lần os.scandir: (tên các file ảnh, {tên .txt: (mtime_ns, size)})."""
+    image_names = []
+    sidecars = {}
+    with os.scandir(folder) as it:              # PermissionError được raise cho caller
+        for entry in it:
+            name = entry.name
+            lower = name.lower()
+            try:
+                if lower.endswith(SUPPORTED_FORMATS):
+                    if entry.is_file():
+                        image_names.append(name)
+                elif lower.endswith('.txt'):
+                    st = entry.stat()
+                    sidecars[name] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                continue
+    return image_names, sidecars
+
+
+def _load_index(folder: str) -> dict:
     try:
-        for file in sorted(os.listdir(folder)):
-            if file.lower().endswith(SUPPORTED_FORMATS):
-                img_path = os.path.join(folder, file)
-                txt_path = os.path.splitext(img_path)[0] + '.txt'
-                tags = load_tags(txt_path)
-                images.append({
-                    'path': img_path,
-                    'txt_path': txt_path,
-                    'tags': tags,
-                    'filename': file,
-                    'modified': False,
-                })
-    except PermissionError:
-        raise
-    return images
+        with open(os.path.join(folder, CACHE_DIRNAME, INDEX_FILENAME), 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') == INDEX_VERSION:
+            return data.get('entries', {})
+    except (OSError, ValueError, AttributeError):
+        pass
+    return {}
+
+
+def _save_index(folder: str, entries: dict) -> None:
+    """Ghi index (tmp + os.replace); folder chỉ đọc thì bỏ qua."""
+    cache_dir = os.path.join(folder, CACHE_DIRNAME)
+    target = os.path.join(cache_dir, INDEX_FILENAME)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = target + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'version': INDEX_VERSION, 'entries': entries}, f, ensure_ascii=False)
+        os.replace(tmp, target)
+    except OSError:
+        pass
 
 
 def save_all_images(images: list) -> int:
@@ -70,7 +144,7 @@ def populate_folder_tree(path: str) -> dict:
         children = []
         for item in sorted(os.listdir(path)):
             item_path = os.path.join(path, item)
-            if os.path.isdir(item_path):
+            if item != CACHE_DIRNAME and os.path.isdir(item_path):
                 children.append(item_path)
                 tree.update(populate_folder_tree(item_path))
         tree[path] = children
@@ -4,6 +4,8 @@ history_manager.py - History Operation Manager for undo/redo functionality in TK
 from dataclasses import dataclass, field
 from typing import Any, List, Optional
 
+from image_store import ImageStore
+
 
 @dataclass
 class HistoryEntry:
@@ -28,9 +30,19 @@ class HistoryManager:
 
     def snapshot_tags(self, images: list) -> list:
         """Tạo snapshot danh sách tags của tất cả ảnh."""
+        if isinstance(images, ImageStore):
+            return images.snapshot()        # chỉ copy mảng id, không tạo list string
         return [list(img['tags']) for img in images]
 
-    def push(self, action: str, before_snapshot: list, images: list):
+    def _restore(self, images: list, snapshot):
+        if isinstance(images, ImageStore):
+            images.restore(snapshot)
+            return
+        for img, tags in zip(images, snapshot):
+            img['tags'] = list(tags)
+            img['modified'] = True
+
+    def push(self, action: str, before_snapshot: list, images: list) -> HistoryEntry:
         """Lưu trạng thái mới vào lịch sử."""
         after_snapshot = self.snapshot_tags(images)
         entry = HistoryEntry(
@@ -43,6 +55,19 @@ class HistoryManager:
             self._undo_stack.pop(0)
         self._redo_stack.clear()
         self._notify()
+        return entry
+
+    def amend(self, entry: HistoryEntry, action: str, images: list) -> bool:
+        """
+        Gộp thêm thay đổi vào *entry* (cập nhật trạng thái sau + tên action) nếu nó
+        vẫn là thao tác cuối cùng. False nếu đã có thao tác khác chen vào / đã undo.
+        """
+        if not self._undo_stack or self._undo_stack[-1] is not entry:
+            return False
+        entry.action = action
+        entry.images_after = self.snapshot_tags(images)
+        self._notify()
+        return True
 
     def undo(self, images: list) -> Optional[str]:
         """Hoàn tác thao tác cuối. Trả về tên action hoặc None."""
@@ -50,9 +75,7 @@ class HistoryManager:
             return None
         entry = self._undo_stack.pop()
         self._redo_stack.append(entry)
-        for img, tags in zip(images, entry.images_before):
-            img['tags'] = list(tags)
-            img['modified'] = True
+        self._restore(images, entry.images_before)
         self._notify()
         return entry.action
 
@@ -62,9 +85,7 @@ class HistoryManager:
             return None
         entry = self._redo_stack.pop()
         self._undo_stack.append(entry)
-        for img, tags in zip(images, entry.images_after):
-            img['tags'] = list(tags)
-            img['modified'] = True
+        self._restore(images, entry.images_after)
         self._notify()
         return entry.action
 
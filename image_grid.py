@@ -1,33 +1,207 @@
 """
 image_grid.py - Widget hiển thị lưới ảnh
+
+Lưới ảo hoá: chỉ tạo ImageCard cho các hàng đang nằm trong vùng nhìn thấy
+(cộng thêm một khoảng OVERSCAN), các card ra khỏi màn hình được trả về pool
+và gắn lại (bind) cho ảnh khác khi cuộn. Chiều cao mỗi hàng tính trước bằng
+font metrics (ChipMetrics) nên không cần dựng widget để biết bố cục.
+Tags trong card được vẽ trực tiếp (TagChips) thay vì mỗi tag một QLabel.
+refresh_card chỉ đánh dấu card "bẩn"; mỗi vòng event loop gom lại vẽ một lần,
+chỉ với card đang hiển thị – chiều cao các card khuất được đo dần theo lô.
+Thumbnail lấy từ PIXMAP_CACHE (RAM) nếu có – luồng nền chỉ kiểm lại file còn
+nguyên không – không thì giải mã ở luồng nền (ThumbnailLoader, tra
+ThumbnailCache trên đĩa trước); card thu hồi thì huỷ yêu cầu.
 """
+from bisect import bisect_left, bisect_right, insort
+
 from PySide6.QtWidgets import (
-    QWidget, QScrollArea, QGridLayout, QVBoxLayout,
+    QWidget, QScrollArea, QVBoxLayout,
     QHBoxLayout, QLabel, QCheckBox, QLineEdit,
-    QPushButton, QFrame, QSizePolicy
+    QPushButton, QFrame, QToolTip
 )
-from PySide6.QtCore import Qt, Signal
-from PySide6.QtGui import QPixmap, QImage
-import os
+from PySide6.QtCore import Qt, Signal, QEvent, QRect, QSize, QTimer, QPoint
+from PySide6.QtGui import QPixmap, QPainter, QColor, QFont, QFontMetrics, QImage, QStaticText, QTransform
 
 from i18n import tr
+from image_store import ImageStore
+from thumbnail_cache import ThumbnailCache, PIXMAP_CACHE
+from thumbnail_loader import ThumbnailLoader
+
+
+class ChipMetrics:
+    """Đo và xếp dòng các chip tag – dùng chung cho mọi card và cho việc tính bố cục lưới."""
+    PAD_X = 5
+    PAD_Y = 2
+    SPACING = 2
+    MAX_TEXTS = 20000   # giới hạn cache QStaticText (xoá sạch khi vượt)
+
+    def __init__(self, font: QFont):
+        self.font = QFont(font)
+        self.font.setBold(True)
+        self.fm = QFontMetrics(self.font)
+        self.line_height = self.fm.height() + 2 * self.PAD_Y
+        self._widths = {}   # tag -> bề rộng chip (px)
+        self._texts = {}    # (tag, bề rộng chữ) -> QStaticText đã elide + prepare sẵn
+
+    def static_text(self, tag: str, chip_width: int) -> QStaticText:
+        """Chữ của chip, đã cắt "…" nếu chip bị thu hẹp; layout chữ được tính một lần rồi dùng lại."""
+        text_width = chip_width - 2 * self.PAD_X
+        key = (tag, text_width)
+        text = self._texts.get(key)
+        if text is None:
+            if len(self._texts) >= self.MAX_TEXTS:
+                self._texts.clear()
+            label = tag if chip_width >= self.chip_width(tag) else \
+                self.fm.elidedText(tag, Qt.ElideRight, text_width)
+            text = QStaticText(label)
+            text.setTextFormat(Qt.PlainText)
+            text.prepare(QTransform(), self.font)
+            self._texts[key] = text
+        return text
+
+    def chip_width(self, tag: str) -> int:
+        w = self._widths.get(tag)
+        if w is None:
+            w = self.fm.horizontalAdvance(tag) + 2 * self.PAD_X
+            self._widths[tag] = w
+        return w
+
+    def flow(self, tags, width: int) -> list:
+        """Vị trí (x, y, w) của từng chip khi xếp tràn dòng trong bề rộng width."""
+        rects = []
+        x = y = 0
+        step = self.line_height + self.SPACING
+        for tag in tags:
+            w = min(self.chip_width(tag), width)
+            if x and x + w > width:
+                x = 0
+                y += step
+            rects.append((x, y, w))
+            x += w + self.SPACING
+        return rects
+
+    def height(self, tags, width: int) -> int:
+        """Chiều cao vùng tag – cùng thuật toán với flow() nhưng không tạo list."""
+        lines = 1
+        x = 0
+        for tag in tags:
+            w = min(self.chip_width(tag), width)
+            if x and x + w > width:
+                x = 0
+                lines += 1
+            x += w + self.SPACING
+        return lines * self.line_height + (lines - 1) * self.SPACING
+
+
+class TagChips(QWidget):
+    """Vùng tag của card: vẽ các chip bằng QPainter, xử lý click/tooltip theo vị trí."""
+    tag_remove_requested = Signal(str)
+    tag_insert_requested = Signal(str)
+
+    def __init__(self, metrics: ChipMetrics, width: int, parent=None):
+        super().__init__(parent)
+        self._metrics = metrics
+        self._width = width
+        self._tags = []
+        self._filters = {}
+        self._rects = []
+        self.setMinimumWidth(width)
+
+    def set_tags(self, tags: list, tag_filters: dict):
+        self._tags = tags
+        self._filters = tag_filters
+        m = self._metrics
+        self._rects = [QRect(x, y, w, m.line_height)
+                       for x, y, w in m.flow(tags, self._width)]
+        self.setFixedHeight(m.height(tags, self._width))
+        self.update()
+
+    def set_filters(self, tag_filters: dict):
+        """Đổi filter: bố cục giữ nguyên, chỉ vẽ lại nếu màu của tag nào đó đổi."""
+        old, self._filters = self._filters, tag_filters
+        if any(bool(old.get(t)) != bool(tag_filters.get(t)) for t in self._tags):
+            self.update()
+
+    def sizeHint(self) -> QSize:
+        return QSize(self._width, self.height())
+
+    def tag_at(self, pos):
+        for rect, tag in zip(self._rects, self._tags):
+            if rect.contains(pos):
+                return tag
+        return None
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        if not self._tags:
+            font = QFont(self.font())
+            font.setItalic(True)
+            painter.setFont(font)
+            painter.setPen(QColor("#888"))
+            painter.drawText(self.rect(), Qt.AlignLeft | Qt.AlignVCenter, tr("no_tags_msg"))
+            return
+
+        m = self._metrics
+        painter.setRenderHint(QPainter.Antialiasing)
+        painter.setFont(m.font)
+        bg = QColor("#3c3c3c")
+        active, normal = QColor("#80ff80"), QColor("white")
+        clip = event.rect()
+        chips = [(rect, tag) for rect, tag in zip(self._rects, self._tags) if rect.intersects(clip)]
+
+        # Hai lượt: nền tất cả chip, rồi chữ gom theo màu – ít lần đổi pen/brush
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(bg)
+        for rect, _ in chips:
+            painter.drawRoundedRect(rect, 3, 3)
+        offset = QPoint(m.PAD_X, m.PAD_Y)
+        filters = self._filters
+        for color, want in ((normal, False), (active, True)):
+            painter.setPen(color)
+            for rect, tag in chips:
+                if bool(filters.get(tag, False)) == want:
+                    painter.drawStaticText(rect.topLeft() + offset, m.static_text(tag, rect.width()))
+
+    def mousePressEvent(self, event):
+        tag = self.tag_at(event.position().toPoint())
+        if tag is None:
+            event.ignore()              # click vào chỗ trống → card xử lý (chọn ảnh)
+            return
+        if event.button() == Qt.MiddleButton:
+            self.tag_remove_requested.emit(tag)
+        elif event.button() == Qt.RightButton:
+            self.tag_insert_requested.emit(tag)
+
+    def event(self, event):
+        if event.type() == QEvent.ToolTip:
+            tag = self.tag_at(event.pos())
+            if tag is None:
+                QToolTip.hideText()
+                event.ignore()
+            else:
+                QToolTip.showText(event.globalPos(), f'"{tag}"\n' + tr("tag_tooltip"), self)
+            return True
+        return super().event(event)
+
 
 class ImageCard(QFrame):
-    """Widget thẻ ảnh đơn với checkbox và hiển thị tags."""
+    """Widget thẻ ảnh đơn với checkbox và hiển thị tags – được ImageGrid tái sử dụng qua bind()."""
     selection_changed = Signal(int, bool)
     tag_added = Signal(int, str)
 
     tag_remove_requested = Signal(int, str)
     tag_insert_requested = Signal(str)
 
-    def __init__(self, idx: int, img_data: dict, img_width: int = 200,
-                 tag_filters: dict = None, parent=None):
+    def __init__(self, img_width: int, metrics: ChipMetrics, parent=None):
         super().__init__(parent)
-        self.idx = idx
-        self.img_data = img_data
+        self.idx = -1
+        self.img_data = None
         self.img_width = img_width
-        self.tag_filters = tag_filters or {}
+        self.tag_filters = {}
+        self._metrics = metrics
         self._selected = False
+        self.thumb_path = None      # ảnh mà img_label đang hiển thị / chờ giải mã
+        self.thumb_ready = False
         self.setObjectName("ImageCard")   # dùng cho CSS selector trong _set_border
         self.setFrameShape(QFrame.Box)
         self.setLineWidth(2)
@@ -45,7 +219,7 @@ class ImageCard(QFrame):
     def retranslate_ui(self):
         """Cập nhật các thành phần text trong card."""
         self.tag_entry.setPlaceholderText(tr("add_tag_placeholder"))
-        self.refresh_tags() # Để cập nhật tooltip và chữ "Không có tags"
+        self.tag_display.update()   # chữ "Không có tags" được vẽ lại
 
     def setup_ui(self):
         layout = QVBoxLayout(self)
@@ -55,12 +229,8 @@ class ImageCard(QFrame):
         # Image
         img_label = QLabel()
         img_label.setAlignment(Qt.AlignCenter)
-        # img_label.setCursor(Qt.PointingHandCursor)
         img_label.setFixedSize(self.img_width, self.img_width)
-        # img_label.mousePressEvent = lambda e: self.toggle_select()
-        # self._load_image(img_label)
         self.img_label = img_label
-        self._image_loaded = False
         layout.addWidget(self.img_label, alignment=Qt.AlignCenter)
 
         # Checkbox
@@ -68,13 +238,13 @@ class ImageCard(QFrame):
         self.checkbox.stateChanged.connect(self._on_check_changed)
         layout.addWidget(self.checkbox, alignment=Qt.AlignCenter)
 
-        # Tags display
-        self.tag_display = QWidget()
-        self.tag_display_layout = QGridLayout(self.tag_display)
-        self.tag_display_layout.setContentsMargins(2, 2, 2, 2)
-        self.tag_display_layout.setSpacing(2)
+        # Tags display (vẽ trực tiếp)
+        self.tag_display = TagChips(self._metrics, self.img_width)
+        self.tag_display.tag_remove_requested.connect(
+            lambda t: self.tag_remove_requested.emit(self.idx, t))
+        self.tag_display.tag_insert_requested.connect(self.tag_insert_requested)
         layout.addWidget(self.tag_display)
-        self.refresh_tags()
+        layout.addStretch(1)
 
         # Tag entry row
         entry_row = QWidget()
@@ -92,84 +262,46 @@ class ImageCard(QFrame):
         entry_layout.addWidget(add_btn)
         layout.addWidget(entry_row)
 
-    def _load_image(self, label: QLabel):
-        try:
-            path = self.img_data.get('path', None)
-            if not path:
-                raise ValueError("No image path provided")
-
-            pixmap = QPixmap(path)
-            if pixmap.isNull():
-                raise ValueError(f"Cannot load image from {path}")
-
-            # Scale the image while keeping aspect ratio
-            pixmap = pixmap.scaled(
-                self.img_width,
-                self.img_width,  # you can change to self.img_height if needed
-                Qt.AspectRatioMode.KeepAspectRatio,
-                Qt.TransformationMode.SmoothTransformation
-            )
-
-            label.setPixmap(pixmap)
-
-        except Exception as e:
-            print(f"Error: {e}")
-            label.setText(f"❌ Error: {e}")
-            label.setStyleSheet("color: red;")
-
-    def showEvent(self, event):
-        super().showEvent(event)
-        if not self._image_loaded:
-            self._load_image(self.img_label)
-            self._image_loaded = True
+    def bind(self, idx: int, img_data, tag_filters: dict, selected: bool):
+        """Gắn card với ảnh idx (card được tái sử dụng khi cuộn)."""
+        self.idx = idx
+        self.img_data = img_data
+        self.tag_filters = tag_filters
+        self.set_selected(selected)
+        path = img_data.get('path')
+        if path != self.thumb_path:
+            # Thumbnail do ImageGrid yêu cầu ThumbnailLoader giải mã ở luồng nền
+            self.thumb_path = path
+            self.thumb_ready = False
+            self.img_label.clear()
+            self.img_label.setStyleSheet("")
+        self.refresh_tags()
+
+    def set_thumbnail(self, pixmap: QPixmap):
+        self.thumb_ready = True
+        self.img_label.setPixmap(pixmap)
+
+    def set_thumbnail_error(self, message: str):
+        self.thumb_ready = True
+        print(f"Error: {message}")
+        self.img_label.setText(f"❌ Error: {message}")
+        self.img_label.setStyleSheet("color: red;")
 
     def mousePressEvent(self, event):
         if self.tag_entry.underMouse():
             super().mousePressEvent(event)
             return
-            
+
         if event.button() == Qt.LeftButton:
             self.toggle_select()
         super().mousePressEvent(event)
 
     def refresh_tags(self):
-        # Clear
-        while self.tag_display_layout.count():
-            item = self.tag_display_layout.takeAt(0)
-            if item.widget():
-                item.widget().deleteLater()
-
-        tags = self.img_data['tags']
-        max_per_row = 3
-        if tags:
-            for i, tag in enumerate(tags):
-                is_active = self.tag_filters.get(tag, False)
-                color = "#80ff80" if is_active else "white"
-                lbl = QLabel(tag)
-                lbl.setCursor(Qt.PointingHandCursor)
-                lbl.setStyleSheet(
-                    f"background:#3c3c3c; color:{color}; font-weight:bold;"
-                    f" padding:2px 5px; border-radius:3px;"
-                )
-                lbl.setWordWrap(True)
-
-                def make_mouse_event(t):
-                    def handler(event):
-                        if event.button() == Qt.MiddleButton:
-                            self.tag_remove_requested.emit(self.idx, t)
-                        elif event.button() == Qt.RightButton:
-                            self.tag_insert_requested.emit(t)
-                    return handler
-
-                lbl.mousePressEvent = make_mouse_event(tag)
-
-                lbl.setToolTip(f'"{tag}"\n' + tr("tag_tooltip"))
-
-                self.tag_display_layout.addWidget(lbl, i // max_per_row, i % max_per_row)
-        else:
-            lbl = QLabel(tr("no_tags_msg"))
-            lbl.setStyleSheet("color:#888; font-style:italic;")
-            self.tag_display_layout.addWidget(lbl, 0, 0)
+        self.tag_display.set_tags(list(self.img_data['tags']), self.tag_filters)
+
+    def set_filters(self, tag_filters: dict):
+        self.tag_filters = tag_filters
+        self.tag_display.set_filters(tag_filters)
 
     def toggle_select(self):
         self.checkbox.setChecked(not self.checkbox.isChecked())
@@ -183,8 +315,9 @@ class ImageCard(QFrame):
         self.checkbox.blockSignals(True)
         self.checkbox.setChecked(value)
         self.checkbox.blockSignals(False)
-        self._selected = value
-        self._set_border(value)
+        if value != self._selected:
+            self._selected = value
+            self._set_border(value)
 
     def is_selected(self) -> bool:
         return self._selected
@@ -197,21 +330,52 @@ class ImageCard(QFrame):
 
 
 class ImageGrid(QWidget):
-    """Widget lưới ảnh chính."""
+    """Widget lưới ảnh chính (ảo hoá – chỉ các hàng đang hiển thị mới có ImageCard)."""
     selection_changed = Signal(set)
     tag_add_requested = Signal(int, str)
 
     tag_insert_requested = Signal(str)
     tag_remove_requested = Signal(int, str)
 
+    MARGIN = 8
+    SPACING = 10
+    OVERSCAN = 300      # px dựng thêm phía trên/dưới vùng nhìn thấy để cuộn không bị trống
+    STALE_BATCH = 500   # số card khuất được đo lại chiều cao mỗi vòng event loop
+
     def __init__(self, parent=None):
         super().__init__(parent)
-        self._images = []
+        self._images = ImageStore('', [])
         self._selected = set()
         self._tag_filters = {}
         self._cols = 3
         self._img_width = 200
-        self._cards: dict = {}
+        self._cards: dict = {}      # idx -> card đang gắn
+        self._pool: list = []       # card rảnh chờ tái sử dụng
+        self._drafts: dict = {}     # idx -> chữ đang gõ dở trong ô thêm tag của card đã bị thu hồi
+
+        self._metrics = ChipMetrics(self.font())
+        self._thumbs = ThumbnailLoader(self, cache=ThumbnailCache())
+        self._thumbs.loaded.connect(self._on_thumbnail_loaded)
+        self._thumbs.failed.connect(self._on_thumbnail_failed)
+        self._card_size = None      # (rộng card, chiều cao phần cố định) đo từ card mẫu
+
+        # Phân nhóm theo filter: ảnh khớp / không khớp (danh sách idx đã sắp xếp)
+        self._active = None         # list tag filter đang bật lúc phân nhóm
+        self._matched = None        # set idx khớp filter (None = không có filter)
+        self._with: list = []
+        self._without: list = []
+
+        # Bố cục: danh sách hàng ('header', widget) / ('cards', [idx...])
+        self._rows: list = []
+        self._row_tops: list = []
+        self._row_heights: list = []
+        self._row_of: dict = {}     # idx -> số thứ tự hàng
+        self._card_heights: list = []
+        self._layout_cols = None
+
+        # Refresh gom theo vòng event loop
+        self._dirty: set = set()    # idx đã đổi tag, chưa xử lý
+        self._stale: set = set()    # idx khuất màn hình, chiều cao chưa đo lại
 
         layout = QVBoxLayout(self)
         layout.setContentsMargins(0, 0, 0, 0)
@@ -222,99 +386,278 @@ class ImageGrid(QWidget):
         layout.addWidget(self.scroll_area)
 
         self._container = QWidget()
-        self._grid_layout = QGridLayout(self._container)
-        self._grid_layout.setContentsMargins(8, 8, 8, 8)
-        self._grid_layout.setSpacing(10)
         self.scroll_area.setWidget(self._container)
+        self.scroll_area.verticalScrollBar().valueChanged.connect(self._update_visible)
+        self.scroll_area.viewport().installEventFilter(self)
+
+        self._header_with = QLabel(self._container)
+        self._header_with.setStyleSheet("background:#4CAF50; color:white; font-weight:bold; padding:6px;")
+        self._separator = QFrame(self._container)
+        self._separator.setFrameShape(QFrame.HLine)
+        self._header_without = QLabel(self._container)
+        self._header_without.setStyleSheet("background:#f44336; color:white; font-weight:bold; padding:6px;")
+        for w in (self._header_with, self._separator, self._header_without):
+            w.hide()
+
+        # refresh_card hàng loạt (replace/xoá tag…) chỉ được xử lý một lần ở vòng event loop kế tiếp
+        self._refresh_timer = QTimer(self)
+        self._refresh_timer.setSingleShot(True)
+        self._refresh_timer.setInterval(0)
+        self._refresh_timer.timeout.connect(self._flush_refresh)
+        self._stale_timer = QTimer(self)
+        self._stale_timer.setSingleShot(True)
+        self._stale_timer.setInterval(0)
+        self._stale_timer.timeout.connect(self._measure_stale_batch)
+
+    def eventFilter(self, obj, event):
+        if obj is self.scroll_area.viewport() and event.type() == QEvent.Resize:
+            self._update_visible()
+        return super().eventFilter(obj, event)
 
     def retranslate_ui(self):
         """Cập nhật text cho ImageGrid."""
-        self._rebuild() # Rebuild lại grid để cập nhật các Header "Ảnh có tags/Không có tags"
-        
-        # Cập nhật tất cả các card đang hiển thị
-        for card in self._cards.values():
+        self._update_rows(force_headers=True)  # cập nhật các Header "Ảnh có tags/Không có tags"
+
+        # Cập nhật tất cả các card (kể cả card trong pool)
+        for card in list(self._cards.values()) + self._pool:
             card.retranslate_ui()
 
     def set_data(self, images: list, tag_filters: dict = None):
+        for idx in list(self._cards):
+            self._release(idx)
+        self._thumbs.cancel_all()
         self._images = images
         self._tag_filters = tag_filters or {}
         self._selected.clear()
+        self._drafts.clear()
+        self._dirty.clear()
+        self._stale.clear()
+        # Bỏ bố cục cũ trước khi cuộn về đầu: valueChanged không được gắn card theo hàng
+        # của folder trước (chỉ số ảnh cũ có thể vượt quá folder mới)
+        self._rows, self._row_tops, self._row_heights, self._row_of = [], [], [], {}
+        self.scroll_area.verticalScrollBar().setValue(0)
         self._rebuild()
 
     def set_columns(self, cols: int):
         self._cols = cols
-        self._rebuild()
+        self._update_rows()
 
     def set_tag_filters(self, filters: dict):
+        """Lọc lại theo filter: chỉ các ảnh đổi nhóm bị dời, bố cục tính lại từ hàng đầu tiên thay đổi."""
         self._tag_filters = filters
-        self._rebuild()
+        for card in self._cards.values():
+            card.set_filters(filters)
+        if self._partition():
+            self._update_rows()
+
+    # ── Bố cục ảo ────────────────────────────────────────────────────────
+
+    def _measure_card(self):
+        """Đo card mẫu một lần: bề rộng card và chiều cao phần không phải tag."""
+        if self._card_size is None:
+            card = self._new_card()
+            card.tag_display.setFixedHeight(0)
+            card.set_selected(True)             # viền dày nhất
+            card.ensurePolished()
+            hint = card.sizeHint()
+            self._card_size = (max(hint.width(), self._img_width + 14), hint.height())
+            card.set_selected(False)
+            self._pool.append(card)
+        return self._card_size
+
+    def _card_height(self, idx: int) -> int:
+        chrome = self._measure_card()[1]
+        return chrome + self._metrics.height(self._images.tags(idx), self._img_width)
 
     def _rebuild(self):
-        # Clear
-        self._cards.clear()
-        while self._grid_layout.count():
-            item = self._grid_layout.takeAt(0)
-            if item.widget():
-                item.widget().deleteLater()
-
-        active_filters = [t for t, v in self._tag_filters.items() if v]
-
-        with_tags = []
-        without_tags = []
-        for idx, img in enumerate(self._images):
-            if active_filters:
-                if any(t in img['tags'] for t in active_filters):
-                    with_tags.append((idx, img))
-                else:
-                    without_tags.append((idx, img))
+        """Dựng lại toàn bộ (đổi folder): đo chiều cao mọi card, phân nhóm, xếp hàng."""
+        self._card_heights = [self._card_height(idx) for idx in range(len(self._images))]
+        self._active = self._matched = None
+        self._with, self._without = [], []
+        self._rows, self._row_tops, self._row_heights, self._row_of = [], [], [], {}
+        self._partition(force=True)
+        self._update_rows()
+
+    def _partition(self, force: bool = False) -> bool:
+        """Cập nhật nhóm khớp/không khớp filter. Trả về False nếu không có gì thay đổi."""
+        active = [t for t, v in self._tag_filters.items() if v]
+        # Ảnh khớp filter lấy thẳng từ posting index của ImageStore
+        matched = set(self._images.images_with_any(active)) if active else None
+
+        if not force and active == self._active:
+            if matched == self._matched:
+                return False
+            # Cùng bộ filter, chỉ vài ảnh vừa được sửa tag → dời đúng các ảnh đó
+            for idx in sorted(matched ^ self._matched):
+                src, dst = (self._without, self._with) if idx in matched else (self._with, self._without)
+                del src[bisect_left(src, idx)]
+                insort(dst, idx)
+        elif matched is None:
+            self._with, self._without = list(range(len(self._images))), []
+        else:
+            self._with = sorted(matched)
+            self._without = [idx for idx in range(len(self._images)) if idx not in matched]
+
+        self._active, self._matched = active, matched
+        return True
+
+    def _update_rows(self, force_headers: bool = False):
+        """Chia nhóm thành hàng; chỉ các hàng từ vị trí khác bố cục cũ trở đi được tính lại."""
+        cols = max(1, self._cols)
+        active = self._active or []
+        rows = []
+        if self._with and active:
+            self._set_header_text(self._header_with, tr("images_with_tags") + f": {', '.join(active)}")
+            rows.append(('header', self._header_with))
+        rows.extend(('cards', self._with[i:i + cols]) for i in range(0, len(self._with), cols))
+
+        if self._without and active:
+            self._set_header_text(self._header_without, tr("images_without_tags") + f": {', '.join(active)}")
+            rows.append(('header', self._separator))
+            rows.append(('header', self._header_without))
+            rows.extend(('cards', self._without[i:i + cols]) for i in range(0, len(self._without), cols))
+
+        # Các hàng đầu giống hệt bố cục cũ giữ nguyên chiều cao và toạ độ
+        start = 0
+        if cols == self._layout_cols and not force_headers:
+            old = self._rows
+            limit = min(len(old), len(rows))
+            while start < limit and old[start] == rows[start]:
+                start += 1
+        self._layout_cols = cols
+
+        heights = self._row_heights[:start]
+        for r in range(start, len(rows)):
+            kind, payload = rows[r]
+            if kind == 'cards':
+                for idx in payload:
+                    self._row_of[idx] = r
+                heights.append(max(self._card_heights[idx] for idx in payload))
             else:
-                with_tags.append((idx, img))
-
-        row = 0
+                heights.append(payload.sizeHint().height())
+        self._rows, self._row_heights = rows, heights
+
+        shown = {payload for kind, payload in rows if kind == 'header'}
+        for w in (self._header_with, self._separator, self._header_without):
+            if w.isHidden() == (w in shown):
+                w.setVisible(w in shown)
+        self._relayout(start)
+
+    @staticmethod
+    def _set_header_text(label: QLabel, text: str):
+        if label.text() != text:
+            label.setText(text)
+
+    def _relayout(self, start: int = 0):
+        """Tính lại toạ độ các hàng từ hàng start rồi đặt lại các card đang hiển thị."""
+        card_w = self._measure_card()[0]
+        cols = max(1, self._cols)
+        grid_w = cols * card_w + (cols - 1) * self.SPACING
+
+        tops = self._row_tops[:start]
+        y = tops[-1] + self._row_heights[start - 1] + self.SPACING if tops else self.MARGIN
+        for r in range(start, len(self._rows)):
+            kind, payload = self._rows[r]
+            tops.append(y)
+            if kind == 'header':
+                payload.setGeometry(self.MARGIN, y, grid_w, self._row_heights[r])
+            y += self._row_heights[r] + self.SPACING
+        self._row_tops = tops
+        height = y - self.SPACING + self.MARGIN if tops else 2 * self.MARGIN
+        self._container.setMinimumSize(grid_w + 2 * self.MARGIN, height)
+        self._update_visible()
+
+    def _update_visible(self):
+        """Gắn card cho các hàng trong vùng nhìn thấy, thu hồi card đã ra khỏi vùng đó."""
+        wanted = {}
+        if self._rows:
+            card_w = self._measure_card()[0]
+            top = self.scroll_area.verticalScrollBar().value() - self.OVERSCAN
+            bottom = top + self.scroll_area.viewport().height() + 2 * self.OVERSCAN
+            first = max(bisect_right(self._row_tops, top) - 1, 0)
+            last = bisect_right(self._row_tops, bottom)
+            if self._stale:
+                # Hàng sắp hiện còn card chưa đo lại → đo ngay, đặt lại toạ độ rồi tính lại vùng nhìn
+                coming = [idx for r in range(first, last) if self._rows[r][0] == 'cards'
+                          for idx in self._rows[r][1] if idx in self._stale]
+                if coming:
+                    self._stale.difference_update(coming)
+                    changed = self._remeasure(coming)
+                    if changed is not None:
+                        self._relayout(changed)
+                        return
+            for r in range(first, last):
+                kind, payload = self._rows[r]
+                if kind != 'cards':
+                    continue
+                y, h = self._row_tops[r], self._row_heights[r]
+                for col, idx in enumerate(payload):
+                    wanted[idx] = QRect(self.MARGIN + col * (card_w + self.SPACING), y, card_w, h)
+
+        for idx in [i for i in self._cards if i not in wanted]:
+            self._release(idx)
+        for idx, rect in wanted.items():
+            card = self._cards.get(idx) or self._acquire(idx)
+            if card.geometry() != rect:
+                card.setGeometry(rect)
+            if card.isHidden():
+                card.show()
+
+    def _new_card(self) -> ImageCard:
+        card = ImageCard(self._img_width, self._metrics, self._container)
+        card.hide()
+        card.selection_changed.connect(self._on_card_selection)
+        card.tag_added.connect(self.tag_add_requested)
+        card.tag_remove_requested.connect(self._on_tag_remove)
+        card.tag_insert_requested.connect(self.tag_insert_requested)
+        return card
 
-        if with_tags and active_filters:
-            header = QLabel( tr("images_with_tags") + f": {', '.join(active_filters)}" )
+    def _acquire(self, idx: int) -> ImageCard:
+        card = self._pool.pop() if self._pool else self._new_card()
+        card.bind(idx, self._images[idx], self._tag_filters, idx in self._selected)
+        if not card.thumb_ready:
+            cached = PIXMAP_CACHE.get(card.thumb_path, self._img_width)
+            if cached is not None:
+                card.set_thumbnail(cached[1])
+                self._thumbs.request(card.thumb_path, self._img_width, known_key=cached[0])
+            else:
+                self._thumbs.request(card.thumb_path, self._img_width)
+        card.tag_entry.setText(self._drafts.pop(idx, ""))
+        self._cards[idx] = card
+        return card
 
-            header.setStyleSheet("background:#4CAF50; color:white; font-weight:bold; padding:6px;")
-            self._grid_layout.addWidget(header, row, 0, 1, self._cols)
-            row += 1
+    def _release(self, idx: int):
+        card = self._cards.pop(idx)
+        if not card.thumb_ready:
+            self._thumbs.cancel(card.thumb_path)
+        if card.tag_entry.text():
+            self._drafts[idx] = card.tag_entry.text()
+        card.hide()
+        self._pool.append(card)
 
-        for grid_i, (idx, img) in enumerate(with_tags):
-            card = self._make_card(idx, img)
-            self._grid_layout.addWidget(card, row + grid_i // self._cols, grid_i % self._cols)
-        if with_tags:
-            row += ((len(with_tags) - 1) // self._cols) + 1
+    def _card_for_path(self, path: str):
+        for card in self._cards.values():
+            if card.thumb_path == path:
+                return card
+        return None
 
-        if without_tags and active_filters:
-            sep = QFrame()
-            sep.setFrameShape(QFrame.HLine)
-            self._grid_layout.addWidget(sep, row, 0, 1, self._cols)
-            row += 1
+    def _on_thumbnail_loaded(self, path: str, image: QImage, key: str):
+        pixmap = QPixmap.fromImage(image)
+        PIXMAP_CACHE.put(path, self._img_width, key, pixmap)
+        card = self._card_for_path(path)
+        if card is not None:
+            card.set_thumbnail(pixmap)
 
-            header2 = QLabel( tr("images_without_tags") + f": {', '.join(active_filters)}" )
-            header2.setStyleSheet("background:#f44336; color:white; font-weight:bold; padding:6px;")
-            self._grid_layout.addWidget(header2, row, 0, 1, self._cols)
-            row += 1
+    def _on_thumbnail_failed(self, path: str, message: str):
+        card = self._card_for_path(path)
+        if card is not None:
+            card.set_thumbnail_error(message)
 
-            for grid_i, (idx, img) in enumerate(without_tags):
-                card = self._make_card(idx, img)
-                self._grid_layout.addWidget(card, row + grid_i // self._cols, grid_i % self._cols)
+    def shutdown(self):
+        """Dừng giải mã nền (gọi khi đóng cửa sổ chính)."""
+        self._thumbs.shutdown()
 
-        # Spacer
-        spacer = QWidget()
-        spacer.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Expanding)
-        self._grid_layout.addWidget(spacer, self._grid_layout.rowCount(), 0, 1, self._cols)
-
-    def _make_card(self, idx: int, img: dict) -> ImageCard:
-        card = ImageCard(idx, img, self._img_width, self._tag_filters)
-        card.selection_changed.connect(self._on_card_selection)
-        card.tag_added.connect(self.tag_add_requested)
-        card.tag_remove_requested.connect(self._on_tag_remove)
-        card.tag_insert_requested.connect(self.tag_insert_requested)
-        if idx in self._selected:
-            card.set_selected(True)
-        self._cards[idx] = card
-        return card
+    # ── Chọn ảnh ────────────────────────────────────────────────────────
 
     def _on_card_selection(self, idx: int, selected: bool):
         if selected:
@@ -324,36 +667,76 @@ class ImageGrid(QWidget):
         self.selection_changed.emit(set(self._selected))
 
     def select_all(self):
-        for idx in range(len(self._images)):
-            self._selected.add(idx)
-            if idx in self._cards:
-                self._cards[idx].set_selected(True)
+        self._selected.update(range(len(self._images)))
+        for card in self._cards.values():
+            card.set_selected(True)
         self.selection_changed.emit(set(self._selected))
 
     def deselect_all(self):
-        for idx in list(self._selected):
-            if idx in self._cards:
-                self._cards[idx].set_selected(False)
+        for card in self._cards.values():
+            card.set_selected(False)
         self._selected.clear()
         self.selection_changed.emit(set())
 
     def invert_selection(self):
-        for idx in range(len(self._images)):
-            new_state = idx not in self._selected
-            if new_state:
-                self._selected.add(idx)
-            else:
-                self._selected.discard(idx)
-            if idx in self._cards:
-                self._cards[idx].set_selected(new_state)
+        self._selected = set(range(len(self._images))) - self._selected
+        for idx, card in self._cards.items():
+            card.set_selected(idx in self._selected)
         self.selection_changed.emit(set(self._selected))
 
     def refresh_card(self, idx: int):
-        if idx in self._cards:
+        """Đánh dấu card cần vẽ lại; việc thật được gom lại ở _flush_refresh."""
+        self._dirty.add(idx)
+        if not self._refresh_timer.isActive():
+            self._refresh_timer.start()
+
+    def refresh_cards(self, indices):
+        self._dirty.update(indices)
+        if self._dirty and not self._refresh_timer.isActive():
+            self._refresh_timer.start()
+
+    def _flush_refresh(self):
+        dirty, self._dirty = self._dirty, set()
+        n = len(self._images)
+        visible = [idx for idx in dirty if idx in self._cards]
+        for idx in visible:
             self._cards[idx].refresh_tags()
+        # Card khuất: không có widget để vẽ, chỉ cần đo lại chiều cao (dần dần)
+        self._stale.update(idx for idx in dirty if idx < n and idx not in self._cards)
+        changed = self._remeasure(visible)
+        if changed is not None:
+            self._relayout(changed)
+        if self._stale and not self._stale_timer.isActive():
+            self._stale_timer.start()
+
+    def _measure_stale_batch(self):
+        batch = [self._stale.pop() for _ in range(min(self.STALE_BATCH, len(self._stale)))]
+        changed = self._remeasure(batch)
+        if changed is not None:
+            self._relayout(changed)
+        if self._stale:
+            self._stale_timer.start()
+
+    def _remeasure(self, indices):
+        """Đo lại chiều cao card; trả về hàng nhỏ nhất có chiều cao thay đổi (None nếu không có)."""
+        rows = set()
+        for idx in indices:
+            h = self._card_height(idx)
+            if h != self._card_heights[idx]:
+                self._card_heights[idx] = h
+                r = self._row_of.get(idx)
+                if r is not None:
+                    rows.add(r)
+        first = None
+        for r in rows:
+            row_h = max(self._card_heights[i] for i in self._rows[r][1])
+            if row_h != self._row_heights[r]:
+                self._row_heights[r] = row_h
+                first = r if first is None else min(first, r)
+        return first
 
     def get_selected(self) -> set:
         return set(self._selected)
-    
+
     def _on_tag_remove(self, idx: int, tag: str):
-        self.tag_remove_requested.emit(idx, tag)
\ No newline at end of file
+        self.tag_remove_requested.emit(idx, tag)
@@ -0,0 +1,489 @@
+"""
+image_store.py - Compact, array-backed storage for the images of a folder.
+
+Thay cho list các dict ({'path', 'txt_path', 'filename', 'tags', 'modified'}):
+  - Tag được intern một lần trong TagVocab (tag → int id), dùng chung giữa các folder.
+  - Tags của từng ảnh là dãy id: CSR (offsets + payload array('I')),
+    các dòng đã sửa nằm trong overlay cho tới lần compact tiếp theo.
+  - Trạng thái modified là một bitset.
+  - Inverted index tag → ảnh (posting list đã sort), cập nhật tăng dần theo
+    từng thay đổi: filter / count / xoá / thay tag chỉ chạm các ảnh liên quan,
+    và số đếm tag được báo lại dạng delta (take_count_changes).
+  - store[i] trả về ImageView, hành xử như dict cũ (img['tags'].append(...),
+    img['modified'] = True, img.get(...)) nên image_grid, history_manager và
+    các tools không cần đổi.
+"""
+import os
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter
+from collections.abc import MutableMapping, MutableSequence, Sequence
+
+
+class TagVocab:
+    """Interned tag names: tag ↔ int id (id không bao giờ bị thu hồi)."""
+
+    def __init__(self):
+        self._ids: dict = {}
+        self._names: list = []
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def intern(self, tag: str) -> int:
+        tid = self._ids.get(tag)
+        if tid is None:
+            tid = self._ids[tag] = len(self._names)
+            self._names.append(tag)
+        return tid
+
+    def get(self, tag: str, default=None):
+        """Id của tag, không tạo mới."""
+        return self._ids.get(tag, default)
+
+    def name(self, tid: int) -> str:
+        return self._names[tid]
+
+    def names(self, ids) -> list:
+        names = self._names
+        return [names[i] for i in ids]
+
+    def ids(self, tags) -> array:
+        intern = self.intern
+        return array('I', [intern(t) for t in tags])
+
+
+class TagSnapshot:
+    """Bản chụp tags của cả store (dùng cho undo/redo) – chỉ là hai mảng id."""
+
+    __slots__ = ('vocab', 'offsets', 'payload')
+
+    def __init__(self, vocab: TagVocab, offsets: array, payload: array):
+        self.vocab = vocab
+        self.offsets = offsets
+        self.payload = payload
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def row(self, idx: int) -> array:
+        return self.payload[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def __getitem__(self, idx: int) -> list:
+        return self.vocab.names(self.row(idx))
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+
+class ImageStore(Sequence):
+    """Danh sách ảnh của một folder, lưu dạng mảng. store[i] → ImageView."""
+
+    # Overlay lớn hơn ngưỡng này (số dòng) thì gộp lại vào CSR
+    COMPACT_MIN = 1024
+
+    def __init__(self, folder: str, filenames: list, tag_lists=None, vocab: TagVocab = None):
+        self.folder = folder
+        self.vocab = vocab if vocab is not None else TagVocab()
+        self._filenames = list(filenames)
+        n = len(self._filenames)
+
+        self._offsets = array('I', [0])
+        self._payload = array('I')
+        for tags in (tag_lists if tag_lists is not None else [()] * n):
+            self._payload.extend(self.vocab.ids(tags))
+            self._offsets.append(len(self._payload))
+        if len(self._offsets) != n + 1:
+            raise ValueError(f"{n} filenames but {len(self._offsets) - 1} tag lists")
+
+        self._edits: dict = {}                  # idx → array('I'), dòng đã sửa
+        self._modified = bytearray((n + 7) // 8)
+        self._modified_count = 0
+        self._extra: dict = {}                  # idx → {key: value} cho key ngoài 5 key chuẩn
+
+        # tag id → array('I') các idx ảnh (sort, lặp lại nếu ảnh có tag trùng); dựng lười
+        self._postings: dict = None
+        # tag id → thay đổi số đếm từ lần take_count_changes() trước; None = cần đếm lại hết
+        self._count_delta: dict = {}
+
+    @classmethod
+    def from_dicts(cls, folder: str, images: list, vocab: TagVocab = None) -> "ImageStore":
+        store = cls(folder, [img['filename'] for img in images],
+                    [img.get('tags', []) for img in images], vocab)
+        for idx, img in enumerate(images):
+            if img.get('modified'):
+                store.set_modified(idx, True)
+        return store
+
+    # ── Sequence ────────────────────────────────
+    def __len__(self) -> int:
+        return len(self._filenames)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [ImageView(self, i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("image index out of range")
+        return ImageView(self, idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield ImageView(self, idx)
+
+    def __repr__(self) -> str:
+        return f"<ImageStore {self.folder!r}: {len(self)} images, {len(self.vocab)} tags>"
+
+    # ── Paths ───────────────────────────────────
+    def filename(self, idx: int) -> str:
+        return self._filenames[idx]
+
+    def path(self, idx: int) -> str:
+        return os.path.join(self.folder, self._filenames[idx])
+
+    def txt_path(self, idx: int) -> str:
+        return os.path.splitext(self.path(idx))[0] + '.txt'
+
+    # ── Tags ────────────────────────────────────
+    def tag_ids(self, idx: int) -> array:
+        """Dãy id tags của ảnh (bản copy, an toàn để đọc)."""
+        row = self._edits.get(idx)
+        if row is not None:
+            return array('I', row)
+        return self._payload[self._offsets[idx]:self._offsets[idx + 1]]
+
+    def tags(self, idx: int) -> list:
+        row = self._edits.get(idx)
+        if row is None:
+            row = self._payload[self._offsets[idx]:self._offsets[idx + 1]]
+        return self.vocab.names(row)
+
+    def tag_count(self, idx: int) -> int:
+        row = self._edits.get(idx)
+        if row is not None:
+            return len(row)
+        return self._offsets[idx + 1] - self._offsets[idx]
+
+    def has_tag(self, idx: int, tag: str) -> bool:
+        tid = self.vocab.get(tag)
+        return tid is not None and tid in self._row(idx)
+
+    def set_tags(self, idx: int, tags) -> None:
+        old = self._row(idx)
+        new = self._edits[idx] = self.vocab.ids(tags)
+        self._row_changed(idx, old, new)
+        self._maybe_compact()
+
+    def _mutate(self, idx: int, fn) -> None:
+        """Sửa dòng tại chỗ bằng fn(row), rồi cập nhật index (TagListView)."""
+        row = self._row_for_write(idx)
+        old = array('I', row)
+        fn(row)
+        self._row_changed(idx, old, row)
+
+    def _row(self, idx: int):
+        """Dòng hiện tại, không copy khi đã nằm trong overlay (chỉ đọc)."""
+        row = self._edits.get(idx)
+        if row is not None:
+            return row
+        return self._payload[self._offsets[idx]:self._offsets[idx + 1]]
+
+    def _row_for_write(self, idx: int) -> array:
+        """Dòng trong overlay để sửa tại chỗ (TagListView)."""
+        row = self._edits.get(idx)
+        if row is None:
+            row = self._edits[idx] = self._payload[self._offsets[idx]:self._offsets[idx + 1]]
+            self._maybe_compact(keep=idx)
+        return row
+
+    def _maybe_compact(self, keep: int = None) -> None:
+        if len(self._edits) > max(self.COMPACT_MIN, len(self) // 8):
+            self.compact(keep)
+
+    def compact(self, keep: int = None) -> None:
+        """Gộp overlay vào CSR. *keep*: dòng vẫn để trong overlay (đang được sửa)."""
+        offsets = array('I', [0])
+        payload = array('I')
+        edits = self._edits
+        for idx in range(len(self)):
+            row = edits.get(idx)
+            if row is None:
+                row = self._payload[self._offsets[idx]:self._offsets[idx + 1]]
+            payload.extend(row)
+            offsets.append(len(payload))
+        self._offsets, self._payload = offsets, payload
+        self._edits = {keep: edits[keep]} if keep in edits else {}
+
+    # ── Modified bitset ─────────────────────────
+    def is_modified(self, idx: int) -> bool:
+        return bool(self._modified[idx >> 3] & (1 << (idx & 7)))
+
+    def set_modified(self, idx: int, value: bool) -> None:
+        byte, bit = idx >> 3, 1 << (idx & 7)
+        was = bool(self._modified[byte] & bit)
+        if value and not was:
+            self._modified[byte] |= bit
+            self._modified_count += 1
+        elif was and not value:
+            self._modified[byte] &= ~bit & 0xFF
+            self._modified_count -= 1
+
+    def any_modified(self) -> bool:
+        return self._modified_count > 0
+
+    def modified_indices(self) -> list:
+        return [i for i in range(len(self)) if self.is_modified(i)]
+
+    # ── Snapshot (history) ──────────────────────
+    def snapshot(self) -> TagSnapshot:
+        if self._edits:
+            self.compact()
+        return TagSnapshot(self.vocab, array('I', self._offsets), array('I', self._payload))
+
+    # ── Inverted index ──────────────────────────
+    def _index(self) -> dict:
+        if self._postings is None:
+            if self._edits:
+                self.compact()
+            postings = {}
+            off, payload = self._offsets, self._payload
+            for idx in range(len(self)):
+                for tid in payload[off[idx]:off[idx + 1]]:
+                    posting = postings.get(tid)
+                    if posting is None:
+                        posting = postings[tid] = array('I')
+                    posting.append(idx)
+            self._postings = postings
+        return self._postings
+
+    def _row_changed(self, idx: int, old, new) -> None:
+        """Cập nhật posting list + delta đếm cho các tag bị thêm / bớt ở một ảnh."""
+        if len(new) == len(old) + 1 and new[:-1] == old:
+            removed, added = {}, {new[-1]: 1}   # append một tag – trường hợp thêm tag hàng loạt
+        elif len(old) == len(new) and sorted(old) == sorted(new):
+            return                              # chỉ đổi thứ tự
+        else:
+            removed = Counter(old)
+            added = Counter(new)
+            removed, added = removed - added, added - removed
+        postings, delta = self._postings, self._count_delta
+        for tid, n in removed.items():
+            if postings is not None:
+                posting = postings[tid]
+                pos = bisect_left(posting, idx)
+                del posting[pos:pos + n]
+                if not posting:
+                    del postings[tid]
+            if delta is not None:
+                delta[tid] = delta.get(tid, 0) - n
+        for tid, n in added.items():
+            if postings is not None:
+                posting = postings.get(tid)
+                if posting is None:
+                    posting = postings[tid] = array('I')
+                for _ in range(n):
+                    insort(posting, idx)
+            if delta is not None:
+                delta[tid] = delta.get(tid, 0) + n
+
+    def images_with_tag(self, tag: str) -> list:
+        """Các idx ảnh có *tag* (tăng dần, không trùng)."""
+        tid = self.vocab.get(tag)
+        posting = self._index().get(tid) if tid is not None else None
+        return sorted(set(posting)) if posting else []
+
+    def images_with_any(self, tags) -> list:
+        """Các idx ảnh có ít nhất một tag trong *tags* (tăng dần)."""
+        postings = self._index()
+        hits = set()
+        for tag in tags:
+            tid = self.vocab.get(tag)
+            if tid is not None and tid in postings:
+                hits.update(postings[tid])
+        return sorted(hits)
+
+    def tag_frequency(self, tag: str) -> int:
+        """Số lần *tag* xuất hiện (tính cả tag trùng trong cùng một ảnh)."""
+        tid = self.vocab.get(tag)
+        posting = self._index().get(tid) if tid is not None else None
+        return len(posting) if posting else 0
+
+    def tag_counts(self) -> dict:
+        """{tag: số lần xuất hiện} cho mọi tag đang có trong folder."""
+        names = self.vocab.name
+        return {names(tid): len(posting) for tid, posting in self._index().items()}
+
+    def take_count_changes(self):
+        """
+        {tag: delta} kể từ lần gọi trước (delta 0 = tag có đổi ảnh nhưng số đếm
+        giữ nguyên), hoặc None nếu cần đếm lại toàn bộ (vd. sau undo/redo).
+        """
+        delta, self._count_delta = self._count_delta, {}
+        if delta is None:
+            return None
+        names = self.vocab.name
+        return {names(tid): d for tid, d in delta.items()}
+
+    def restore(self, snapshot, mark_modified: bool = True) -> None:
+        """Ghi lại tags từ snapshot (TagSnapshot hoặc list các list tags)."""
+        same_vocab = isinstance(snapshot, TagSnapshot) and snapshot.vocab is self.vocab
+        for idx in range(min(len(self), len(snapshot))):
+            if same_vocab:
+                self._edits[idx] = snapshot.row(idx)
+            else:
+                self._edits[idx] = self.vocab.ids(snapshot[idx])
+            if mark_modified:
+                self.set_modified(idx, True)
+        self.compact()
+        self._postings = None                   # dựng lại khi cần
+        self._count_delta = None
+
+
+_CORE_KEYS = ('path', 'txt_path', 'tags', 'filename', 'modified')
+
+
+class ImageView(MutableMapping):
+    """Một ảnh trong ImageStore, dùng như dict cũ. Ghi vào view là ghi vào store."""
+
+    __slots__ = ('store', 'idx')
+
+    def __init__(self, store: ImageStore, idx: int):
+        self.store = store
+        self.idx = idx
+
+    def __getitem__(self, key):
+        s, i = self.store, self.idx
+        if key == 'tags':
+            return TagListView(s, i)
+        if key == 'modified':
+            return s.is_modified(i)
+        if key == 'path':
+            return s.path(i)
+        if key == 'filename':
+            return s.filename(i)
+        if key == 'txt_path':
+            return s.txt_path(i)
+        extra = s._extra.get(i)
+        if extra is None or key not in extra:
+            raise KeyError(key)
+        return extra[key]
+
+    def __setitem__(self, key, value):
+        s, i = self.store, self.idx
+        if key == 'tags':
+            s.set_tags(i, list(value))
+        elif key == 'modified':
+            s.set_modified(i, bool(value))
+        elif key in _CORE_KEYS:
+            raise TypeError(f"'{key}' is read-only in ImageStore")
+        else:
+            s._extra.setdefault(i, {})[key] = value
+
+    def __delitem__(self, key):
+        if key in _CORE_KEYS:
+            raise TypeError(f"'{key}' cannot be deleted from ImageStore")
+        extra = self.store._extra.get(self.idx)
+        if extra is None or key not in extra:
+            raise KeyError(key)
+        del extra[key]
+
+    def __iter__(self):
+        yield from _CORE_KEYS
+        yield from self.store._extra.get(self.idx, {})
+
+    def __len__(self):
+        return len(_CORE_KEYS) + len(self.store._extra.get(self.idx, {}))
+
+    def __eq__(self, other):
+        if isinstance(other, ImageView):
+            return self.store is other.store and self.idx == other.idx
+        return MutableMapping.__eq__(self, other)
+
+    def __hash__(self):
+        return hash((id(self.store), self.idx))
+
+    def __repr__(self):
+        return f"ImageView({dict(self)!r})"
+
+
+class TagListView(MutableSequence):
+    """img['tags'] của một ImageView: list tags sống, sửa tại chỗ vào store."""
+
+    __slots__ = ('store', 'idx')
+
+    def __init__(self, store: ImageStore, idx: int):
+        self.store = store
+        self.idx = idx
+
+    # ── Đọc ─────────────────────────────────────
+    def __len__(self):
+        return self.store.tag_count(self.idx)
+
+    def __getitem__(self, i):
+        row = self.store._row(self.idx)
+        if isinstance(i, slice):
+            return self.store.vocab.names(row[i])
+        return self.store.vocab.name(row[i])
+
+    def __iter__(self):
+        return iter(self.store.tags(self.idx))
+
+    def __contains__(self, tag):
+        return self.store.has_tag(self.idx, tag)
+
+    def index(self, tag, *args):
+        tid = self.store.vocab.get(tag)
+        if tid is None:
+            raise ValueError(f"{tag!r} is not in list")
+        return list(self.store._row(self.idx)).index(tid, *args)
+
+    def count(self, tag):
+        tid = self.store.vocab.get(tag)
+        return 0 if tid is None else self.store._row(self.idx).count(tid)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, TagListView)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    # ── Ghi ─────────────────────────────────────
+    def __setitem__(self, i, value):
+        vocab = self.store.vocab
+        new = vocab.ids(value) if isinstance(i, slice) else vocab.intern(value)
+
+        def assign(row):
+            row[i] = new
+        self.store._mutate(self.idx, assign)
+
+    def __delitem__(self, i):
+        def delete(row):
+            del row[i]
+        self.store._mutate(self.idx, delete)
+
+    def insert(self, i, tag):
+        tid = self.store.vocab.intern(tag)
+        self.store._mutate(self.idx, lambda row: row.insert(i, tid))
+
+    def append(self, tag):
+        tid = self.store.vocab.intern(tag)
+        self.store._mutate(self.idx, lambda row: row.append(tid))
+
+    def remove(self, tag):
+        tid = self.store.vocab.get(tag)
+        if tid is None:
+            raise ValueError(f"{tag!r} is not in list")
+        self.store._mutate(self.idx, lambda row: row.remove(tid))
+
+    def clear(self):
+        self.store.set_tags(self.idx, [])
@@ -3,6 +3,7 @@ main.py - Entry point of TKtagger (PySide6)
 """
 import sys
 import argparse
+import multiprocessing
 from PySide6.QtWidgets import QApplication
 from settings_manager import settings
 from i18n import set_language
@@ -32,4 +33,5 @@ def main():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()    # tagger worker processes (bản đóng gói)
     main()
@@ -3,6 +3,7 @@ main_window.py - Cửa sổ chính của ứng dụng TKtagger (PySide6)
 """
 import os
 import json
+from bisect import bisect_left, insort
 from pathlib import Path
 
 from PySide6.QtWidgets import (
@@ -11,12 +12,13 @@ from PySide6.QtWidgets import (
     QTreeWidget, QTreeWidgetItem, QMessageBox,
     QFileDialog, QSpinBox, QStatusBar, QToolBar, QInputDialog,
 )
-from PySide6.QtCore import Qt, QSettings, Signal
+from PySide6.QtCore import Qt, QSettings, QTimer, Signal
 from PySide6.QtGui import QAction, QKeySequence, QShortcut, QIcon
 
 from history_manager import HistoryManager
 from history_window import HistoryWindow
-from file_ops import load_folder_images, save_all_images
+from file_ops import load_folder_images, save_all_images, CACHE_DIRNAME
+from image_store import ImageStore, TagVocab
 from image_grid import ImageGrid
 from tag_panel import TagPanel
 from dialogs import AboutDialog
@@ -34,17 +36,20 @@ from i18n import tr, set_language, get_language
 
 class MainWindow(QMainWindow):
 
-    tagging_completed = Signal(list)
+    tagging_progress = Signal(int, int, str)    # current, total, message (từ worker thread)
+    tagging_chunk = Signal(list)                # kết quả từng chunk của run_tagger
+    tagging_stream_finished = Signal(str)       # "" = xong, còn lại = thông báo lỗi
 
     def __init__(self, initial_path=None):
         super().__init__()
         
         self.root_folder = None
         self.current_folder = None
-        self.images: list = []
+        self.images: ImageStore = ImageStore('', [])
         self.all_folder_tags: list = []
         self.folder_tag_counts: dict = {}
-        self._folder_cache: dict[str, list] = {}
+        self._folder_cache: dict[str, ImageStore] = {}
+        self._tag_vocab = TagVocab()            # tag ↔ id dùng chung cho mọi folder của root
 
         self.history = HistoryManager(max_history=256)
         self.history_win: HistoryWindow = None
@@ -56,6 +61,21 @@ class MainWindow(QMainWindow):
         self._dict_tags_win:  DictTagsWidget = None
         self._resort_win                     = None   # ResortTagsWidget window
 
+        # Waifu Tagger streaming state
+        self._tag_job = None                     # TaggingJob đang chạy
+        self._tag_pending: list = []             # chunk nhận được, chờ flush
+        self._tag_targets: dict = {}             # path → image dict (mọi folder đã load)
+        self._tag_images = None                  # list images lúc bắt đầu
+        self._tag_entry = None                   # HistoryEntry đang gộp các chunk liên tiếp
+        self._tag_entry_count = 0
+        self._tag_rows: dict = {}                # path → idx trong self.images (để refresh card)
+        self._tag_rows_images = None             # images mà _tag_rows được dựng cho
+        self._tag_updated = 0
+        self._tag_flush_timer = QTimer(self)
+        self._tag_flush_timer.setSingleShot(True)
+        self._tag_flush_timer.setInterval(150)
+        self._tag_flush_timer.timeout.connect(self._flush_tagging_results)
+
         self.setup_menu()
         self.setup_ui()
         self.retranslate_ui()           # first paint with correct language
@@ -64,7 +84,9 @@ class MainWindow(QMainWindow):
         if initial_path and os.path.exists(initial_path):
             self.select_root_folder(initial_path)
 
-        self.tagging_completed.connect(self._on_tagging_finished)
+        self.tagging_progress.connect(self._on_tagging_progress)
+        self.tagging_chunk.connect(self._on_tagging_chunk)
+        self.tagging_stream_finished.connect(self._on_tagging_stream_finished)
 
         self.resize(1024, 720)
 
@@ -103,6 +125,9 @@ class MainWindow(QMainWindow):
         self._act_rm_dup.setText(tr("menu_remove_dup"))
         self._act_sort.setText(tr("menu_sort_tags"))
         self._act_waifu.setText(tr("menu_waifu_tagger"))
+        self._act_waifu_pause.setText(tr("menu_waifu_resume") if self._tag_job and self._tag_job.paused
+                                      else tr("menu_waifu_pause"))
+        self._act_waifu_cancel.setText(tr("menu_waifu_cancel"))
         self._act_calc_dataset.setText(tr("menu_calc_dataset"))
         self._help_menu.setTitle(tr("menu_help"))
         self._act_about.setText(tr("menu_about"))
@@ -229,6 +254,14 @@ class MainWindow(QMainWindow):
         self._act_waifu = QAction("", self)
         self._act_waifu.triggered.connect(self.open_waifu_tagger)
 
+        self._act_waifu_pause = QAction("", self)
+        self._act_waifu_pause.triggered.connect(self.toggle_pause_tagging)
+        self._act_waifu_pause.setEnabled(False)
+
+        self._act_waifu_cancel = QAction("", self)
+        self._act_waifu_cancel.triggered.connect(self.cancel_tagging)
+        self._act_waifu_cancel.setEnabled(False)
+
         self._act_calc_dataset = QAction("", self)
         self._act_calc_dataset.triggered.connect(self.open_calc_dataset)
         self._act_calc_dataset.setShortcuts(["Ctrl+Shift+D", "F9"])
@@ -240,6 +273,8 @@ class MainWindow(QMainWindow):
         self.tool_menu.addAction(self._act_sort)
         self.tool_menu.addSeparator()
         self.tool_menu.addAction(self._act_waifu)
+        self.tool_menu.addAction(self._act_waifu_pause)
+        self.tool_menu.addAction(self._act_waifu_cancel)
         self.tool_menu.addAction(self._act_calc_dataset)
 
         # Dict Manager menu
@@ -489,7 +524,7 @@ class MainWindow(QMainWindow):
             try:
                 for sub in sorted(os.listdir(path)):
                     sub_path = os.path.join(path, sub)
-                    if os.path.isdir(sub_path):
+                    if sub != CACHE_DIRNAME and os.path.isdir(sub_path):
                         add_node(sub_path, item)
             except PermissionError:
                 pass
@@ -512,7 +547,7 @@ class MainWindow(QMainWindow):
             self.images = self._folder_cache[folder]
         else:
             try:
-                self.images = load_folder_images(folder)
+                self.images = load_folder_images(folder, vocab=self._tag_vocab)
             except PermissionError:
                 QMessageBox.critical(self, tr("dlg_no_permission"), tr("dlg_no_permission_msg", folder=folder))
                 return
@@ -529,22 +564,17 @@ class MainWindow(QMainWindow):
             self._folder_cache[self.current_folder] = self.images
 
     def _load_all_folder_tags(self):
-        counts = {}
-        for img in self.images:
-            for tag in img['tags']:
-                counts[tag] = counts.get(tag, 0) + 1
+        counts = self.images.tag_counts()
+        self.images.take_count_changes()        # đã đếm đủ, bỏ delta cũ
         self.folder_tag_counts = counts
         self.all_folder_tags = sorted(counts.keys())
         self.tag_panel.load_tags(self.all_folder_tags, self.folder_tag_counts)
         self.image_grid.set_data(self.images, {})
 
     def _has_unsaved(self) -> bool:
-        # Check folder đang xem
-        if any(img.get('modified') for img in self.images):
-            return True
-        # Check các folder đang cached
-        for cached_images in self._folder_cache.values():
-            if any(img.get('modified') for img in cached_images):
+        # Check folder đang xem + các folder đang cached
+        for images in [self.images, *self._folder_cache.values()]:
+            if images and images.any_modified():
                 return True
         return False
 
@@ -568,7 +598,8 @@ class MainWindow(QMainWindow):
 
         # Clear cache và reset state TRƯỚC
         self._folder_cache.clear()
-        self.images = []          # ← reset images để _save_current_folder_state không cache rác
+        self._tag_vocab = TagVocab()
+        self.images = ImageStore('', [])  # ← reset images để _save_current_folder_state không cache rác
         self.current_folder = None  # ← reset để _load_folder không lưu state cũ
 
         self.root_folder = folder
@@ -635,9 +666,8 @@ class MainWindow(QMainWindow):
             self.act_redo.setText(tr("ldl_redo"))
 
     def _refresh_after_tag_change(self):
-        self._load_all_folder_tags()
-        for idx in range(len(self.images)):
-            self.image_grid.refresh_card(idx)
+        self._reload_tags_panel()
+        self.image_grid.refresh_cards(range(len(self.images)))
 
     # ──────────────────────────────────────────────
     #  History window
@@ -804,16 +834,15 @@ class MainWindow(QMainWindow):
         before = self._snapshot()
         count = 0
         
-        for idx, img in enumerate(self.images):
-            modified = False
+        # Chỉ duyệt các ảnh có tag cần xoá (posting index)
+        for idx in self.images.images_with_any(selected):
+            img = self.images[idx]
             for tag in selected:
                 if tag in img['tags']:
                     img['tags'].remove(tag)
-                    modified = True
-            if modified:
-                img['modified'] = True
-                self.image_grid.refresh_card(idx)
-                count += 1
+            img['modified'] = True
+            self.image_grid.refresh_card(idx)
+            count += 1
 
         self._push_history(tr("history_delete_tags", tags=selected, count=count), before)
         self._reload_tags_panel()
@@ -825,20 +854,39 @@ class MainWindow(QMainWindow):
 
     def _reload_tags_panel(self):
         current_filters = self.tag_panel._tag_filters.copy()
-        counts = {}
-        for img in self.images:
-            for tag in img['tags']:
-                counts[tag] = counts.get(tag, 0) + 1
-
-        self.folder_tag_counts = counts
-        self.all_folder_tags = sorted(counts.keys())
-        self.tag_panel.load_tags(self.all_folder_tags, self.folder_tag_counts)
-
-        for tag, is_active in current_filters.items():
-            if tag in self.tag_panel._check_boxes:
-                self.tag_panel._check_boxes[tag].setChecked(is_active)
+        changes = self.images.take_count_changes()
+        if changes is not None:
+            self._apply_tag_count_changes(changes, current_filters)
+            return
 
-        self.image_grid.set_tag_filters(current_filters)
+        # Sau undo / redo store không còn delta: đếm lại (từ inverted index) rồi so
+        # với counts cũ, panel vẫn chỉ cập nhật các dòng đổi.
+        old, counts = self.folder_tag_counts, self.images.tag_counts()
+        changes = {tag: n - old.get(tag, 0) for tag, n in counts.items() if n != old.get(tag, 0)}
+        changes.update((tag, -n) for tag, n in old.items() if tag not in counts)
+        # Số đếm không đổi vẫn có thể đã chuyển sang ảnh khác → lọc lại grid nếu đang có filter
+        self._apply_tag_count_changes(changes, current_filters, refilter=any(current_filters.values()))
+
+    def _apply_tag_count_changes(self, changes: dict, current_filters: dict, refilter: bool = False):
+        """Cập nhật counts theo delta, chỉ đụng tới các tag đã thay đổi."""
+        counts = self.folder_tag_counts
+        tags = self.all_folder_tags               # luôn sắp xếp → chèn / xoá bằng bisect
+        for tag, delta in changes.items():
+            had = tag in counts
+            n = counts.get(tag, 0) + delta
+            if n > 0:
+                counts[tag] = n
+                if not had:
+                    insort(tags, tag)
+            elif had:
+                del counts[tag]
+                del tags[bisect_left(tags, tag)]
+        if changes:
+            self.tag_panel.update_counts(tags, counts, set(changes))
+
+        # Grid chỉ cần lọc lại khi một filter đang bật có ảnh thay đổi
+        if refilter or any(current_filters.get(tag) for tag in changes):
+            self.image_grid.set_tag_filters(self.tag_panel._tag_filters.copy())
 
     # ──────────────────────────────────────────────
     #  Tool operations
@@ -873,48 +921,152 @@ class MainWindow(QMainWindow):
         dlg.exec()
 
     def _on_tagging_started(self, config: dict):
+        if self._tag_job is not None:
+            QMessageBox.information(self, tr("ldl_no_images"), tr("waifu_already_running"))
+            return
         self.statusBar().showMessage(tr("waifu_running", mode=config['mode']))
 
         from threading import Thread
-        from tagger_logic import run_tagger, run_tagger_api
+        from tagger_logic import TaggingJob
+
+        progress = self.tagging_progress.emit
+
+        # Local và API đều stream kết quả theo chunk và áp dụng dần vào UI,
+        # worker không giữ toàn bộ list kết quả.
+        self._save_current_folder_state()
+        self._tag_targets = {}
+        for imgs in [self.images, *self._folder_cache.values()]:
+            for img in imgs:
+                self._tag_targets[img['path']] = img
+        self._tag_pending = []
+        self._tag_images = self.images
+        self._tag_entry, self._tag_entry_count = None, 0
+        self._tag_rows_images = None
+        self._tag_updated = 0
+
+        # Job có thể pause / cancel từ menu; chạy lại cùng job sẽ resume từ checkpoint
+        job = TaggingJob(config, progress)
+        self._tag_job = job
+        self._set_tagging_actions(True)
 
         def thread_wrapper():
+            error = ""
             try:
-                target_func = run_tagger if config["mode"] == "local" else run_tagger_api
-                results = target_func(config, lambda c, t, m: self.statusBar().showMessage(f"[{c}/{t}] {m}"))
-
-                if config["mode"] == "api":
-                    self.statusBar().showMessage(tr("waifu_api_done"))
-                    self.tagging_completed.emit([])
-                elif results and isinstance(results, list):
-                    self.tagging_completed.emit(results)
+                for chunk in job:
+                    self.tagging_chunk.emit(chunk)
             except Exception as exc:
-                self.statusBar().showMessage(tr("waifu_error", error=exc))
+                error = str(exc)
+            self.tagging_stream_finished.emit(error)
 
         Thread(target=thread_wrapper, daemon=True).start()
 
-    def _on_tagging_finished(self, results: list):
-        if not results:
-            self._load_folder(self.current_folder)
-            self.statusBar().showMessage(tr("waifu_reload_done"))
-            QMessageBox.information(self, tr("remove_dup_done"), tr("waifu_reload_msg"))
+    def toggle_pause_tagging(self):
+        job = self._tag_job
+        if job is None:
             return
+        if job.paused:
+            job.resume()
+            self.statusBar().showMessage(tr("waifu_running", mode=job.config["mode"]))
+        else:
+            job.pause()
+            self.statusBar().showMessage(tr("waifu_paused"))
+        self.retranslate_ui()
 
-        before = self._snapshot()
-        path_to_idx = {img['path']: i for i, img in enumerate(self.images)}
-        updated_count = 0
-
-        for item in results:
-            img_path = item.get("path")
-            new_tags = item.get("tags")
-            if img_path in path_to_idx:
-                idx = path_to_idx[img_path]
-                self.images[idx]['tags'] = new_tags
-                self.images[idx]['modified'] = True
-                updated_count += 1
+    def cancel_tagging(self):
+        if self._tag_job is None:
+            return
+        self._tag_job.cancel()
+        self._act_waifu_pause.setEnabled(False)
+        self._act_waifu_cancel.setEnabled(False)
+        self.statusBar().showMessage(tr("waifu_cancelling"))
+
+    def _set_tagging_actions(self, running: bool):
+        self._act_waifu_pause.setEnabled(running)
+        self._act_waifu_cancel.setEnabled(running)
+        self.retranslate_ui()
+
+    def _on_tagging_progress(self, current: int, total: int, message: str):
+        if self._tag_job is not None and self._tag_job.paused:
+            return                          # giữ thông báo "paused"
+        if total:
+            self.statusBar().showMessage(f"[{current}/{total}] {message}")
+        else:
+            self.statusBar().showMessage(message)
+
+    def _on_tagging_chunk(self, results: list):
+        # Gom các chunk đến liên tiếp, flush một lần mỗi 150 ms
+        self._tag_pending.extend(results)
+        if not self._tag_flush_timer.isActive():
+            self._tag_flush_timer.start()
+
+    def _flush_tagging_results(self):
+        """Áp dụng các kết quả đang chờ vào images và chỉ refresh card bị ảnh hưởng."""
+        pending, self._tag_pending = self._tag_pending, []
+        updates = {}
+        for item in pending:
+            if item.get("skipped"):          # up to date or failed → keep current tags
+                continue
+            img = self._tag_targets.get(item.get("path"))
+            if img is not None:
+                updates[item.get("path")] = (img, item.get("tags"))
+        if not updates:
+            return
 
-        self._push_history(tr("history_waifu_tag", count=updated_count), before)
-        self._refresh_after_tag_change()
+        # History theo từng lần flush: tag sửa tay trong lúc chạy có mục riêng, đúng thứ tự,
+        # undo mục waifu chỉ trả lại các ảnh tagger đã ghi trong mục đó
+        record = self.images is self._tag_images
+        before = self._snapshot() if record else None
+        for img, tags in updates.values():
+            img['tags'] = tags
+            img['modified'] = True
+        self._tag_updated += len(updates)
+
+        rows = self._tagging_rows()
+        for path in updates:
+            idx = rows.get(path)
+            if idx is not None:
+                self.image_grid.refresh_card(idx)
+        if record:
+            self._record_tagging_history(before, sum(path in rows for path in updates))
+
+    def _tagging_rows(self) -> dict:
+        """path → idx của folder đang hiển thị; dựng một lần cho mỗi folder trong lúc chạy."""
+        if self._tag_rows_images is not self.images:
+            self._tag_rows_images = self.images
+            self._tag_rows = {img['path']: idx for idx, img in enumerate(self.images)}
+        return self._tag_rows
+
+    def _record_tagging_history(self, before, count: int):
+        """Các lần flush liên tiếp gộp vào một mục; có thao tác khác chen vào thì mở mục mới."""
+        entry = self._tag_entry
+        if entry is not None and self.history.amend(
+                entry, tr("history_waifu_tag", count=self._tag_entry_count + count), self.images):
+            self._tag_entry_count += count
+            return
+        self._tag_entry_count = count
+        self._tag_entry = self.history.push(tr("history_waifu_tag", count=count), before, self.images)
+
+    def _on_tagging_stream_finished(self, error: str):
+        self._tag_flush_timer.stop()
+        self._flush_tagging_results()
+        updated_count = self._tag_updated
+
+        cancelled = self._tag_job is not None and self._tag_job.cancelled
+        self._tag_job = None
+        self._tag_targets = {}
+        self._tag_images = None
+        self._tag_entry, self._tag_entry_count = None, 0
+        self._tag_rows, self._tag_rows_images = {}, None
+        self._set_tagging_actions(False)
+
+        if updated_count:
+            self._reload_tags_panel()        # card đã được refresh trong lúc stream
+        if error:
+            self.statusBar().showMessage(tr("waifu_error", error=error))
+            return
+        if cancelled:
+            self.statusBar().showMessage(tr("waifu_cancelled_status", count=updated_count))
+            return
         self.statusBar().showMessage(tr("waifu_done_status", count=updated_count))
         QMessageBox.information(self, tr("remove_dup_done"),
                                 tr("waifu_done_msg", count=updated_count))
@@ -1051,4 +1203,8 @@ class MainWindow(QMainWindow):
             else:
                 event.ignore()
         else:
-            event.accept()
\ No newline at end of file
+            event.accept()
+        if event.isAccepted():
+            self.image_grid.shutdown()
+        if event.isAccepted() and self._tag_job is not None:
+            self._tag_job.cancel()      # checkpoint giữ lại, lần sau resume được
\ No newline at end of file
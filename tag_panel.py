@@ -1,16 +1,345 @@
 """
 tag_panel.py - Panel bên phải hiển thị danh sách tags của thư mục
+
+Danh sách tag dùng model/view: TagListModel (tag, số lượng, trạng thái filter)
+→ TagFilterProxy (lọc JEI + nhóm dict) → QListView với TagItemDelegate vẽ
+checkbox, "tag (count)" và nút Insert. Gõ tìm kiếm chỉ lọc lại proxy, không
+dựng widget nào; đổi số lượng chỉ phát dataChanged cho đúng các dòng đó.
+
+Tìm kiếm đi qua TagSearchIndex (tag_search.py) và được gom lại SEARCH_DELAY_MS
+sau phím cuối, nên gõ nhanh trên vài chục nghìn tag không bị giật.
 """
+from bisect import bisect_left
+
 from PySide6.QtWidgets import (
     QWidget, QVBoxLayout, QHBoxLayout, QLabel,
-    QLineEdit, QPushButton, QScrollArea, QFrame,
-    QCheckBox, QSizePolicy, QComboBox,
+    QLineEdit, QPushButton, QFrame, QListView,
+    QSizePolicy, QComboBox, QStyledItemDelegate, QStyle,
+    QStyleOptionViewItem, QApplication,
 )
-from PySide6.QtCore import Qt, Signal
-from PySide6.QtGui import QIcon
+from PySide6.QtCore import (
+    Qt, Signal, QAbstractListModel, QAbstractProxyModel, QModelIndex,
+    QEvent, QRect, QSize, QTimer,
+)
+from PySide6.QtGui import QIcon, QColor, QFont
 from i18n import tr
+from tag_search import TagSearchIndex, parse_query
+
+
+class TagListModel(QAbstractListModel):
+    """Danh sách tag của folder: hiển thị "tag (count)", ô check = filter đang bật."""
+    TagRole = Qt.UserRole + 1
+    CountRole = Qt.UserRole + 2
+
+    filter_toggled = Signal(str, bool)
+
+    BULK_RESET = 64     # số dòng thêm/xoá tối đa còn chèn từng dòng
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._tags: list = []
+        self._counts: dict = {}
+        self._rows: dict = {}       # tag -> số thứ tự dòng
+        self.filters: dict = {}     # tag -> bool
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else len(self._tags)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        tag = self._tags[index.row()]
+        if role == Qt.DisplayRole:
+            return f"{tag} ({self._counts.get(tag, 0)})"
+        if role == Qt.CheckStateRole:
+            return Qt.Checked if self.filters.get(tag, False) else Qt.Unchecked
+        if role == self.TagRole:
+            return tag
+        if role == self.CountRole:
+            return self._counts.get(tag, 0)
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole) -> bool:
+        if role != Qt.CheckStateRole or not index.isValid():
+            return False
+        checked = Qt.CheckState(value) == Qt.Checked if isinstance(value, int) else value == Qt.Checked
+        tag = self._tags[index.row()]
+        self.filters[tag] = checked
+        self.dataChanged.emit(index, index, [Qt.CheckStateRole])
+        self.filter_toggled.emit(tag, checked)
+        return True
+
+    def flags(self, index):
+        return Qt.ItemIsEnabled | Qt.ItemIsUserCheckable if index.isValid() else Qt.NoItemFlags
+
+    # ── Cập nhật ──────────────────────────────────────────────────────
+
+    def tags(self) -> list:
+        return self._tags
+
+    def counts(self) -> dict:
+        return self._counts
+
+    def row_of(self, tag: str):
+        return self._rows.get(tag)
+
+    def _reindex(self, start: int):
+        rows, tags = self._rows, self._tags
+        for i in range(start, len(tags)):
+            rows[tags[i]] = i
+
+    def reset(self, tags: list, counts: dict):
+        self.beginResetModel()
+        self._tags = list(tags)
+        self._counts = counts
+        self._rows = {t: i for i, t in enumerate(self._tags)}
+        self.endResetModel()
+
+    def update_counts(self, tags: list, counts: dict, changed):
+        """
+        Sửa số lượng cho *changed*; tag mới/hết được chèn/xoá đúng dòng thay vì
+        reset cả model. *tags* đã sắp xếp (cùng thứ tự các dòng) nên vị trí chèn
+        tìm bằng bisect – không phải duyệt cả danh sách cho mỗi lần sửa.
+        """
+        self._counts = counts
+        gone = [t for t in changed if t in self._rows and t not in counts]
+        added = sorted(t for t in changed if t in counts and t not in self._rows)
+        if len(gone) + len(added) > self.BULK_RESET:
+            # Đổi hàng loạt (vd. undo cả thư mục): reset một lần rẻ hơn chèn từng dòng
+            filters = {t: v for t, v in self.filters.items() if t in counts}
+            self.reset(tags, counts)
+            self.filters.clear()
+            self.filters.update(filters)
+            return
+
+        for row in sorted((self._rows[t] for t in gone), reverse=True):
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self._rows[self._tags.pop(row)]
+            self._reindex(row)
+            self.endRemoveRows()
+        for t in gone:
+            self.filters.pop(t, None)
+
+        for t in added:
+            row = bisect_left(self._tags, t)
+            self.beginInsertRows(QModelIndex(), row, row)
+            self._tags.insert(row, t)
+            self._reindex(row)
+            self.endInsertRows()
+
+        for t in changed:
+            row = self._rows.get(t)
+            if row is not None:
+                idx = self.index(row)
+                self.dataChanged.emit(idx, idx, [Qt.DisplayRole, self.CountRole])
+
+    def set_filters(self, filters: dict):
+        self.filters.clear()
+        self.filters.update({t: v for t, v in filters.items() if t in self._rows})
+        if self._tags:
+            self.dataChanged.emit(self.index(0), self.index(len(self._tags) - 1), [Qt.CheckStateRole])
+
+
+class TagFilterProxy(QAbstractProxyModel):
+    """
+    Lọc theo ô tìm kiếm (JEI) và nhóm dict.
+
+    Không lọc gì → đi thẳng qua source (chèn/xoá dòng chuyển tiếp nguyên vẹn).
+    Có điều kiện → _rows (dòng proxy → dòng source) tính một lần từ
+    TagSearchIndex, đã xếp hạng; không gọi filterAcceptsRow cho từng dòng.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self._tokens: list = []
+        self._whitelist = None
+        self._index = None          # TagSearchIndex, dựng lúc tìm lần đầu
+        self._rows = None           # dòng proxy -> dòng source; None = không lọc
+        self._pos: dict = {}        # dòng source -> dòng proxy
+        self._count = 0             # QListView gọi index() cho từng dòng khi layout → giữ sẵn
+
+    def setSourceModel(self, model):
+        super().setSourceModel(model)
+        model.modelAboutToBeReset.connect(self.beginResetModel)
+        model.modelReset.connect(self._on_source_reset)
+        model.dataChanged.connect(self._on_source_data_changed)
+        model.rowsAboutToBeInserted.connect(self._on_rows_about_to_be_inserted)
+        model.rowsInserted.connect(self._on_rows_inserted)
+        model.rowsAboutToBeRemoved.connect(self._on_rows_about_to_be_removed)
+        model.rowsRemoved.connect(self._on_rows_removed)
+
+    # ── Điều kiện lọc ─────────────────────────────────────────────────
+
+    def set_search(self, text: str):
+        tokens = parse_query(text)
+        if tokens != self._tokens:
+            self.beginResetModel()
+            self._tokens = tokens
+            self._refilter()
+            self.endResetModel()
+
+    def set_whitelist(self, whitelist):
+        self.beginResetModel()
+        self._whitelist = whitelist
+        self._refilter()
+        self.endResetModel()
+
+    def _refilter(self):
+        model = self.sourceModel()
+        if not self._tokens and self._whitelist is None:
+            self._rows, self._pos = None, {}
+            self._count = len(model.tags())
+            return
+        if self._tokens:
+            if self._index is None:
+                self._index = TagSearchIndex(model.tags())
+            tags = self._index.ranked(self._tokens, model.counts())
+        else:
+            tags = model.tags()
+        if self._whitelist is not None:
+            tags = [t for t in tags if t in self._whitelist]
+        row_of = model.row_of
+        self._rows = [row_of(t) for t in tags]
+        self._pos = {r: i for i, r in enumerate(self._rows)}
+        self._count = len(self._rows)
+
+    # ── QAbstractProxyModel ───────────────────────────────────────────
+
+    def index(self, row, column=0, parent=QModelIndex()):
+        if 0 <= row < self._count and column == 0 and not parent.isValid():
+            return self.createIndex(row, 0)
+        return QModelIndex()
+
+    def parent(self, index=QModelIndex()):
+        return QModelIndex()
+
+    def rowCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else self._count
+
+    def columnCount(self, parent=QModelIndex()) -> int:
+        return 0 if parent.isValid() else 1
+
+    def mapToSource(self, proxy_index):
+        if not proxy_index.isValid():
+            return QModelIndex()
+        row = proxy_index.row()
+        return self.sourceModel().index(row if self._rows is None else self._rows[row], 0)
+
+    def mapFromSource(self, source_index):
+        if not source_index.isValid():
+            return QModelIndex()
+        row = source_index.row() if self._rows is None else self._pos.get(source_index.row())
+        return QModelIndex() if row is None else self.createIndex(row, 0)
+
+    # ── Tín hiệu từ source ────────────────────────────────────────────
+
+    def _on_source_reset(self):
+        self._index = None
+        self._refilter()
+        self.endResetModel()
+
+    def _on_source_data_changed(self, top_left, bottom_right, roles=()):
+        first, last = top_left.row(), bottom_right.row()
+        if self._rows is None:
+            self.dataChanged.emit(self.createIndex(first, 0), self.createIndex(last, 0), roles)
+        elif last - first > 64:
+            if self._rows:
+                self.dataChanged.emit(self.createIndex(0, 0), self.createIndex(len(self._rows) - 1, 0), roles)
+        else:
+            for r in range(first, last + 1):
+                row = self._pos.get(r)
+                if row is not None:
+                    idx = self.createIndex(row, 0)
+                    self.dataChanged.emit(idx, idx, roles)
+
+    def _on_rows_about_to_be_inserted(self, parent, first, last):
+        if self._rows is None:
+            self.beginInsertRows(QModelIndex(), first, last)
+        else:
+            self.beginResetModel()
+
+    def _on_rows_inserted(self, parent, first, last):
+        if self._index is not None:
+            tags = self.sourceModel().tags()
+            for r in range(first, last + 1):
+                self._index.add(tags[r])
+        if self._rows is None:
+            self._count += last - first + 1
+            self.endInsertRows()
+        else:
+            self._refilter()
+            self.endResetModel()
+
+    def _on_rows_about_to_be_removed(self, parent, first, last):
+        if self._index is not None:
+            tags = self.sourceModel().tags()
+            for r in range(first, last + 1):
+                self._index.remove(tags[r])
+        if self._rows is None:
+            self.beginRemoveRows(QModelIndex(), first, last)
+        else:
+            self.beginResetModel()
+
+    def _on_rows_removed(self, parent, first, last):
+        if self._rows is None:
+            self._count -= last - first + 1
+            self.endRemoveRows()
+        else:
+            self._refilter()
+            self.endResetModel()
+
+
+class TagItemDelegate(QStyledItemDelegate):
+    """Vẽ dòng tag: checkbox + "tag (count)" (mặc định của Qt) và nút Insert bên phải."""
+    insert_requested = Signal(str)
+
+    BUTTON_WIDTH = 55
+    ROW_HEIGHT = 24
+
+    def _button_rect(self, rect: QRect) -> QRect:
+        return QRect(rect.right() - self.BUTTON_WIDTH - 3, rect.top() + 2,
+                     self.BUTTON_WIDTH, rect.height() - 4)
+
+    def paint(self, painter, option, index):
+        opt = QStyleOptionViewItem(option)
+        opt.rect = option.rect.adjusted(0, 0, -(self.BUTTON_WIDTH + 8), 0)
+        super().paint(painter, opt, index)
+
+        btn = self._button_rect(option.rect)
+        painter.save()
+        painter.setRenderHint(painter.RenderHint.Antialiasing)
+        painter.setPen(Qt.NoPen)
+        painter.setBrush(QColor("#2196F3"))
+        painter.drawRoundedRect(btn, 3, 3)
+        font = QFont(option.font)
+        font.setPixelSize(9)
+        painter.setFont(font)
+        painter.setPen(QColor("white"))
+        painter.drawText(btn, Qt.AlignCenter, tr("insert_btn_short"))
+        painter.restore()
+
+    def sizeHint(self, option, index) -> QSize:
+        hint = super().sizeHint(option, index)
+        return QSize(hint.width() + self.BUTTON_WIDTH + 8, max(hint.height(), self.ROW_HEIGHT))
+
+    def editorEvent(self, event, model, option, index) -> bool:
+        # Click ngoài ô check (vào chữ hoặc nút Insert) → chèn tag, giống label/nút cũ
+        if event.type() in (QEvent.MouseButtonPress, QEvent.MouseButtonRelease, QEvent.MouseButtonDblClick) \
+                and event.button() == Qt.LeftButton:
+            opt = QStyleOptionViewItem(option)
+            self.initStyleOption(opt, index)
+            style = opt.widget.style() if opt.widget else QApplication.style()
+            check = style.subElementRect(QStyle.SE_ItemViewItemCheckIndicator, opt, opt.widget)
+            if not check.contains(event.position().toPoint()):
+                if event.type() == QEvent.MouseButtonRelease:
+                    self.insert_requested.emit(index.data(TagListModel.TagRole))
+                return True
+        return super().editorEvent(event, model, option, index)
+
 
 class TagPanel(QWidget):
+    SEARCH_DELAY_MS = 150
+
     filter_changed         = Signal(dict)
     tag_insert_requested   = Signal(str)
     delete_tags_requested  = Signal()
@@ -18,10 +347,6 @@ class TagPanel(QWidget):
 
     def __init__(self, parent=None):
         super().__init__(parent)
-        self._all_tags:    list = []
-        self._tag_counts:  dict = {}
-        self._tag_filters: dict = {}
-        self._check_boxes: dict = {}
         self._dict_groups: dict = {}   # {group_name: [tag, …]}
         self._dict_loaded: bool = False
         self.setup_ui()
@@ -38,7 +363,11 @@ class TagPanel(QWidget):
         self.search_edit = QLineEdit()
         self.search_edit.addAction(QIcon.fromTheme("edit-find"), QLineEdit.ActionPosition.LeadingPosition)
         self.search_edit.setClearButtonEnabled(True)
-        self.search_edit.textChanged.connect(self._filter_display)
+        self.search_edit.textChanged.connect(self._on_search_text_changed)
+        self._search_timer = QTimer(self)
+        self._search_timer.setSingleShot(True)
+        self._search_timer.setInterval(self.SEARCH_DELAY_MS)
+        self._search_timer.timeout.connect(lambda: self._filter_display(self.search_edit.text()))
         search_row.addWidget(self.search_edit)
         layout.addLayout(search_row)
 
@@ -68,24 +397,35 @@ class TagPanel(QWidget):
         self._group_filter_lbl.setFixedWidth(40)
         self._group_combo = QComboBox()
         self._group_combo.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Fixed)
-        self._group_combo.currentIndexChanged.connect(lambda _: self._rebuild_tag_list(self.search_edit.text()))
+        self._group_combo.currentIndexChanged.connect(lambda _: self._apply_group_filter())
         gfr.addWidget(self._group_filter_lbl)
         gfr.addWidget(self._group_combo)
         layout.addWidget(self._group_filter_row)
         self._group_filter_row.setVisible(False)
 
-        # Scroll area
-        self.scroll_area = QScrollArea()
-        self.scroll_area.setWidgetResizable(True)
-        self.scroll_area.setFrameShape(QFrame.NoFrame)
-        self.scroll_area.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-        self.tags_container = QWidget()
-        self.tags_layout = QVBoxLayout(self.tags_container)
-        self.tags_layout.setContentsMargins(2, 2, 2, 2)
-        self.tags_layout.setSpacing(1)
-        self.tags_layout.addStretch()
-        self.scroll_area.setWidget(self.tags_container)
-        layout.addWidget(self.scroll_area, stretch=1)
+        # Tag list (model/view)
+        self.model = TagListModel(self)
+        self.model.filter_toggled.connect(self._on_filter_toggle)
+        self.proxy = TagFilterProxy(self)
+        self.proxy.setSourceModel(self.model)
+        self.delegate = TagItemDelegate(self)
+        self.delegate.insert_requested.connect(self.tag_insert_requested)
+        self.list_view = QListView()
+        self.list_view.setModel(self.proxy)
+        self.list_view.setItemDelegate(self.delegate)
+        self.list_view.setUniformItemSizes(True)       # 8k dòng: không phải đo từng dòng
+        self.list_view.setLayoutMode(QListView.Batched)  # vài chục nghìn dòng: layout chia nhiều lượt, không chặn gõ
+        self.list_view.setBatchSize(2000)
+        self.list_view.setSelectionMode(QListView.NoSelection)
+        self.list_view.setFrameShape(QFrame.NoFrame)
+        self.list_view.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
+        self.list_view.setVerticalScrollMode(QListView.ScrollPerPixel)
+        self.list_view.setCursor(Qt.PointingHandCursor)
+        layout.addWidget(self.list_view, stretch=1)
+
+    @property
+    def _tag_filters(self) -> dict:
+        return self.model.filters
 
     # ─── i18n ────────────────────────────────────────────────────────────────
     def retranslate_ui(self):
@@ -97,8 +437,7 @@ class TagPanel(QWidget):
         self._deselect_btn.setText(tr("deselect_filters_btn"))
         self._delete_btn.setText(tr("delete_tags_btn"))
         self._replace_btn.setText(tr("replace_tags_btn"))
-        if self._all_tags:
-            self._rebuild_tag_list(self.search_edit.text())
+        self.list_view.viewport().update()     # chữ nút Insert vẽ theo ngôn ngữ hiện tại
 
     # ─── Dict integration ───────────────────────────────────────────────────
     def set_dict_groups(self, groups: dict):
@@ -117,39 +456,30 @@ class TagPanel(QWidget):
                 self._group_combo.addItem(gname)
         self._group_combo.blockSignals(False)
         self._group_filter_row.setVisible(self._dict_loaded)
-        self._rebuild_tag_list(self.search_edit.text())
-
-    # ─── Tag row ─────────────────────────────────────────────────────────────
-    def _make_tag_row(self, tag: str) -> QWidget:
-        row = QWidget()
-        row_layout = QHBoxLayout(row)
-        row_layout.setContentsMargins(4, 1, 4, 1)
-        row_layout.setSpacing(4)
-        cb = QCheckBox()
-        cb.setChecked(self._tag_filters.get(tag, False))
-        cb.stateChanged.connect(lambda state, t=tag: self._on_filter_toggle(t, state))
-        self._check_boxes[tag] = cb
-        count = self._tag_counts.get(tag, 0)
-        lbl = QLabel(f"{tag} ({count})")
-        lbl.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Preferred)
-        lbl.setCursor(Qt.PointingHandCursor)
-        lbl.mousePressEvent = lambda e, t=tag: self.tag_insert_requested.emit(t)
-        insert_btn = QPushButton(tr("insert_btn_short"))
-        insert_btn.setFixedWidth(55)
-        insert_btn.setStyleSheet("background:#2196F3; color:white; font-size:9px; padding:2px;")
-        insert_btn.clicked.connect(lambda _, t=tag: self.tag_insert_requested.emit(t))
-        row_layout.addWidget(cb)
-        row_layout.addWidget(lbl)
-        row_layout.addWidget(insert_btn)
-        return row
-
-    # ─── Load / rebuild ──────────────────────────────────────────────────────
+        self._apply_group_filter()
+
+    # ─── Load / update ───────────────────────────────────────────────────────
     def load_tags(self, all_tags: list, tag_counts: dict):
-        self._all_tags    = all_tags
-        self._tag_counts  = tag_counts
-        self._tag_filters = {}
-        self._check_boxes = {}
-        self._rebuild_tag_list(self.search_edit.text())
+        self.model.filters.clear()
+        self.model.reset(all_tags, tag_counts)
+
+    def update_counts(self, all_tags: list, tag_counts: dict, changed: set):
+        """
+        Cập nhật theo delta: chỉ các dòng của tag trong *changed* được vẽ lại;
+        tag mới / tag hết được chèn / xoá đúng dòng, giữ nguyên filters.
+        """
+        self.model.update_counts(all_tags, tag_counts, changed)
+
+    def set_filters(self, filters: dict):
+        """Khôi phục trạng thái filter (bỏ các tag không còn) mà không phát filter_changed."""
+        self.model.set_filters(filters)
+
+    def set_filter(self, tag: str, checked: bool) -> bool:
+        """Bật/tắt filter một tag như khi người dùng click ô check. False nếu tag không có trong danh sách."""
+        row = self.model.row_of(tag)
+        if row is None:
+            return False
+        return self.model.setData(self.model.index(row), Qt.Checked if checked else Qt.Unchecked, Qt.CheckStateRole)
 
     def _get_group_whitelist(self):
         """Trả về set tags thuộc nhóm đang chọn, hoặc None nếu All."""
@@ -158,49 +488,26 @@ class TagPanel(QWidget):
         gname = self._group_combo.currentText()
         return set(self._dict_groups.get(gname, []))
 
-    @staticmethod
-    def _matches_jei(tag: str, tokens: list) -> bool:
-        """JEI: khớp nếu tag chứa ÍT NHẤT MỘT token (OR logic)."""
-        if not tokens:
-            return True
-        tl = tag.lower()
-        return any(tok in tl for tok in tokens)
-
-    def _rebuild_tag_list(self, filter_text: str = ""):
-        # Clear
-        while self.tags_layout.count() > 1:
-            item = self.tags_layout.takeAt(0)
-            if item.widget():
-                item.widget().deleteLater()
-        self._check_boxes.clear()
-
-        # JEI tokens
-        tokens = [t.strip().lower() for t in filter_text.split(",") if t.strip()]
-        whitelist = self._get_group_whitelist()
-
-        for tag in self._all_tags:
-            if whitelist is not None and tag not in whitelist:
-                continue
-            if not self._matches_jei(tag, tokens):
-                continue
-            row = self._make_tag_row(tag)
-            self.tags_layout.insertWidget(self.tags_layout.count() - 1, row)
+    def _apply_group_filter(self):
+        self.proxy.set_whitelist(self._get_group_whitelist())
 
     # ─── Signals ─────────────────────────────────────────────────────────────
+    def _on_search_text_changed(self, text: str):
+        if text.strip():
+            self._search_timer.start()      # gõ tiếp trong SEARCH_DELAY_MS → chỉ lọc một lần
+        else:
+            self._search_timer.stop()       # xoá ô tìm kiếm → hiện lại ngay
+            self._filter_display(text)
+
     def _filter_display(self, text: str):
-        self._rebuild_tag_list(text)
+        self.proxy.set_search(text)
 
-    def _on_filter_toggle(self, tag: str, state: int):
-        self._tag_filters[tag] = (state == Qt.Checked or state == 2)
+    def _on_filter_toggle(self, tag: str, checked: bool):
         self.filter_changed.emit(dict(self._tag_filters))
 
     def deselect_all_filters(self):
-        self._tag_filters.clear()
-        for cb in self._check_boxes.values():
-            cb.blockSignals(True)
-            cb.setChecked(False)
-            cb.blockSignals(False)
+        self.model.set_filters({})
         self.filter_changed.emit({})
 
     def get_selected_filter_tags(self) -> list:
-        return [t for t, v in self._tag_filters.items() if v]
\ No newline at end of file
+        return [t for t, v in self._tag_filters.items() if v]
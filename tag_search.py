@@ -0,0 +1,148 @@
+"""
+tag_search.py - Chỉ mục tìm kiếm JEI cho danh sách tag
+
+Truy vấn là các token cách nhau bằng dấu phẩy; một tag khớp nếu chứa ÍT NHẤT
+MỘT token (OR, không phân biệt hoa thường), như kiểu tìm của JEI.
+
+Chỉ mục là toàn bộ từ vựng đã lowercase nối thành một chuỗi (ngăn bằng '\n')
+kèm bảng vị trí bắt đầu của từng tag. Một token được tìm bằng str.find trên
+chuỗi đó (quét ở tốc độ C), vị trí khớp đổi ra id tag bằng bisect rồi nhảy
+thẳng sang tag kế tiếp – không có vòng lặp Python trên từng tag. Dựng chỉ mục
+chỉ là một lần join, nên 50k+ tag vẫn dựng trong vài chục ms.
+
+Gõ thêm ký tự (mỗi token mới chứa token cũ, cùng số token) thì kết quả mới là
+tập con của kết quả cũ → chỉ lọc lại trong kết quả trước.
+
+Kết quả xếp hạng: trùng khớp hoàn toàn → khớp đầu tag → khớp đầu một từ
+(sau '_', ' ', ':' …) → khớp giữa; cùng hạng thì tag nhiều ảnh hơn lên trước.
+"""
+from __future__ import annotations
+
+from bisect import bisect_right
+
+SEP = "\n"
+DENSE_RATIO = 4             # token xuất hiện > 1/4 số tag → quét tuyến tính
+WORD_SEPARATORS = "_ :-/()"
+
+
+def parse_query(text: str) -> list:
+    """Tách ô tìm kiếm thành các token lowercase (bỏ token rỗng)."""
+    return [t.strip().lower() for t in text.split(",") if t.strip()]
+
+
+class TagSearchIndex:
+    """Từ vựng tag lowercase nối liền + bảng vị trí; thêm/xoá tag không phải dựng lại."""
+
+    def __init__(self, tags=()):
+        self._tags: list = list(dict.fromkeys(tags))       # id -> tag gốc
+        self._lower: list = [t.lower() for t in self._tags]  # id -> lowercase (None = đã xoá)
+        self._ids: dict = {t: i for i, t in enumerate(self._tags)}
+        self._starts: list = []     # id -> vị trí bắt đầu trong _blob
+        pos = 0
+        for low in self._lower:
+            self._starts.append(pos)
+            pos += len(low) + 1
+        self._blob = SEP.join(self._lower) + SEP if self._lower else ""
+        self._dead = 0
+        self._last_tokens: list = []
+        self._last_ids = None       # id khớp của truy vấn trước (None = chưa có)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, tag) -> bool:
+        return tag in self._ids
+
+    # ── Cập nhật ──────────────────────────────────────────────────────
+
+    def add(self, tag: str) -> None:
+        if tag in self._ids:
+            return
+        low = tag.lower()
+        self._ids[tag] = len(self._tags)
+        self._tags.append(tag)
+        self._lower.append(low)
+        self._starts.append(len(self._blob))
+        self._blob += low + SEP
+        self._last_ids = None
+
+    def remove(self, tag: str) -> None:
+        tid = self._ids.pop(tag, None)
+        if tid is None:
+            return
+        # Chỉ đánh dấu; id chết bị bỏ qua khi tìm, quá nhiều thì dựng lại
+        self._lower[tid] = None
+        self._dead += 1
+        self._last_ids = None
+        if self._dead > 1024 and self._dead > len(self._ids):
+            self.__init__(self._ids)
+
+    # ── Truy vấn ──────────────────────────────────────────────────────
+
+    def _scan(self, tok: str) -> list:
+        """Id (tăng dần) các tag còn sống chứa *tok*."""
+        blob, starts, lower = self._blob, self._starts, self._lower
+        if blob.count(tok) * DENSE_RATIO > len(starts):
+            # Token ngắn khớp gần hết từ vựng: kiểm từng tag còn rẻ hơn nhảy bisect
+            return [i for i, low in enumerate(lower) if low is not None and tok in low]
+        find, last = blob.find, len(starts) - 1
+        out = []
+        pos = find(tok)
+        while pos >= 0:
+            tid = bisect_right(starts, pos) - 1
+            if lower[tid] is not None:
+                out.append(tid)
+            if tid == last:
+                break
+            pos = find(tok, starts[tid + 1])
+        return out
+
+    def _match_ids(self, tokens: list) -> list:
+        prev = self._last_tokens
+        if self._last_ids is not None and prev and len(prev) == len(tokens) \
+                and all(old in new for old, new in zip(prev, tokens)):
+            # Truy vấn chỉ dài thêm → kết quả nằm trong kết quả trước
+            lower = self._lower
+            return [i for i in self._last_ids if any(t in lower[i] for t in tokens)]
+        if len(tokens) == 1:
+            return self._scan(tokens[0])
+        found = set()
+        for tok in tokens:
+            found.update(self._scan(tok))
+        return sorted(found)
+
+    def search(self, tokens: list) -> list:
+        """Các tag khớp *tokens* (OR); thứ tự theo id. Rỗng → mọi tag."""
+        if not tokens:
+            self._last_tokens, self._last_ids = [], None
+            return list(self._ids)
+        ids = self._match_ids(tokens)
+        self._last_tokens, self._last_ids = list(tokens), ids
+        tags = self._tags
+        return [tags[i] for i in ids]
+
+    @staticmethod
+    def rank(tag: str, tokens: list) -> int:
+        """0 = trùng hẳn, 1 = khớp đầu tag, 2 = khớp đầu một từ, 3 = khớp giữa."""
+        low = tag.lower()
+        best = 3
+        for tok in tokens:
+            if low == tok:
+                return 0
+            if low.startswith(tok):
+                best = 1
+            elif best == 3 and any(sep + tok in low for sep in WORD_SEPARATORS):
+                best = 2
+        return best
+
+    def ranked(self, tokens: list, counts: dict) -> list:
+        """search() rồi xếp theo hạng, cùng hạng thì nhiều ảnh trước, rồi theo tên."""
+        tags = self.search(tokens)
+        if not tokens:
+            return tags
+        # Ba lần sort ổn định thay cho một key tuple (sort theo tên chạy hoàn toàn trong C)
+        tags.sort()
+        tags.sort(key=lambda t: counts.get(t, 0), reverse=True)
+        rank = self.rank
+        tags.sort(key=lambda t: rank(t, tokens))
+        return tags
@@ -0,0 +1,233 @@
+"""
+thumbnail_cache.py - Cache thumbnail trên đĩa, dùng chung giữa các phiên
+
+Một file SQLite duy nhất trong cache của người dùng (~/.cache/tktagger/thumbnails.sqlite):
+    thumbs(key TEXT PRIMARY KEY, data BLOB, bytes INT, atime INT)
+
+- key = sha1(đường dẫn tuyệt đối | mtime_ns | kích thước file | bề rộng thumbnail)
+  → sửa/ghi đè ảnh là tự ra key mới, entry cũ bị LRU dọn dần.
+- data = thumbnail nén WebP (PNG nếu Qt không có plugin WebP).
+- Tổng dung lượng giới hạn bởi max_bytes; vượt ngưỡng thì xoá các entry có
+  atime cũ nhất tới khi còn EVICT_TO × max_bytes.
+
+Được gọi từ worker của ThumbnailLoader: mỗi luồng một connection (WAL cho phép
+đọc song song). Lỗi SQLite không làm hỏng việc hiển thị – cache chỉ bị tắt.
+
+PixmapCache (PIXMAP_CACHE) là tầng trong RAM phía trên: QPixmap đã giải mã,
+dùng chung toàn tiến trình, giới hạn theo tổng số byte, loại bỏ theo LRU.
+Chỉ dùng trên GUI thread (QPixmap không an toàn giữa các luồng) nên không
+stat file: mỗi pixmap mang key mà worker đã tính ở luồng nền.
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from PySide6.QtCore import QBuffer, QIODevice
+from PySide6.QtGui import QImage, QImageWriter, QPixmap
+
+USER_CACHE_DIR = Path.home() / ".cache" / "tktagger"     # cùng gốc với cache ONNX của tagger
+DEFAULT_PATH = USER_CACHE_DIR / "thumbnails.sqlite"
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+EVICT_TO = 0.8           # dọn xuống 80% giới hạn để không phải dọn sau mỗi lần ghi
+ATIME_GRANULARITY = 60   # giây – đọc liên tục không phải ghi atime mỗi lần
+PIXMAP_CACHE_BYTES = 128 * 1024 * 1024   # ~800 thumbnail 200px ARGB
+
+IMAGE_FORMAT = "WEBP" if b"webp" in [bytes(f) for f in QImageWriter.supportedImageFormats()] else "PNG"
+
+
+class ThumbnailCache:
+    """Cache thumbnail dạng key → ảnh nén, giới hạn dung lượng theo LRU."""
+
+    def __init__(self, path: str | Path = DEFAULT_PATH, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._enabled = True
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = self._conn()
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS thumbs ("
+                " key TEXT PRIMARY KEY, data BLOB NOT NULL,"
+                " bytes INTEGER NOT NULL, atime INTEGER NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS thumbs_atime ON thumbs(atime)")
+            conn.commit()
+            self._total = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM thumbs").fetchone()[0]
+        except (OSError, sqlite3.Error) as e:
+            self._disable(e)
+
+    # ── Key ─────────────────────────────────────────────────────────────
+
+    @staticmethod
+    def make_key(path: str, mtime_ns: int, size: int, width: int) -> str:
+        raw = f"{os.path.abspath(path)}|{mtime_ns}|{size}|{width}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def key_for(cls, path: str, width: int) -> str | None:
+        """Key cho file hiện tại trên đĩa; None nếu không stat được."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return cls.make_key(path, st.st_mtime_ns, st.st_size, width)
+
+    # ── Đọc / ghi ───────────────────────────────────────────────────────
+
+    def get(self, key: str) -> QImage | None:
+        if not self._enabled:
+            return None
+        try:
+            conn = self._conn()
+            row = conn.execute("SELECT data, atime FROM thumbs WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            now = int(time.time())
+            if now - row[1] > ATIME_GRANULARITY:
+                conn.execute("UPDATE thumbs SET atime = ? WHERE key = ?", (now, key))
+                conn.commit()
+        except sqlite3.Error as e:
+            self._disable(e)
+            return None
+        image = QImage.fromData(row[0])
+        return None if image.isNull() else image
+
+    def put(self, key: str, image: QImage) -> None:
+        if not self._enabled or image.isNull():
+            return
+        data = self._encode(image)
+        if data is None:
+            return
+        try:
+            conn = self._conn()
+            with self._lock:
+                old = conn.execute("SELECT bytes FROM thumbs WHERE key = ?", (key,)).fetchone()
+                conn.execute(
+                    "INSERT OR REPLACE INTO thumbs (key, data, bytes, atime) VALUES (?, ?, ?, ?)",
+                    (key, data, len(data), int(time.time())),
+                )
+                conn.commit()
+                self._total += len(data) - (old[0] if old else 0)
+                if self._total > self.max_bytes:
+                    self._evict(conn)
+        except sqlite3.Error as e:
+            self._disable(e)
+
+    def total_bytes(self) -> int:
+        return self._total if self._enabled else 0
+
+    def clear(self) -> None:
+        if not self._enabled:
+            return
+        try:
+            conn = self._conn()
+            with self._lock:
+                conn.execute("DELETE FROM thumbs")
+                conn.commit()
+                self._total = 0
+        except sqlite3.Error as e:
+            self._disable(e)
+
+    # ── Nội bộ ──────────────────────────────────────────────────────────
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        """Xoá entry ít dùng nhất tới khi tổng dung lượng ≤ EVICT_TO × max_bytes (gọi khi giữ _lock)."""
+        target = int(self.max_bytes * EVICT_TO)
+        doomed, freed = [], 0
+        for key, size in conn.execute("SELECT key, bytes FROM thumbs ORDER BY atime"):
+            if self._total - freed <= target:
+                break
+            doomed.append((key,))
+            freed += size
+        conn.executemany("DELETE FROM thumbs WHERE key = ?", doomed)
+        conn.commit()
+        self._total -= freed
+
+    @staticmethod
+    def _encode(image: QImage) -> bytes | None:
+        buf = QBuffer()
+        buf.open(QIODevice.WriteOnly)
+        if not image.save(buf, IMAGE_FORMAT, 85):
+            return None
+        return bytes(buf.data())
+
+    def _disable(self, error: Exception) -> None:
+        if self._enabled:
+            print(f"Thumbnail cache disabled: {error}")
+        self._enabled = False
+
+
+class PixmapCache:
+    """
+    LRU QPixmap trong RAM theo (path, bề rộng), giới hạn theo byte.
+
+    Mỗi pixmap đi kèm key ThumbnailCache.key_for (path|mtime|size|bề rộng) mà
+    ThumbnailLoader đã tính ở luồng nền. get() không đụng tới đĩa; ảnh có đổi
+    hay không do loader kiểm lại (request với known_key).
+    """
+
+    def __init__(self, max_bytes: int = PIXMAP_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self._items: OrderedDict = OrderedDict()    # (path, width) -> (key, QPixmap)
+        self._total = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _cost(pixmap: QPixmap) -> int:
+        return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+    def get(self, path: str, width: int) -> tuple[str, QPixmap] | None:
+        """(key, pixmap) đã cache cho path ở bề rộng width, hoặc None."""
+        item = self._items.get((path, width))
+        if item is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end((path, width))
+        self.hits += 1
+        return item
+
+    def put(self, path: str, width: int, key: str, pixmap: QPixmap) -> None:
+        if not key or pixmap.isNull():
+            return
+        cost = self._cost(pixmap)
+        if cost > self.max_bytes:
+            return
+        old = self._items.pop((path, width), None)
+        if old is not None:
+            self._total -= self._cost(old[1])
+        self._items[(path, width)] = (key, pixmap)
+        self._total += cost
+        while self._total > self.max_bytes:
+            _, (_, evicted) = self._items.popitem(last=False)
+            self._total -= self._cost(evicted)
+
+    def total_bytes(self) -> int:
+        return self._total
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def clear(self) -> None:
+        self._items.clear()
+        self._total = 0
+
+
+PIXMAP_CACHE = PixmapCache()
@@ -0,0 +1,138 @@
+"""
+thumbnail_loader.py - Giải mã thumbnail ở luồng nền
+
+Mỗi yêu cầu (path, size) được đẩy vào một QThreadPool riêng. Worker giải mã
+thẳng ra kích thước thumbnail:
+  - QImageReader.setScaledSize: với JPEG Qt thu nhỏ ngay ở miền DCT
+    (scale_denom của libjpeg) nên không phải giải mã cả ảnh 24MP.
+  - Nếu Qt không đọc được → Pillow với Image.draft() (cũng thu nhỏ ở miền DCT
+    cho JPEG) rồi thumbnail().
+Kết quả là QImage (an toàn giữa các luồng); việc đổi sang QPixmap do phía GUI
+làm khi nhận tín hiệu `loaded`.
+
+Worker stat file để tính key (ThumbnailCache.key_for) – GUI thread không
+stat. Có ThumbnailCache thì worker tra cache trên đĩa trước, chỉ giải mã khi
+miss và ghi kết quả lại cho các lần mở sau. request(..., known_key) dùng khi
+GUI đã có pixmap trong RAM: key trùng thì worker dừng luôn, ảnh đã đổi thì
+giải mã lại và phát `loaded` như thường.
+
+Huỷ: cancel(path) bỏ yêu cầu khỏi bảng chờ – task chưa chạy sẽ thoát ngay khi
+tới lượt, task đang chạy thì kết quả bị bỏ qua.
+"""
+from itertools import count
+
+from PySide6.QtCore import QCoreApplication, QObject, QThreadPool, Qt, Signal
+from PySide6.QtGui import QImage, QImageReader
+
+from thumbnail_cache import ThumbnailCache
+
+MAX_THREADS = 4
+
+
+def decode_thumbnail(path: str, size: int) -> QImage:
+    """Giải mã ảnh vừa khung size×size (giữ tỉ lệ). Lỗi → ValueError."""
+    reader = QImageReader(path)
+    reader.setAutoTransform(True)
+    src = reader.size()
+    if src.isValid() and (src.width() > size or src.height() > size):
+        reader.setScaledSize(src.scaled(size, size, Qt.KeepAspectRatio))
+    image = reader.read()
+    if not image.isNull():
+        return image
+
+    qt_error = reader.errorString()
+    try:
+        return _decode_with_pil(path, size)
+    except Exception as exc:
+        raise ValueError(f"Cannot load image from {path}: {qt_error or exc}") from exc
+
+
+def _decode_with_pil(path: str, size: int) -> QImage:
+    from PIL import Image, ImageOps
+
+    with Image.open(path) as im:
+        im.draft("RGB", (size, size))      # JPEG: giảm 1/2, 1/4, 1/8 ngay khi giải mã
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((size, size), Image.LANCZOS)
+        im = im.convert("RGBA")
+        data = im.tobytes("raw", "RGBA")
+        w, h = im.size
+    # copy() để QImage sở hữu bộ nhớ, không trỏ vào bytes của Python
+    return QImage(data, w, h, 4 * w, QImage.Format_RGBA8888).copy()
+
+
+class ThumbnailLoader(QObject):
+    """Hàng đợi giải mã thumbnail bất đồng bộ, có huỷ theo path."""
+    loaded = Signal(str, QImage, str)           # path, ảnh, key của file lúc giải mã
+    failed = Signal(str, str)
+
+    _decoded = Signal(str, int, QImage, str, str)   # worker → GUI thread (queued)
+
+    def __init__(self, parent=None, max_threads: int = MAX_THREADS, cache=None):
+        super().__init__(parent)
+        self._cache = cache             # ThumbnailCache hoặc None
+        self._pool = QThreadPool(self)
+        self._pool.setMaxThreadCount(max(1, min(max_threads, QThreadPool.globalInstance().maxThreadCount())))
+        self._pending: dict = {}        # path -> token của yêu cầu còn hiệu lực
+        self._tokens = count(1)
+        self._decoded.connect(self._on_decoded, Qt.QueuedConnection)
+        app = QCoreApplication.instance()
+        if app is not None:
+            app.aboutToQuit.connect(self.shutdown)
+
+    def request(self, path: str, size: int, known_key: str | None = None) -> None:
+        """
+        Xếp hàng giải mã path; yêu cầu cũ cho cùng path (nếu còn) bị thay thế.
+        known_key: key của thumbnail đang có – file không đổi thì không giải mã.
+        """
+        token = next(self._tokens)
+        self._pending[path] = token
+        self._pool.start(lambda: self._run(path, size, token, known_key))
+
+    def cancel(self, path: str) -> None:
+        self._pending.pop(path, None)
+
+    def cancel_all(self) -> None:
+        self._pending.clear()
+        self._pool.clear()
+
+    def is_pending(self, path: str) -> bool:
+        return path in self._pending
+
+    def shutdown(self) -> None:
+        """Huỷ mọi yêu cầu và chờ các worker đang chạy kết thúc (gọi khi đóng app)."""
+        self.cancel_all()
+        self._pool.waitForDone()
+
+    def _run(self, path: str, size: int, token: int, known_key: str | None) -> None:
+        # Chạy trên worker: yêu cầu đã bị huỷ/thay thế thì bỏ qua, không giải mã
+        if self._pending.get(path) != token:
+            return
+        key = ThumbnailCache.key_for(path, size)
+        error = ""
+        if key is not None and key == known_key:
+            image = QImage()            # file không đổi → thumbnail trong RAM vẫn đúng
+        else:
+            image = self._cache.get(key) if key and self._cache is not None else None
+        if image is None:
+            try:
+                image = decode_thumbnail(path, size)
+            except Exception as exc:
+                image, error = QImage(), str(exc)
+            else:
+                if key and self._cache is not None and self._pending.get(path) == token:
+                    self._cache.put(key, image)
+        if self._pending.get(path) == token:
+            try:
+                self._decoded.emit(path, token, image, key or "", error)
+            except RuntimeError:
+                pass        # loader đã bị huỷ (đang thoát app) → bỏ kết quả
+
+    def _on_decoded(self, path: str, token: int, image: QImage, key: str, error: str) -> None:
+        if self._pending.get(path) != token:
+            return
+        del self._pending[path]
+        if error:
+            self.failed.emit(path, error)
+        elif not image.isNull():
+            self.loaded.emit(path, image, key)
@@ -100,18 +100,17 @@ def run_replace_tags(win) -> bool:
     # Execute replacement
     before = win._snapshot()
     affected = 0
-    for idx, img in enumerate(win.images):
-        modified = False
+    # Chỉ duyệt các ảnh có ít nhất một tag cũ (posting index)
+    for idx in win.images.images_with_any(replace_map):
+        img = win.images[idx]
         for old_tag, new_tag in replace_map.items():
             if old_tag in img['tags']:
                 img['tags'].remove(old_tag)
                 if new_tag not in img['tags']:
                     img['tags'].append(new_tag)
-                modified = True
-        if modified:
-            img['modified'] = True
-            win.image_grid.refresh_card(idx)
-            affected += 1
+        img['modified'] = True
+        win.image_grid.refresh_card(idx)
+        affected += 1
 
     win._push_history(tr("history_replace_tags", map=replace_map), before)
     win._reload_tags_panel()
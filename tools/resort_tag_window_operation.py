@@ -198,7 +198,8 @@ class ResortTagsSimple(QWidget):
         before = win._snapshot()
         affected = 0
 
-        for idx, img in enumerate(win.images):
+        for idx in win.images.images_with_any(chosen_set):
+            img = win.images[idx]
             # Lọc ra các tag đang có trong ảnh mà nằm trong danh sách chọn
             present = [t for t in img['tags'] if t in chosen_set]
             if not present:
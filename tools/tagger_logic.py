@@ -3,15 +3,34 @@ tagger_logic.py – WD14 Tagger backend for TKtagger
 
 Supports:
   - Loading model from HuggingFace Hub (repo_id) OR local .onnx file
-  - PNG alpha → white background flattening in /tmp before inference
+  - PNG alpha → white background flattening (in memory) before inference
+  - Batched inference: N images stacked into one (N, 448, 448, 3) tensor
+  - Process-level model registry: sessions stay warm between runs (LRU)
+  - Configurable ONNX Runtime session profile (providers, threads,
+    graph optimisation level, serialized optimised-graph cache, arenas)
+  - Raw model outputs cached per folder (.tktagger/) – changing thresholds
+    or undesired tags re-runs only the decoder, not the model
+  - Incremental mode (only_new): skips images whose caption is newer than
+    the image or whose content hash is in the tagging manifest
+  - Decode/preprocess on a worker thread pool, prefetched ahead of inference
   - Output as  tag_<stem><ext>  or overwrite existing caption file
   - Subfolder recursion from root_folder
   - Progress callback  cb(current, total, message)  for UI integration
+  - Streaming: iter_tagger() yields per-chunk results while inference runs
+  - TaggingJob: cancel / pause, checkpointed so a restarted job resumes
+  - Caption files are written atomically (temp file + os.replace)
+  - num_processes > 1: inference sharded across worker processes
+  - Remote backends (Kohya_ss Gradio, TKtagger HTTP) with pooled clients
 
 Usage (standalone / test):
     from tagger_logic import run_tagger
     run_tagger(config, progress_cb=print)
 
+Usage (streaming, results applied while tagging runs):
+    from tagger_logic import iter_tagger
+    for chunk in iter_tagger(config, progress_cb=print):
+        apply(chunk)
+
 Usage (from main_window slot):
     def _on_tagging_started(self, config):
         from tagger_logic import run_tagger
@@ -21,13 +40,23 @@ Usage (from main_window slot):
 
 from __future__ import annotations
 
+import base64
 import csv
+import hashlib
+import http.client
+import json
+import multiprocessing
 import os
+import queue
 import re
-import shutil
-import tempfile
+import threading
+import urllib.parse
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from itertools import islice
 from pathlib import Path
-from typing import Callable, Optional
+from typing import Callable, Iterator, Optional
 
 # gradio_client – only needed for API mode
 try:
@@ -44,7 +73,6 @@ from PIL import Image
 # ──────────────────────────────────────────────────────────────
 try:
     import onnxruntime as ort
-    print(f"Available providers: {ort.get_available_providers()}")
     _HAS_ORT = True
 except ImportError:
     _HAS_ORT = False
@@ -64,6 +92,12 @@ IMAGE_EXTENSIONS: set[str] = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".gif"}
 MODEL_FILENAME   = "model.onnx"
 TAGS_FILENAME    = "selected_tags.csv"
 MODEL_INPUT_SIZE = 448   # WD14 standard input resolution
+DEFAULT_LOADER_WORKERS = min(4, os.cpu_count() or 1)
+DEFAULT_PROVIDERS = ("CUDAExecutionProvider", "CPUExecutionProvider")
+MAX_LOADED_MODELS = 2    # models kept resident by the registry
+GRAPH_OPT_LEVELS  = ("disable", "basic", "extended", "all")
+OPTIMIZED_MODEL_DIR = Path.home() / ".cache" / "tktagger" / "onnx"   # default graph cache
+CACHE_DIRNAME    = ".tktagger"   # per-folder sidecar dir, same as file_ops.CACHE_DIRNAME
 
 RATING_TAGS = {
     "general":    "rating:general",
@@ -91,6 +125,28 @@ def run_tagger(
     Returns
     -------
     List of dicts: [{"path": str, "tags": [str], "skipped": bool, "error": str|None}]
+    skipped=True with error=None means the caption was already up to date
+    (only_new mode); skipped=True with an error means the image failed.
+    """
+    results: list[dict] = []
+    for chunk in iter_tagger(config, progress_cb):
+        results.extend(chunk)
+    return results
+
+
+def iter_tagger(
+    config: dict,
+    progress_cb: Optional[Callable[[int, int, str], None]] = None,
+    job: Optional["TaggingJob"] = None,
+) -> Iterator[list[dict]]:
+    """
+    Streaming form of run_tagger: yields the result dicts of every chunk
+    (same format, same order) as soon as its captions are written, so the
+    caller can apply tags while inference continues and never has to hold
+    the whole result list.  Closing the generator stops the run.
+
+    With a *job*, the run honours its cancel / pause requests between
+    chunks and checkpoints finished images; see TaggingJob.
     """
     _cb = progress_cb or (lambda *_: None)
 
@@ -101,164 +157,456 @@ def run_tagger(
             "Install it with:  pip install onnxruntime  (or onnxruntime-gpu)"
         )
 
-    # 2. Resolve model & tags CSV
+    # 2–4. Resolve model + tags (warm from the registry).  The ONNX session
+    #      itself is loaded only once an image actually needs inference.
     _cb(0, 0, "Loading model…")
-    onnx_path, csv_path = _resolve_model(config)
-
-    # 3. Load tags list
-    tags_df = _load_tags_csv(csv_path)               # list of dicts: name, category
-    rating_idxs, general_idxs, char_idxs = _split_tag_indices(tags_df)
-
-    # 4. Load ONNX session
-    session = _load_session(onnx_path)
-    input_name = session.get_inputs()[0].name
+    model = MODEL_REGISTRY.get(config)
+    options = DecodeOptions.from_config(config)
 
     # 5. Collect image paths
-    image_paths = _collect_images(config)
+    image_paths = [Path(p) for p in _collect_images(config)]
     total = len(image_paths)
     if total == 0:
         _cb(0, 0, "No images found.")
-        return []
-
-    # 6. Prepare /tmp scratch dir for alpha conversion
-    tmp_dir = Path(tempfile.mkdtemp(prefix="tktagger_")) if config.get("alpha_to_white") else None
+        return
+
+    # 6. Incremental mode: images already tagged with these settings are
+    #    reported as skipped.  Images whose raw outputs are cached from an
+    #    earlier run skip decoding and inference – only the decoder runs.
+    manifest = TaggingManifest(model.model_id, _settings_key(options, config))
+    up_to_date = [
+        bool(config.get("only_new")) and _is_up_to_date(p, manifest, config)
+        for p in image_paths
+    ]
+    # 6b. Resumed job: images finished before the interruption count as done
+    checkpoint = None
+    if job is not None and config.get("resume", True):
+        checkpoint = TaggingCheckpoint(config, model.model_id, manifest.settings_key)
+        finished = checkpoint.load()
+        if finished:
+            _cb(0, total, f"Resuming – {len(finished)} images already done.")
+            up_to_date = [done or p in finished for p, done in zip(image_paths, up_to_date)]
+
+    cache = ProbabilityCache(model, alpha_to_white=bool(config.get("alpha_to_white")),
+                             enabled=config.get("prob_cache", True))
+    hits = [done or cache.has(p) for p, done in zip(image_paths, up_to_date)]
+    misses = [p for p, hit in zip(image_paths, hits) if not hit]
+    processes = min(int(config.get("num_processes", 1) or 1), len(misses))
+    sharded = processes > 1
+    if sharded:       # every worker clamps to its own session's batch dimension
+        batch_size = max(1, int(config.get("batch_size", 1) or 1))
+    else:
+        batch_size = _effective_batch_size(model.session, config) if misses else 1
 
-    results = []
+    # 7. Tag in chunks, missing images decoded ahead on the loader pool (or,
+    #    sharded, decoded and inferred by the worker processes)
+    if sharded:
+        stream = _iter_sharded_probs(misses, config, batch_size, processes, model)
+    else:
+        stream = _iter_preprocessed(misses, config, batch_size)
+    completed = False
     try:
-        for idx, img_path in enumerate(image_paths):
-            img_path = Path(img_path)
-            _cb(idx, total, f"[{idx+1}/{total}] {img_path.name}")
-
-            try:
-                # 6a. Flatten alpha if needed
-                work_path = _flatten_alpha(img_path, tmp_dir) if config.get("alpha_to_white") else img_path
+        for chunk in _chunks(hits, batch_size):
+            if job is not None and not job.wait():
+                _cb(chunk[0], total, f"Cancelled – {chunk[0]}/{total} images processed.")
+                return
+
+            # 7a. Cached rows come from the store; the prefetched tensors of
+            #     the misses form the batch.  A file that failed to load only
+            #     costs its own slot.
+            slots: list[dict] = []
+            tensors: list[np.ndarray] = []
+            for idx in chunk:
+                img_path = image_paths[idx]
+                _cb(idx, total, f"[{idx+1}/{total}] {img_path.name}")
+                slot = {"path": str(img_path), "tags": [], "skipped": True, "error": None}
+                if up_to_date[idx]:
+                    pass
+                elif hits[idx]:
+                    slot["probs"] = cache.get(img_path)
+                    if slot["probs"] is None:
+                        slot["error"] = "cached model outputs could not be read"
+                else:
+                    _, data, error = next(stream)
+                    if error is not None:
+                        slot["error"] = str(error)
+                    elif sharded:
+                        slot["probs"], slot["fresh"] = data, True
+                    else:
+                        tensors.append(data)
+                        slot["row"] = len(tensors) - 1
+                slots.append(slot)
+
+            # 7b. Run inference on the stacked batch → (n, num_tags)
+            probs = _run_batch(model.session, model.input_name, tensors, slots) if tensors else None
+            fresh = []
+            for slot in slots:
+                row = slot.pop("row", None)
+                if row is not None and slot["error"] is None:
+                    slot["probs"] = probs[row]
+                    fresh.append(slot)
+                elif slot.pop("fresh", False):
+                    fresh.append(slot)
+            # Decode fresh rows at the cache's float16 precision, so a later
+            # run served from the cache writes exactly the same captions
+            for slot in fresh:
+                slot["probs"] = slot["probs"].astype(np.float16).astype(np.float32)
+            cache.put([Path(s["path"]) for s in fresh], [s["probs"] for s in fresh])
+
+            # 7c. Decode tags for every probability row at once
+            ready = [s for s in slots if s.get("probs") is not None]
+            tag_lists = model.decoder.decode(
+                np.stack([s.pop("probs") for s in ready]), options
+            ) if ready else []
+
+            # 7d. Write caption files, keep result order = image order
+            for slot, tags in zip(ready, tag_lists):
+                try:
+                    _write_caption(_caption_path(Path(slot["path"]), config), tags, config)
+                    slot.update(tags=tags, skipped=False)
+                    manifest.record(Path(slot["path"]))
+                except Exception as exc:
+                    slot["error"] = str(exc)
+            if checkpoint is not None:
+                checkpoint.add(Path(s["path"]) for s in slots if not s["skipped"])
+            yield slots
+        completed = True
 
-                # 6b. Preprocess → numpy
-                img_tensor = _preprocess_image(work_path)
+    finally:
+        stream.close()   # stops the loader pool, drops unread prefetches
+        cache.save()
+        manifest.save()
+        if checkpoint is not None:
+            checkpoint.close(discard=completed)
+        if not config.get("keep_model_loaded", True):
+            MODEL_REGISTRY.unload(model.onnx_path)
 
-                # 6c. Run inference
-                probs = session.run(None, {input_name: img_tensor})[0][0]   # shape (num_tags,)
+    _cb(total, total, f"Done – {total} images processed.")
 
-                # 6d. Decode tags
-                tags = _decode_tags(
-                    probs        = probs,
-                    tags_df      = tags_df,
-                    rating_idxs  = rating_idxs,
-                    general_idxs = general_idxs,
-                    char_idxs    = char_idxs,
-                    config       = config,
-                )
+def run_tagger_api(
+    config: dict,
+    progress_cb: Optional[Callable[[int, int, str], None]] = None,
+) -> list[dict]:
+    """
+    Tag through a remote backend (config["api_backend"]) instead of a local
+    ONNX session.  Same result format as run_tagger, so the tags can be
+    merged into the UI without re-reading the folder.
+
+        "kohya" – Kohya_ss Gradio API (/caption_images_3), one call for the
+                  whole folder; the server writes the caption files and the
+                  tags are read back from them.
+        "http"  – TKtagger tagging contract (see tools/tagger_server.py),
+                  per-chunk requests with a concurrency limit; captions are
+                  written locally.
+    """
+    results: list[dict] = []
+    for chunk in iter_tagger_api(config, progress_cb):
+        results.extend(chunk)
+    return results
 
-                # 6e. Write caption file
-                out_path = _caption_path(img_path, config)
-                _write_caption(out_path, tags, config)
 
-                results.append({"path": str(img_path), "tags": tags, "skipped": False, "error": None})
+def iter_tagger_api(
+    config: dict,
+    progress_cb: Optional[Callable[[int, int, str], None]] = None,
+    job: Optional["TaggingJob"] = None,
+) -> Iterator[list[dict]]:
+    """Streaming form of run_tagger_api (see iter_tagger)."""
+    _cb = progress_cb or (lambda *_: None)
 
+    backend = REMOTE_CLIENTS.get(config)
+    if not backend.per_chunk:
+        # The server tags target_folder (recursive = include_subfolders), not
+        # root_folder – read back exactly the images it wrote captions for
+        config = {**config, "root_folder": config.get("target_folder", "")}
+    image_paths = [Path(p) for p in _collect_images(config)]
+    total = len(image_paths)
+    if total == 0:
+        _cb(0, 0, "No images found.")
+        return
+
+    # Whole-folder backend: one blocking call, then read the captions back
+    if not backend.per_chunk:
+        _cb(0, total, f"Đang gửi yêu cầu tagging cho: {config.get('target_folder', '')}")
+        backend.tag_folder(config)
+        for start in range(0, total, 256):
+            slots = []
+            for img_path in image_paths[start:start + 256]:
+                slot = {"path": str(img_path), "tags": [], "skipped": True, "error": None}
+                try:
+                    slot.update(tags=_read_caption(_caption_path(img_path, config)), skipped=False)
+                except OSError as exc:
+                    slot["error"] = str(exc)
+                slots.append(slot)
+            yield slots
+        _cb(total, total, f"Done – {total} images processed.")
+        return
+
+    # Per-chunk backend: up to api_concurrency requests in flight on the
+    # pooled client, results consumed (and captions written) in order
+    chunk_size = max(1, int(config.get("api_chunk_size", config.get("batch_size", 1)) or 1))
+    concurrency = max(1, int(config.get("api_concurrency", 4) or 1))
+    chunks = [image_paths[i:i + chunk_size] for i in range(0, total, chunk_size)]
+    pool = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="tktagger-remote")
+    try:
+        pending: deque = deque()
+        todo = iter(chunks)
+        for chunk in islice(todo, 2 * concurrency):
+            pending.append((chunk, pool.submit(backend.tag, chunk, config)))
+        done = 0
+        while pending:
+            if job is not None and not job.wait():
+                _cb(done, total, f"Cancelled – {done}/{total} images processed.")
+                return
+            chunk, future = pending.popleft()
+            nxt = next(todo, None)
+            if nxt is not None:
+                pending.append((nxt, pool.submit(backend.tag, nxt, config)))
+            try:
+                replies = future.result()
             except Exception as exc:
-                results.append({"path": str(img_path), "tags": [], "skipped": True, "error": str(exc)})
-
+                replies = [(None, str(exc))] * len(chunk)
+
+            slots = []
+            for img_path, (tags, error) in zip(chunk, replies):
+                done += 1
+                _cb(done - 1, total, f"[{done}/{total}] {img_path.name}")
+                slot = {"path": str(img_path), "tags": [], "skipped": True, "error": error}
+                if error is None:
+                    try:
+                        _write_caption(_caption_path(img_path, config), tags, config)
+                        slot.update(tags=tags, skipped=False)
+                    except Exception as exc:
+                        slot["error"] = str(exc)
+                slots.append(slot)
+            yield slots
     finally:
-        # Clean up /tmp scratch
-        if tmp_dir and tmp_dir.exists():
-            shutil.rmtree(tmp_dir, ignore_errors=True)
+        pool.shutdown(wait=False, cancel_futures=True)
 
     _cb(total, total, f"Done – {total} images processed.")
-    return results
 
-def run_tagger_api(
-    config: dict,
-    progress_cb: Optional[Callable[[int, int, str], None]] = None,
-) -> list[dict] | None:
+
+# ──────────────────────────────────────────────────────────────
+#  Remote backends
+# ──────────────────────────────────────────────────────────────
+
+class KohyaBackend:
     """
-    Run WD14 tagging via the Kohya_ss Gradio API (/caption_images_3).
+    Kohya_ss Gradio API.  The Client (which downloads the API schema when it
+    is created) is built once and reused for every later run.
 
     Requires:  pip install gradio_client
+    """
 
-    The kohya_ss API does NOT return per-image tag lists — it writes caption
-    files directly into *train_data_dir* on the server side.  Therefore this
-    function returns None (no in-memory results to merge back into the UI).
-    The caller in main_window._on_tagging_started already handles None gracefully.
+    per_chunk = False
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self._client = None
+        self._lock = threading.Lock()
+
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                if not _HAS_GRADIO_CLIENT:
+                    raise ImportError(
+                        "gradio_client is not installed.\n"
+                        "Install with:  pip install gradio_client"
+                    )
+                self._client = GradioClient(self.base_url)
+            return self._client
+
+    def tag_folder(self, config: dict) -> object:
+        # ── The 22 named parameters exactly as documented ───────────────
+        # Source: kohya_ss /caption_images_3  (api_name="/caption_images_3")
+        return self.client().predict(
+            train_data_dir=config.get("target_folder", ""),
+            caption_extension=config.get("ext", ".txt"),          # ".cap" | ".caption" | ".txt"
+            batch_size=float(config.get("batch_size", 1)),
+            general_threshold=float(config.get("gen_threshold", 0.35)),
+            character_threshold=float(config.get("char_threshold", 0.35)),
+            repo_id=config.get("repo_id", "SmilingWolf/wd-v1-4-convnextv2-tagger-v2"),
+            recursive=bool(config.get("include_subfolders", False)),
+            max_data_loader_n_workers=float(config.get("max_data_loader_n_workers", 2)),
+            debug=bool(config.get("debug", True)),
+            undesired_tags=", ".join(config.get("undesired_tags", [])),
+            frequency_tags=bool(config.get("frequency_tags", True)),
+            always_first_tags=", ".join(config.get("prefix_tags", [])),
+            onnx=True,                                             # always True for speed
+            append_tags=bool(config.get("append_tags", False)),
+            force_download=bool(config.get("force_download", False)),
+            caption_separator=config.get("separator", ", "),
+            tag_replacement=config.get("tag_replacement", ""),    # "old1,new1;old2,new2" or ""
+            character_tag_expand=bool(config.get("char_expand", False)),
+            use_rating_tags=bool(config.get("use_rating", False)),
+            use_rating_tags_as_last_tag=bool(config.get("rating_as_last", False)),
+            remove_underscore=bool(config.get("remove_underscore", True)),
+            thresh=float(config.get("gen_threshold", 0.35)),      # global fallback threshold
+            api_name="/caption_images_3",
+        )
 
-    Parameters
-    ----------
-    config       : dict produced by WaifuTaggerWindow.tagging_started
-    progress_cb  : optional callable(current, total, message)
+    def close(self) -> None:
+        with self._lock:
+            self._client = None
+
+
+class HttpTaggerBackend:
     """
-    _cb = progress_cb or (lambda *_: None)
+    Client for the TKtagger tagging contract (served by tools/tagger_server.py):
 
-    if not _HAS_GRADIO_CLIENT:
-        raise ImportError(
-            "gradio_client is not installed.\n"
-            "Install with:  pip install gradio_client"
-        )
+        GET  /health → {"ok": true, "model": str, "max_batch": int}
+        POST /tag    {"options": {...}, "images": [{"name": str, "data": base64}]}
+                   → {"results": [{"tags": [str], "error": str | null}]}
 
-    base_url = config.get("api_url", "http://127.0.0.1:7860").rstrip("/")
-
-    # ── Build the 22 named parameters exactly as documented ───────────────
-    # Source: kohya_ss /caption_images_3  (api_name="/caption_images_3")
-    train_data_dir   = config.get("target_folder", "")
-    caption_extension = config.get("ext", ".txt")          # ".cap" | ".caption" | ".txt"
-    batch_size       = float(config.get("batch_size", 1))
-    general_threshold = float(config.get("gen_threshold", 0.35))
-    character_threshold = float(config.get("char_threshold", 0.35))
-    repo_id          = config.get("repo_id", "SmilingWolf/wd-v1-4-convnextv2-tagger-v2")
-    recursive        = bool(config.get("include_subfolders", False))
-    max_workers      = float(config.get("max_data_loader_n_workers", 2))
-    debug            = bool(config.get("debug", True))
-    undesired_tags   = ", ".join(config.get("undesired_tags", []))
-    frequency_tags   = bool(config.get("frequency_tags", True))
-    always_first_tags = ", ".join(config.get("prefix_tags", []))
-    use_onnx         = True                                 # always True for speed
-    append_tags      = bool(config.get("append_tags", False))
-    force_download   = bool(config.get("force_download", False))
-    caption_separator = config.get("separator", ", ")
-    tag_replacement  = config.get("tag_replacement", "")   # "old1,new1;old2,new2" or ""
-    character_tag_expand = bool(config.get("char_expand", False))
-    use_rating_tags  = bool(config.get("use_rating", False))
-    use_rating_tags_as_last_tag = bool(config.get("rating_as_last", False))
-    remove_underscore = bool(config.get("remove_underscore", True))
-    thresh           = float(config.get("gen_threshold", 0.35))   # global fallback threshold
+    "options" carries the tag settings of the config (thresholds, prefix /
+    undesired tags, …), applied on the server.  Keep-alive connections are
+    pooled, so concurrent requests and later runs reuse the same sockets.
 
-    try:
-        _cb(0, 1, f"Đang kết nối tới Kohya_ss tại {base_url} …")
-        client = GradioClient(base_url)
-
-        _cb(0, 1, f"Đang gửi yêu cầu tagging cho: {train_data_dir}")
-        result = client.predict(
-            train_data_dir=train_data_dir,
-            caption_extension=caption_extension,
-            batch_size=batch_size,
-            general_threshold=general_threshold,
-            character_threshold=character_threshold,
-            repo_id=repo_id,
-            recursive=recursive,
-            max_data_loader_n_workers=max_workers,
-            debug=debug,
-            undesired_tags=undesired_tags,
-            frequency_tags=frequency_tags,
-            always_first_tags=always_first_tags,
-            onnx=use_onnx,
-            append_tags=append_tags,
-            force_download=force_download,
-            caption_separator=caption_separator,
-            tag_replacement=tag_replacement,
-            character_tag_expand=character_tag_expand,
-            use_rating_tags=use_rating_tags,
-            use_rating_tags_as_last_tag=use_rating_tags_as_last_tag,
-            remove_underscore=remove_underscore,
-            thresh=thresh,
-            api_name="/caption_images_3",
-        )
+    A chunk larger than the server's "max_batch" is sent as several
+    requests; a server that doesn't advertise one but answers 413 gets the
+    request halved, and the smaller size is kept for the following chunks.
+    """
 
-        _cb(1, 1, f"Kohya_ss hoàn thành! Kết quả: {result}")
-        # kohya_ss trả về 1 phần tử (thường là chuỗi log).
-        # Caption files đã được ghi vào disk bởi server — không có list tags trả về.
-        return None
+    per_chunk = True
+
+    def __init__(self, base_url: str, timeout: float = 300.0):
+        parts = urllib.parse.urlsplit(base_url if "://" in base_url else f"http://{base_url}")
+        self._conn_cls = (http.client.HTTPSConnection if parts.scheme == "https"
+                          else http.client.HTTPConnection)
+        self._netloc = parts.netloc
+        self._prefix = parts.path.rstrip("/")
+        self.timeout = timeout
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        self._max_batch: Optional[int] = None   # None = not asked yet, 0 = no known limit
+
+    def _request(self, method: str, path: str, payload: Optional[dict] = None) -> dict:
+        body = json.dumps(payload).encode("utf-8") if payload is not None else None
+        headers = {"Content-Type": "application/json"} if body is not None else {}
+        for attempt in range(2):
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._conn_cls(self._netloc, timeout=self.timeout)
+            try:
+                conn.request(method, self._prefix + path, body=body, headers=headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except (http.client.RemoteDisconnected, http.client.CannotSendRequest,
+                    ConnectionResetError, BrokenPipeError):
+                conn.close()            # stale keep-alive socket: retry once on a new one
+                if attempt:
+                    raise
+                continue
+            except Exception:
+                conn.close()
+                raise
+            if resp.will_close:
+                conn.close()
+            else:
+                self._idle.put(conn)
+            if resp.status != 200:
+                raise RemoteHTTPError(method, path, resp.status, data)
+            return json.loads(data)
+        raise RuntimeError(f"{method} {path} failed")
+
+    def health(self) -> dict:
+        return self._request("GET", "/health")
+
+    def tag(self, paths: list[Path], config: dict) -> list[tuple[Optional[list[str]], Optional[str]]]:
+        """Tag one chunk; returns (tags, error) per path, in order."""
+        replies: list = [None] * len(paths)
+        images, sent = [], []
+        for i, path in enumerate(paths):
+            try:
+                data = base64.b64encode(Path(path).read_bytes()).decode("ascii")
+            except OSError as exc:
+                replies[i] = (None, str(exc))
+                continue
+            images.append({"name": Path(path).name, "data": data})
+            sent.append(i)
+        if images:
+            results = self._post_images(remote_options(config), images)
+            if len(results) != len(sent):
+                raise RuntimeError(f"server returned {len(results)} results for {len(sent)} images")
+            for i, res in zip(sent, results):
+                replies[i] = (None, res["error"]) if res.get("error") else (list(res["tags"]), None)
+        return replies
+
+    def _batch_limit(self) -> int:
+        if self._max_batch is None:
+            try:
+                self._max_batch = max(0, int(self.health().get("max_batch") or 0))
+            except Exception:
+                return 0            # not cached: asked again on the next request
+        return self._max_batch
+
+    def _post_images(self, options: dict, images: list[dict]) -> list[dict]:
+        """POST /tag, split into requests the server accepts; results in order."""
+        limit = self._batch_limit()
+        if limit and len(images) > limit:
+            return [res for i in range(0, len(images), limit)
+                    for res in self._post_images(options, images[i:i + limit])]
+        try:
+            return self._request("POST", "/tag", {"options": options, "images": images})["results"]
+        except RemoteHTTPError as exc:
+            if exc.status != 413 or len(images) < 2:
+                raise
+        half = len(images) // 2
+        self._max_batch = half
+        return self._post_images(options, images[:half]) + self._post_images(options, images[half:])
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class RemoteHTTPError(RuntimeError):
+    """Non-200 reply from a remote tagging backend."""
+
+    def __init__(self, method: str, path: str, status: int, body: bytes):
+        super().__init__(f"{method} {path} → HTTP {status}: {body[:200]!r}")
+        self.status = status
+
+
+REMOTE_BACKENDS = {"kohya": KohyaBackend, "http": HttpTaggerBackend}
+
+
+class RemoteClientPool:
+    """Remote backends keyed by (kind, url), kept across runs like the model registry."""
+
+    def __init__(self):
+        self._clients: dict[tuple[str, str], object] = {}
+        self._lock = threading.Lock()
+
+    def get(self, config: dict):
+        kind = config.get("api_backend", "kohya")
+        if kind not in REMOTE_BACKENDS:
+            raise ValueError(f"Unknown api_backend {kind!r} (expected one of {sorted(REMOTE_BACKENDS)})")
+        url = (config.get("api_url") or "http://127.0.0.1:7860").rstrip("/")
+        with self._lock:
+            if (kind, url) not in self._clients:
+                self._clients[(kind, url)] = REMOTE_BACKENDS[kind](url)
+            return self._clients[(kind, url)]
+
+    def close(self) -> None:
+        with self._lock:
+            for client in self._clients.values():
+                client.close()
+            self._clients.clear()
+
+
+REMOTE_CLIENTS = RemoteClientPool()
+
+
+def remote_options(config: dict) -> dict:
+    """The tag settings of *config* sent along with every remote request."""
+    keys = ("gen_threshold", "char_threshold", "remove_underscore", "char_expand",
+            "use_rating", "rating_as_last", "undesired_tags", "prefix_tags", "replacement_map",
+            "alpha_to_white")
+    return {k: config[k] for k in keys if k in config}
 
-    except Exception as exc:
-        _cb(0, 1, f"Lỗi khi gọi Kohya_ss API: {exc}")
-        raise
 
 # ──────────────────────────────────────────────────────────────
 #  Model resolution
@@ -329,53 +677,987 @@ def _split_tag_indices(tags_df: list[dict]) -> tuple[list[int], list[int], list[
     return rating_idxs, general_idxs, char_idxs
 
 
+# ──────────────────────────────────────────────────────────────
+#  Model registry
+# ──────────────────────────────────────────────────────────────
+
+@dataclass
+class LoadedModel:
+    """Everything run_tagger needs from one model, kept warm between runs."""
+    onnx_path:  str
+    csv_path:   str
+    model_id:   str              # stable id of (onnx, csv) file versions
+    tags_df:    list[dict]
+    decoder:    "TagDecoder"
+    profile:    "SessionProfile" = None
+    _session:   Optional["ort.InferenceSession"] = field(default=None, repr=False)
+    _lock:      threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def session(self) -> "ort.InferenceSession":
+        """ONNX session, loaded on first use (fully cached runs never need it)."""
+        with self._lock:
+            if self._session is None:
+                self._session = _load_session(self.onnx_path, self.profile, self.model_id)
+            return self._session
+
+    @property
+    def input_name(self) -> str:
+        return self.session.get_inputs()[0].name
+
+
+class ModelRegistry:
+    """
+    Process-level cache of loaded models, keyed by
+    (onnx path, onnx mtime, csv path, csv mtime, session profile).
+
+    Re-running the tagger with the same model (e.g. after tweaking
+    thresholds) reuses the InferenceSession, tag table and decoder instead
+    of reloading the graph.  The session is created lazily on first use.
+    At most *max_models* stay resident; the least recently used one is
+    dropped first.  Replacing the .onnx file on disk changes its mtime, so
+    a stale session is never reused.
+    """
+
+    def __init__(self, max_models: int = MAX_LOADED_MODELS):
+        self.max_models = max_models
+        self._models: "OrderedDict[tuple, LoadedModel]" = OrderedDict()
+        self._resolved: dict[str, tuple[str, str]] = {}   # repo_id → (onnx, csv)
+        self._lock = threading.RLock()
+
+    def get(self, config: dict) -> LoadedModel:
+        with self._lock:
+            onnx_path, csv_path = self._resolve(config)
+            profile = SessionProfile.from_config(config)
+            key = (
+                os.path.realpath(onnx_path), os.stat(onnx_path).st_mtime_ns,
+                os.path.realpath(csv_path),  os.stat(csv_path).st_mtime_ns,
+                profile,
+            )
+            model = self._models.get(key)
+            if model is not None:
+                self._models.move_to_end(key)
+                return model
+
+            # Same file with an older mtime / other session profile → drop it first
+            self._drop(lambda k: k[0] == key[0])
+
+            tags_df = _load_tags_csv(csv_path)
+            model = LoadedModel(
+                onnx_path  = onnx_path,
+                csv_path   = csv_path,
+                model_id   = hashlib.sha1(repr(key[:4]).encode("utf-8")).hexdigest()[:16],
+                tags_df    = tags_df,
+                decoder    = TagDecoder(tags_df),
+                profile    = profile,
+            )
+            self._models[key] = model
+            while len(self._models) > max(1, self.max_models):
+                self._models.popitem(last=False)
+            return model
+
+    def _resolve(self, config: dict) -> tuple[str, str]:
+        """_resolve_model, memoised per repo_id so warm runs skip the Hub check."""
+        if config.get("onnx_path") and os.path.isfile(config["onnx_path"]):
+            return _resolve_model(config)
+        repo_id = config.get("repo_id", "SmilingWolf/wd-v1-4-convnextv2-tagger-v2")
+        cached = self._resolved.get(repo_id)
+        if cached and not config.get("force_download") and all(map(os.path.isfile, cached)):
+            return cached
+        self._resolved[repo_id] = _resolve_model(config)
+        return self._resolved[repo_id]
+
+    def _drop(self, predicate: Callable[[tuple], bool]) -> int:
+        keys = [k for k in self._models if predicate(k)]
+        for k in keys:
+            del self._models[k]
+        return len(keys)
+
+    def unload(self, onnx_path: Optional[str] = None) -> int:
+        """Unload one model (by .onnx path) or, without argument, all of them."""
+        with self._lock:
+            if onnx_path is None:
+                count = len(self._models)
+                self._models.clear()
+                return count
+            real = os.path.realpath(onnx_path)
+            return self._drop(lambda k: k[0] == real)
+
+    def set_limit(self, max_models: int) -> None:
+        with self._lock:
+            self.max_models = max_models
+            while len(self._models) > max(1, max_models):
+                self._models.popitem(last=False)
+
+    def loaded(self) -> list[str]:
+        """Paths of resident models, least recently used first."""
+        with self._lock:
+            return [m.onnx_path for m in self._models.values()]
+
+    def describe(self) -> list[dict]:
+        """Resident models with the providers their session actually runs on."""
+        with self._lock:
+            return [
+                {
+                    "onnx_path": m.onnx_path,
+                    "model_id":  m.model_id,
+                    "providers": m._session.get_providers() if m._session is not None else None,
+                }
+                for m in self._models.values()
+            ]
+
+
+MODEL_REGISTRY = ModelRegistry()
+
+
+def unload_models(onnx_path: Optional[str] = None) -> int:
+    """Free cached ONNX sessions.  Returns the number of models unloaded."""
+    return MODEL_REGISTRY.unload(onnx_path)
+
+
+# ──────────────────────────────────────────────────────────────
+#  Probability cache
+# ──────────────────────────────────────────────────────────────
+
+class ProbabilityStore:
+    """
+    Raw model outputs of one folder for one model, as float16 rows.
+
+        <folder>/.tktagger/probs-<store_id>.f16    rows appended, read via memmap
+        <folder>/.tktagger/probs-<store_id>.json   {filename: [row, mtime_ns, size]}
+
+    store_id is the model id plus the preprocessing that changes the model
+    input (see ProbabilityCache).
+
+    A row is reused only while the image keeps the same mtime and size.
+    Rows of replaced images stay in the data file until the store is
+    compacted on save.
+    """
+
+    def __init__(self, folder: Path, store_id: str, num_tags: int):
+        self.dir        = Path(folder) / CACHE_DIRNAME
+        self.data_path  = self.dir / f"probs-{store_id}.f16"
+        self.index_path = self.dir / f"probs-{store_id}.json"
+        self.num_tags   = num_tags
+        self._index: dict[str, list[int]] = {}
+        self._rows  = 0
+        self._dirty = False
+        self._mmap: Optional[np.memmap] = None
+        self._load()
+
+    @property
+    def _row_bytes(self) -> int:
+        return 2 * self.num_tags
+
+    def _load(self) -> None:
+        try:
+            meta = json.loads(self.index_path.read_text(encoding="utf-8"))
+            size = self.data_path.stat().st_size
+        except (OSError, ValueError):
+            return
+        if meta.get("num_tags") != self.num_tags:
+            return
+        self._rows  = size // self._row_bytes
+        self._index = {k: v for k, v in meta.get("entries", {}).items() if v[0] < self._rows}
+
+    @staticmethod
+    def _stamp(path: Path) -> list[int]:
+        st = path.stat()
+        return [st.st_mtime_ns, st.st_size]
+
+    def has(self, path: Path) -> bool:
+        entry = self._index.get(path.name)
+        try:
+            return entry is not None and entry[1:] == self._stamp(path)
+        except OSError:
+            return False
+
+    def get(self, path: Path) -> Optional[np.ndarray]:
+        if not self.has(path):
+            return None
+        if self._mmap is None:
+            self._mmap = np.memmap(self.data_path, dtype=np.float16, mode="r",
+                                   shape=(self._rows, self.num_tags))
+        return np.asarray(self._mmap[self._index[path.name][0]], dtype=np.float32)
+
+    def put(self, paths: list[Path], probs: list[np.ndarray]) -> None:
+        if not paths:
+            return
+        self.dir.mkdir(exist_ok=True)
+        self._mmap = None
+        mode = "ab" if self._index else "wb"       # no valid index → start over
+        with open(self.data_path, mode) as f:
+            if mode == "ab":
+                f.truncate(self._rows * self._row_bytes)   # drop a torn tail row
+            f.write(np.asarray(probs, dtype=np.float16).tobytes())
+        if mode == "wb":
+            self._rows = 0
+        for i, path in enumerate(paths):
+            self._index[path.name] = [self._rows + i] + self._stamp(path)
+        self._rows += len(paths)
+        self._dirty = True
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        if self._rows > 2 * len(self._index) + 64:
+            self._compact()
+        meta = {"num_tags": self.num_tags, "entries": self._index}
+        tmp = self.index_path.with_suffix(".json.tmp")
+        tmp.write_text(json.dumps(meta), encoding="utf-8")
+        os.replace(tmp, self.index_path)
+        self._dirty = False
+
+    def _compact(self) -> None:
+        """Rewrite the data file with live rows only."""
+        live = sorted(self._index.items(), key=lambda kv: kv[1][0])
+        old = np.memmap(self.data_path, dtype=np.float16, mode="r",
+                        shape=(self._rows, self.num_tags))
+        data = np.array(old[[entry[0] for _, entry in live]]) if live else np.empty((0, self.num_tags), np.float16)
+        del old
+        self._mmap = None
+        tmp = self.data_path.with_suffix(".f16.tmp")
+        data.tofile(tmp)
+        os.replace(tmp, self.data_path)
+        self._index = {name: [row] + entry[1:] for row, (name, entry) in enumerate(live)}
+        self._rows = len(live)
+
+
+class ProbabilityCache:
+    """
+    ProbabilityStore per image folder for one model and preprocessing.
+    alpha_to_white changes the input tensor of transparent images, so each
+    setting keeps its own store.  Cache failures (e.g. a read-only dataset)
+    never fail a tagging run – the cache just switches off.
+    """
+
+    def __init__(self, model: "LoadedModel", alpha_to_white: bool = False, enabled: bool = True):
+        self.model    = model
+        self.enabled  = enabled
+        self.store_id = model.model_id + ("-white" if alpha_to_white else "")
+        self._stores: dict[Path, ProbabilityStore] = {}
+
+    def _store(self, path: Path) -> ProbabilityStore:
+        folder = path.parent
+        if folder not in self._stores:
+            self._stores[folder] = ProbabilityStore(folder, self.store_id, len(self.model.tags_df))
+        return self._stores[folder]
+
+    def has(self, path: Path) -> bool:
+        return self.enabled and self._store(path).has(path)
+
+    def get(self, path: Path) -> Optional[np.ndarray]:
+        return self._store(path).get(path) if self.enabled else None
+
+    def put(self, paths: list[Path], probs: list[np.ndarray]) -> None:
+        if not self.enabled:
+            return
+        by_folder: dict[Path, tuple[list, list]] = {}
+        for path, row in zip(paths, probs):
+            group = by_folder.setdefault(path.parent, ([], []))
+            group[0].append(path)
+            group[1].append(row)
+        try:
+            for folder_paths, rows in by_folder.values():
+                self._store(folder_paths[0]).put(folder_paths, rows)
+        except OSError:
+            self.enabled = False
+
+    def save(self) -> None:
+        for store in self._stores.values():
+            try:
+                store.save()
+            except OSError:
+                pass
+
+
+# ──────────────────────────────────────────────────────────────
+#  Incremental tagging
+# ──────────────────────────────────────────────────────────────
+
+class TaggingManifest:
+    """
+    What was tagged, per folder, for one model:
+
+        <folder>/.tktagger/manifest-<model_id>.json
+        {filename: [mtime_ns, size, sha1 | null, settings_key]}
+
+    An image matches when it was tagged with the same settings and its
+    content is unchanged – mtime/size equal, or (after a copy / touch) the
+    same SHA-1.  record() stores the SHA-1 with every entry, reusing the one
+    of an unchanged entry or one matches() just computed; the image was read
+    for inference a moment before, so hashing it hits the OS page cache.
+    matches() only hashes when the size matches but the mtime does not.
+    Failures to read or write the manifest are ignored.
+    """
+
+    def __init__(self, model_id: str, settings_key: str):
+        self.model_id = model_id
+        self.settings_key = settings_key
+        self._folders: dict[Path, dict[str, list]] = {}
+        self._dirty: set[Path] = set()
+        self._hashes: dict[Path, str] = {}      # computed by matches(), reused by record()
+
+    def _path(self, folder: Path) -> Path:
+        return folder / CACHE_DIRNAME / f"manifest-{self.model_id}.json"
+
+    def _entries(self, folder: Path) -> dict[str, list]:
+        if folder not in self._folders:
+            try:
+                self._folders[folder] = json.loads(self._path(folder).read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                self._folders[folder] = {}
+        return self._folders[folder]
+
+    def matches(self, path: Path) -> bool:
+        entry = self._entries(path.parent).get(path.name)
+        if not entry or entry[3] != self.settings_key:
+            return False
+        try:
+            st = path.stat()
+            if [st.st_mtime_ns, st.st_size] == entry[:2]:
+                return True
+            if st.st_size != entry[1]:
+                return False
+            digest = self._hashes[path] = _file_sha1(path)
+        except OSError:
+            return False
+        if digest != entry[2]:
+            return False
+        del self._hashes[path]
+        entry[0] = st.st_mtime_ns           # touched only: next run matches on mtime again
+        self._dirty.add(path.parent)
+        return True
+
+    def record(self, path: Path) -> None:
+        entries = self._entries(path.parent)
+        old = entries.get(path.name)
+        try:
+            st = path.stat()
+            digest = self._hashes.pop(path, None)
+            if digest is None and old and old[:2] == [st.st_mtime_ns, st.st_size]:
+                digest = old[2]
+            if digest is None:
+                digest = _file_sha1(path)
+        except OSError:
+            return
+        entries[path.name] = [st.st_mtime_ns, st.st_size, digest, self.settings_key]
+        self._dirty.add(path.parent)
+
+    def save(self) -> None:
+        for folder in self._dirty:
+            target = self._path(folder)
+            try:
+                target.parent.mkdir(exist_ok=True)
+                tmp = target.with_suffix(".json.tmp")
+                tmp.write_text(json.dumps(self._folders[folder]), encoding="utf-8")
+                os.replace(tmp, target)
+            except OSError:
+                pass
+        self._dirty.clear()
+
+
+def _file_sha1(path: Path) -> str:
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _settings_key(options: "DecodeOptions", config: dict) -> str:
+    """Everything besides the model that changes what ends up in the caption."""
+    key = (
+        options,
+        config.get("ext", ".txt"),
+        config.get("separator", ", "),
+        bool(config.get("append_tags", False)),
+        bool(config.get("alpha_to_white", False)),
+    )
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+
+
+def _is_up_to_date(img_path: Path, manifest: TaggingManifest, config: dict) -> bool:
+    """
+    only_new mode: True when the caption already exists and is either newer
+    than the image, or the manifest says the same content was tagged with
+    the same model and settings.  A deleted caption is always re-tagged.
+    """
+    caption = _caption_path(img_path, config)
+    try:
+        if caption.stat().st_mtime_ns >= img_path.stat().st_mtime_ns:
+            return True
+    except OSError:
+        return False
+    return manifest.matches(img_path)
+
+
+def _chunks(hits: list[bool], batch_size: int, max_len: int = 256) -> Iterator[list[int]]:
+    """
+    Group image indices so every chunk holds at most *batch_size* images that
+    need inference (cache misses); cached images just ride along, up to
+    *max_len* per chunk, and are decoded in the same vectorised pass.
+    """
+    chunk: list[int] = []
+    misses = 0
+    for idx, hit in enumerate(hits):
+        chunk.append(idx)
+        misses += not hit
+        if misses >= batch_size or len(chunk) >= max(max_len, batch_size):
+            yield chunk
+            chunk, misses = [], 0
+    if chunk:
+        yield chunk
+
+
+# ──────────────────────────────────────────────────────────────
+#  Jobs (cancel / pause / resume)
+# ──────────────────────────────────────────────────────────────
+
+class TaggingJob:
+    """
+    Handle for one tagging run that another thread (the UI) can control:
+
+        job = TaggingJob(config, progress_cb)
+        Thread(target=lambda: [apply(c) for c in job]).start()
+        job.pause(); job.resume(); job.cancel()
+
+    Requests take effect between chunks, so the current batch is always
+    finished and written.  Completed images are checkpointed; starting a
+    job with the same folder, model and settings again skips them, and
+    the checkpoint is removed once a run completes.
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        progress_cb: Optional[Callable[[int, int, str], None]] = None,
+    ):
+        self.config = config
+        self.progress_cb = progress_cb
+        self._cancelled = threading.Event()
+        self._running = threading.Event()
+        self._running.set()
+
+    def __iter__(self) -> Iterator[list[dict]]:
+        if self.config.get("mode") == "api":
+            return iter_tagger_api(self.config, self.progress_cb, job=self)
+        return iter_tagger(self.config, self.progress_cb, job=self)
+
+    def run(self) -> list[dict]:
+        """Blocking run, same result list as run_tagger."""
+        return [item for chunk in self for item in chunk]
+
+    def cancel(self) -> None:
+        self._cancelled.set()
+        self._running.set()          # wake a paused run so it can stop
+
+    def pause(self) -> None:
+        if not self._cancelled.is_set():
+            self._running.clear()
+
+    def resume(self) -> None:
+        self._running.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._running.is_set()
+
+    def wait(self) -> bool:
+        """Block while paused; False once the job has been cancelled."""
+        self._running.wait()
+        return not self._cancelled.is_set()
+
+
+class TaggingCheckpoint:
+    """
+    Images finished by an interrupted job, one path per line relative to
+    the scanned folder:
+
+        <folder>/.tktagger/checkpoint-<job_id>.txt
+
+    The job id covers the folder, scope, model and caption settings, so
+    only the same job resumes from it.  Lines are appended and flushed per
+    chunk; a torn last line just names no image.
+    """
+
+    def __init__(self, config: dict, model_id: str, settings_key: str):
+        include_sub = bool(config.get("include_subfolders", False))
+        target = Path(config.get("target_folder", ""))
+        root = Path(config.get("root_folder", target))
+        self.base = root if include_sub and root.is_dir() else target
+        key = (str(self.base.resolve()), include_sub, model_id, settings_key,
+               bool(config.get("only_new")))
+        self.job_id = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+        self.path = self.base / CACHE_DIRNAME / f"checkpoint-{self.job_id}.txt"
+        self._fh = None
+
+    def load(self) -> set[Path]:
+        try:
+            lines = self.path.read_text(encoding="utf-8").splitlines()
+        except OSError:
+            return set()
+        return {self.base / line for line in lines if line}
+
+    def add(self, paths) -> None:
+        lines = "".join(f"{p.relative_to(self.base).as_posix()}\n" for p in paths)
+        if not lines:
+            return
+        try:
+            if self._fh is None:
+                self.path.parent.mkdir(exist_ok=True)
+                self._fh = open(self.path, "a", encoding="utf-8")
+            self._fh.write(lines)
+            self._fh.flush()
+        except (OSError, ValueError):
+            pass
+
+    def close(self, discard: bool = False) -> None:
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if discard:
+            try:
+                self.path.unlink()
+            except OSError:
+                pass
+
+
 # ──────────────────────────────────────────────────────────────
 #  ONNX session
 # ──────────────────────────────────────────────────────────────
 
-def _load_session(onnx_path: str) -> "ort.InferenceSession":
-    providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
+@dataclass(frozen=True)
+class SessionProfile:
+    """
+    ONNX Runtime session settings taken from the tagger config (hashable, so
+    it is part of the model registry key).
+
+    Config keys:
+      providers              "auto" | "cpu" | "cuda" | [provider names…]
+      intra_op_threads       threads inside one operator (0 → ORT default)
+      inter_op_threads       threads across operators (0 → ORT default;
+                             > 1 switches to parallel execution mode)
+      graph_opt_level        "disable" | "basic" | "extended" | "all"
+      cache_optimized_model  serialize the optimised graph and reuse it on
+                             the next load (skips graph optimisation)
+      optimized_model_dir    where to keep it (default OPTIMIZED_MODEL_DIR)
+      cpu_mem_arena          ORT CPU memory arena on/off
+      mem_pattern            memory pattern planning on/off
+      arena_extend_strategy  CUDA arena growth: "kNextPowerOfTwo" | "kSameAsRequested"
+    """
+    providers:             tuple = DEFAULT_PROVIDERS
+    intra_op_threads:      int   = 0
+    inter_op_threads:      int   = 0
+    graph_opt_level:       str   = "all"
+    optimized_model_dir:   Optional[str] = None
+    cpu_mem_arena:         bool  = True
+    mem_pattern:           bool  = True
+    arena_extend_strategy: str   = "kNextPowerOfTwo"
+
+    @classmethod
+    def from_config(cls, config: dict) -> "SessionProfile":
+        level = str(config.get("graph_opt_level", "all")).lower()
+        opt_dir = config.get("optimized_model_dir") or (
+            str(OPTIMIZED_MODEL_DIR) if config.get("cache_optimized_model") else None
+        )
+        return cls(
+            providers             = _resolve_providers(config.get("providers", "auto")),
+            intra_op_threads      = max(0, int(config.get("intra_op_threads", 0) or 0)),
+            inter_op_threads      = max(0, int(config.get("inter_op_threads", 0) or 0)),
+            graph_opt_level       = level if level in GRAPH_OPT_LEVELS else "all",
+            optimized_model_dir   = opt_dir,
+            cpu_mem_arena         = bool(config.get("cpu_mem_arena", True)),
+            mem_pattern           = bool(config.get("mem_pattern", True)),
+            arena_extend_strategy = config.get("arena_extend_strategy", "kNextPowerOfTwo"),
+        )
+
+
+def available_providers() -> list[str]:
+    """Execution providers of the installed onnxruntime build."""
+    return list(ort.get_available_providers()) if _HAS_ORT else []
+
+
+def _resolve_providers(spec) -> tuple:
+    """
+    Turn the "providers" config value into an ordered provider tuple that
+    only contains providers this onnxruntime build has, always ending with
+    the CPU provider as last resort.
+    """
+    aliases = {
+        "auto": list(DEFAULT_PROVIDERS),
+        "cpu":  ["CPUExecutionProvider"],
+        "cuda": ["CUDAExecutionProvider", "CPUExecutionProvider"],
+    }
+    wanted = aliases.get(spec.lower(), [spec]) if isinstance(spec, str) else list(spec or [])
+    available = available_providers()
+    chosen = [p for p in wanted if not available or p in available]
+    if "CPUExecutionProvider" not in chosen:
+        chosen.append("CPUExecutionProvider")
+    return tuple(chosen)
+
+
+def _load_session(
+    onnx_path: str,
+    profile:   Optional[SessionProfile] = None,
+    model_id:  str = "",
+) -> "ort.InferenceSession":
+    profile = profile or SessionProfile()
+    levels = {
+        "disable":  ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic":    ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all":      ort.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }
+
+    opts = ort.SessionOptions()
+    if profile.intra_op_threads:
+        opts.intra_op_num_threads = profile.intra_op_threads
+    if profile.inter_op_threads:
+        opts.inter_op_num_threads = profile.inter_op_threads
+        if profile.inter_op_threads > 1:
+            opts.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+    opts.graph_optimization_level = levels[profile.graph_opt_level]
+    opts.enable_cpu_mem_arena = profile.cpu_mem_arena
+    opts.enable_mem_pattern = profile.mem_pattern
+
+    providers = list(profile.providers)
+    provider_options = [
+        {"arena_extend_strategy": profile.arena_extend_strategy}
+        if p == "CUDAExecutionProvider" else {}
+        for p in providers
+    ]
+
+    # Optimised-graph cache: the serialized graph is provider specific at the
+    # higher levels, so the file name carries both level and provider.
+    model_path = onnx_path
+    if profile.optimized_model_dir and profile.graph_opt_level != "disable":
+        cache_dir = Path(profile.optimized_model_dir)
+        tag = providers[0].replace("ExecutionProvider", "").lower()
+        cached = cache_dir / f"{model_id or Path(onnx_path).stem}-{profile.graph_opt_level}-{tag}.onnx"
+        if cached.is_file():
+            model_path = str(cached)
+            opts.graph_optimization_level = levels["disable"]
+        else:
+            try:
+                cache_dir.mkdir(parents=True, exist_ok=True)
+                opts.optimized_model_filepath = str(cached)
+            except OSError:
+                pass
+
     try:
-        return ort.InferenceSession(onnx_path, providers=providers)
+        return ort.InferenceSession(model_path, sess_options=opts,
+                                    providers=providers, provider_options=provider_options)
     except Exception:
+        if model_path != onnx_path:
+            # Unusable cached graph (other ORT version…) → rebuild from source
+            Path(model_path).unlink(missing_ok=True)
+            return _load_session(onnx_path, profile, model_id)
         # Fallback to CPU only
-        return ort.InferenceSession(onnx_path, providers=["CPUExecutionProvider"])
+        return ort.InferenceSession(onnx_path, sess_options=opts, providers=["CPUExecutionProvider"])
+
+
+def _effective_batch_size(session: "ort.InferenceSession", config: dict) -> int:
+    """
+    Requested batch size, clamped to the model's batch dimension when the
+    graph was exported with a fixed one (e.g. shape [1, 448, 448, 3]).
+    """
+    batch_size = max(1, int(config.get("batch_size", 1) or 1))
+    dim = session.get_inputs()[0].shape[0]
+    if isinstance(dim, int) and dim > 0:
+        batch_size = min(batch_size, dim)
+    return batch_size
+
+
+def _run_batch(
+    session:    "ort.InferenceSession",
+    input_name: str,
+    tensors:    list[np.ndarray],
+    slots:      list[dict],
+) -> Optional[np.ndarray]:
+    """
+    Run one (N, H, W, 3) batch and return probabilities of shape (N, num_tags).
+
+    If the batched call fails, every image is retried on its own so an error
+    is reported only for the image that actually caused it (same as the
+    one-image-per-call behaviour).
+    """
+    if not tensors:
+        return None
+    try:
+        return session.run(None, {input_name: np.stack(tensors)})[0]
+    except Exception:
+        pass
+
+    rows: list[Optional[np.ndarray]] = []
+    for row, tensor in enumerate(tensors):
+        try:
+            rows.append(session.run(None, {input_name: tensor[np.newaxis]})[0][0])
+        except Exception as exc:
+            rows.append(None)
+            for s in slots:
+                if s.get("row") == row:
+                    s["error"] = str(exc)
+    width = next((r.shape[0] for r in rows if r is not None), None)
+    if width is None:
+        return None
+    return np.stack([r if r is not None else np.zeros(width, dtype=np.float32) for r in rows])
+
+
+# ──────────────────────────────────────────────────────────────
+#  Multi-process sharding
+# ──────────────────────────────────────────────────────────────
+
+def _iter_sharded_probs(
+    image_paths: list[Path],
+    config:      dict,
+    batch_size:  int,
+    processes:   int,
+    model:       LoadedModel,
+) -> Iterator[tuple[Path, Optional[np.ndarray], Optional[str]]]:
+    """
+    Yield (path, probs, error) for every image, in input order, computed by
+    *processes* worker processes that each load their own ONNX session.
+
+    The images are cut into tasks of *batch_size* on one shared queue; a
+    worker takes the next task as soon as it is done with its last one, so
+    fast and slow workers stay balanced without a static split.  Only a few
+    tasks per worker are queued at a time, results are re-ordered here, and
+    caption writing / caches stay in the calling process.
+    """
+    ctx = multiprocessing.get_context("spawn")     # safe next to Qt / threads
+    tasks, results = ctx.Queue(), ctx.Queue()
+    # claims[i] = task id worker i is working on (-1 = none); shared memory, so
+    # it is still readable after the worker crashes
+    claims = ctx.Array("l", [-1] * processes, lock=False)
+    worker_config = _worker_config(config, processes, model)
+    cpu_sets = _cpu_shards(processes) if config.get("pin_processes", True) else None
+    procs = [
+        ctx.Process(
+            target=_shard_worker,
+            args=(worker_config, cpu_sets[i] if cpu_sets else None, tasks, results, claims, i),
+            name=f"tktagger-shard-{i}",
+            daemon=True,
+        )
+        for i in range(processes)
+    ]
+    for proc in procs:
+        proc.start()
+
+    shards = [image_paths[i:i + batch_size] for i in range(0, len(image_paths), batch_size)]
+    in_flight = 2 * processes + 2
+    submitted = 0
+    pending: set[int] = set()       # submitted task ids with no result yet
+    done: dict[int, list] = {}
+    finished = False
+    try:
+        for task_id, shard in enumerate(shards):
+            while submitted < len(shards) and submitted < task_id + in_flight:
+                tasks.put((submitted, [str(p) for p in shards[submitted]]))
+                pending.add(submitted)
+                submitted += 1
+            while task_id not in done:
+                tid, payload = _next_result(results, procs, claims, pending)
+                if tid < 0:
+                    raise RuntimeError(f"Tagger worker failed: {payload}")
+                pending.discard(tid)
+                done[tid] = payload
+            for path, (row, error) in zip(shard, done.pop(task_id)):
+                yield path, row, error
+        finished = True
+    finally:
+        for _ in procs:
+            tasks.put(None)
+        for proc in procs:
+            proc.join(timeout=10 if finished else 0.5)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        for q in (tasks, results):
+            q.cancel_join_thread()
+            q.close()
+
+
+def _next_result(results, procs, claims, pending: set[int]) -> tuple[int, object]:
+    """
+    Next (task_id, payload) from the workers.
+
+    Fails as soon as a worker has died with unfinished work (killed, crashed
+    or holding a task in *pending*); otherwise the task it took would never
+    arrive and the caller would wait forever.
+    """
+    while True:
+        try:
+            return results.get(timeout=1.0)
+        except queue.Empty:
+            pass
+        for worker, proc in enumerate(procs):
+            if proc.is_alive():
+                continue
+            if proc.exitcode != 0 or claims[worker] in pending:
+                task = claims[worker]
+                return -1, (f"{proc.name} exited with code {proc.exitcode}"
+                            + (f" while processing task {task}" if task in pending else ""))
+        if not any(proc.is_alive() for proc in procs):
+            return -1, "all worker processes exited unexpectedly"
+
+
+def _worker_config(config: dict, processes: int, model: LoadedModel) -> dict:
+    """
+    Config for one worker: the already resolved model files, and a share of
+    the machine's cores as ONNX / loader thread budget (explicit values win).
+    """
+    share = max(1, (os.cpu_count() or 1) // processes)
+    loaders = int(config.get("max_data_loader_n_workers", DEFAULT_LOADER_WORKERS))
+    return {
+        **config,
+        "onnx_path":         model.onnx_path,
+        "csv_path":          model.csv_path,
+        "force_download":    False,
+        "intra_op_threads":  int(config.get("intra_op_threads") or 0) or share,
+        "inter_op_threads":  int(config.get("inter_op_threads") or 0) or 1,
+        "max_data_loader_n_workers": min(max(1, loaders // processes), share) if loaders > 0 else 0,
+    }
+
+
+def _cpu_shards(processes: int) -> Optional[list[set[int]]]:
+    """
+    Split the usable CPUs into *processes* contiguous ranges (consecutive ids
+    usually share a socket), or None where affinity can't be set.
+    """
+    if not hasattr(os, "sched_getaffinity"):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    if len(cpus) < processes:
+        return None
+    step = len(cpus) / processes
+    return [set(cpus[round(i * step):round((i + 1) * step)]) for i in range(processes)]
+
+
+def _shard_worker(config: dict, cpus: Optional[set[int]], tasks, results, claims, worker: int) -> None:
+    """
+    Worker process: (task_id, [paths]) → (task_id, [(probs|None, error|None)]).
+
+    The task being worked on is recorded in claims[worker] so the parent can
+    tell which task was lost if this process dies.
+    """
+    if cpus:
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError:
+            pass
+    try:
+        model = MODEL_REGISTRY.get(config)
+        session = model.session
+        batch_size = _effective_batch_size(session, config)
+    except Exception as exc:
+        results.put((-1, f"{type(exc).__name__}: {exc}"))
+        return
+
+    for task_id, paths in iter(tasks.get, None):
+        claims[worker] = task_id
+        out: list[tuple] = []
+        stream = _iter_preprocessed(paths, config, batch_size)
+        for _ in range(0, len(paths), batch_size):
+            slots, tensors = [], []
+            for _, tensor, error in islice(stream, batch_size):
+                slot = {"error": None if error is None else str(error)}
+                if error is None:
+                    tensors.append(tensor)
+                    slot["row"] = len(tensors) - 1
+                slots.append(slot)
+            probs = _run_batch(session, model.input_name, tensors, slots)
+            for slot in slots:
+                ok = probs is not None and slot["error"] is None and "row" in slot
+                out.append((probs[slot["row"]] if ok else None, slot["error"]))
+        results.put((task_id, out))
+    claims[worker] = -1
 
 
 # ──────────────────────────────────────────────────────────────
 #  Image pre-processing
 # ──────────────────────────────────────────────────────────────
 
-def _flatten_alpha(src: Path, tmp_dir: Path) -> Path:
+def _iter_preprocessed(
+    image_paths: list[Path],
+    config:      dict,
+    batch_size:  int = 1,
+) -> Iterator[tuple[Path, Optional[np.ndarray], Optional[Exception]]]:
     """
-    If *src* has an alpha channel, composite it over white and save
-    a JPEG/PNG to *tmp_dir*.  Returns the work path.
-    If no alpha, returns *src* unchanged.
+    Yield (path, tensor, error) for every image, in input order.
+
+    Decoding runs on a pool of *max_data_loader_n_workers* threads (PIL
+    releases the GIL while decoding and resizing) and stays at most
+    two batches ahead of the consumer, so memory is bounded no matter how
+    large the folder is.  0 workers → decode inline on the calling thread.
     """
-    with Image.open(src) as img:
-        if img.mode not in ("RGBA", "LA") and not (
-            img.mode == "P" and "transparency" in img.info
-        ):
-            return src   # no alpha, nothing to do
+    alpha = bool(config.get("alpha_to_white"))
 
-        # Convert to RGBA to handle palette transparency
-        img = img.convert("RGBA")
-        background = Image.new("RGBA", img.size, (255, 255, 255, 255))
-        background.paste(img, mask=img.split()[3])   # alpha as mask
-        flat = background.convert("RGB")
+    def load(path: Path) -> np.ndarray:
+        return _preprocess_image(path, alpha_to_white=alpha)
 
-        dest = tmp_dir / (src.stem + "_flat.png")
-        flat.save(dest, format="PNG")
-        return dest
+    workers = int(config.get("max_data_loader_n_workers", DEFAULT_LOADER_WORKERS))
+    if workers <= 0:
+        for path in map(Path, image_paths):
+            try:
+                yield path, load(path), None
+            except Exception as exc:
+                yield path, None, exc
+        return
+
+    prefetch = max(2 * batch_size, 2 * workers)
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tktagger-loader")
+    try:
+        pending: deque = deque()
+        todo = iter(map(Path, image_paths))
+        for path in islice(todo, prefetch):
+            pending.append((path, pool.submit(load, path)))
+
+        while pending:
+            path, future = pending.popleft()
+            nxt = next(todo, None)
+            if nxt is not None:
+                pending.append((nxt, pool.submit(load, nxt)))
+            try:
+                yield path, future.result(), None
+            except Exception as exc:
+                yield path, None, exc
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
 
 
-def _preprocess_image(path: Path) -> np.ndarray:
+def _flatten_alpha(img: Image.Image) -> Image.Image:
+    """
+    If *img* has an alpha channel, composite it over white and return
+    the RGB result.  If no alpha, returns *img* unchanged.
     """
-    Load image, resize to MODEL_INPUT_SIZE×MODEL_INPUT_SIZE,
-    convert to float32 RGB, return shape (1, H, W, 3).
+    if img.mode not in ("RGBA", "LA") and not (
+        img.mode == "P" and "transparency" in img.info
+    ):
+        return img   # no alpha, nothing to do
+
+    # Convert to RGBA to handle palette transparency
+    img = img.convert("RGBA")
+    background = Image.new("RGB", img.size, (255, 255, 255))
+    background.paste(img, mask=img.getchannel("A"))   # alpha as mask
+    return background
+
+
+def _preprocess_image(path: Path, alpha_to_white: bool = False) -> np.ndarray:
+    """
+    Load image, optionally flatten alpha onto white, resize to
+    MODEL_INPUT_SIZE×MODEL_INPUT_SIZE, convert to float32 RGB,
+    return shape (H, W, 3) – callers stack several of these into
+    one (N, H, W, 3) batch.
     WD14 expects BGR channel order (OpenCV convention).
     """
     with Image.open(path) as img:
+        if alpha_to_white:
+            img = _flatten_alpha(img)
         img = img.convert("RGB")
 
         # Pad to square then resize (preserve aspect ratio with padding)
@@ -384,8 +1666,7 @@ def _preprocess_image(path: Path) -> np.ndarray:
 
         arr = np.array(img, dtype=np.float32)        # H,W,3  RGB
         arr = arr[:, :, ::-1]                        # RGB → BGR
-        arr = np.expand_dims(arr, axis=0)            # 1,H,W,3
-    return arr
+    return np.ascontiguousarray(arr)
 
 
 def _pad_to_square(img: Image.Image, fill: int = 255) -> Image.Image:
@@ -402,76 +1683,126 @@ def _pad_to_square(img: Image.Image, fill: int = 255) -> Image.Image:
 #  Tag decoding
 # ──────────────────────────────────────────────────────────────
 
-def _decode_tags(
-    probs:        np.ndarray,
-    tags_df:      list[dict],
-    rating_idxs:  list[int],
-    general_idxs: list[int],
-    char_idxs:    list[int],
-    config:       dict,
-) -> list[str]:
-    gen_thresh  = float(config.get("gen_threshold",  0.35))
-    char_thresh = float(config.get("char_threshold", 0.35))
-    remove_us   = config.get("remove_underscore", True)
-    char_expand = config.get("char_expand", False)
-    use_rating  = config.get("use_rating", False)
-    rating_last = config.get("rating_as_last", False)
-    undesired   = set(config.get("undesired_tags", []))
-    prefix_tags = list(config.get("prefix_tags", []))
-    rep_map     = config.get("replacement_map", {})
-
-    # ── character tags ────────────────────────────
-    char_tags: list[str] = []
-    for i in char_idxs:
-        if probs[i] >= char_thresh:
-            name = _clean_tag(tags_df[i]["name"], remove_us)
+@dataclass(frozen=True)
+class DecodeOptions:
+    """Tag post-processing settings taken from the tagger config (hashable)."""
+    gen_threshold:     float = 0.35
+    char_threshold:    float = 0.35
+    remove_underscore: bool  = True
+    char_expand:       bool  = False
+    use_rating:        bool  = False
+    rating_as_last:    bool  = False
+    undesired:         frozenset = field(default_factory=frozenset)
+    prefix_tags:       tuple = ()
+    replacement:       tuple = ()      # sorted (old, new) pairs
+
+    @classmethod
+    def from_config(cls, config: dict) -> "DecodeOptions":
+        return cls(
+            gen_threshold     = float(config.get("gen_threshold",  0.35)),
+            char_threshold    = float(config.get("char_threshold", 0.35)),
+            remove_underscore = bool(config.get("remove_underscore", True)),
+            char_expand       = bool(config.get("char_expand", False)),
+            use_rating        = bool(config.get("use_rating", False)),
+            rating_as_last    = bool(config.get("rating_as_last", False)),
+            undesired         = frozenset(config.get("undesired_tags", [])),
+            prefix_tags       = tuple(config.get("prefix_tags", [])),
+            replacement       = tuple(sorted((config.get("replacement_map") or {}).items())),
+        )
+
+
+class TagDecoder:
+    """
+    WD14 decoder built once per model (selected_tags.csv).
+
+    Holds NumPy index arrays per category and, per DecodeOptions, a plan of
+    output names with replacement and undesired tags already applied, so a
+    whole batch of probability rows is thresholded with one vectorised
+    mask per category and no tag name is cleaned twice.
+    """
+
+    def __init__(self, tags_df: list[dict]):
+        self.names = [t["name"] for t in tags_df]
+        rating_idxs, general_idxs, char_idxs = _split_tag_indices(tags_df)
+        self.rating_idxs  = np.asarray(rating_idxs,  dtype=np.intp)
+        self.general_idxs = np.asarray(general_idxs, dtype=np.intp)
+        self.char_idxs    = np.asarray(char_idxs,    dtype=np.intp)
+        self._name_tables: dict[tuple[bool, bool], tuple[list[str], list[str]]] = {}
+        self._plans: dict[DecodeOptions, tuple] = {}
+
+    def name_table(self, remove_underscore: bool, char_expand: bool) -> tuple[list[str], list[str]]:
+        """Cleaned (character names, general names), cached per setting."""
+        key = (remove_underscore, char_expand)
+        if key not in self._name_tables:
+            chars = [_clean_tag(self.names[i], remove_underscore) for i in self.char_idxs]
             if char_expand:
-                name = _expand_parens(name)
-            char_tags.append(name)
-
-    # ── general tags ──────────────────────────────
-    gen_tags: list[str] = []
-    for i in general_idxs:
-        if probs[i] >= gen_thresh:
-            name = _clean_tag(tags_df[i]["name"], remove_us)
-            gen_tags.append(name)
-
-    # ── rating tag ────────────────────────────────
-    rating_tag: list[str] = []
-    if use_rating and rating_idxs:
-        best_idx = max(rating_idxs, key=lambda i: probs[i])
-        raw_name = tags_df[best_idx]["name"]
-        rating_tag = [RATING_TAGS.get(raw_name, raw_name)]
-
-    # ── assemble ──────────────────────────────────
-    all_tags: list[str] = char_tags + gen_tags
-    if use_rating and not rating_last:
-        all_tags = rating_tag + all_tags
-    elif use_rating and rating_last:
-        all_tags = all_tags + rating_tag
-
-    # Apply replacement map
-    all_tags = [rep_map.get(t, t) for t in all_tags]
-
-    # Remove undesired
-    all_tags = [t for t in all_tags if t not in undesired]
-
-    # Deduplicate while preserving order
-    seen: set[str] = set()
-    deduped: list[str] = []
-    for t in all_tags:
-        if t not in seen:
-            seen.add(t)
-            deduped.append(t)
-
-    # Prepend prefix tags
-    result: list[str] = []
-    for p in prefix_tags:
-        if p and p not in seen:
-            result.append(p)
-    result.extend(deduped)
-
-    return result
+                chars = [_expand_parens(n) for n in chars]
+            general = [_clean_tag(self.names[i], remove_underscore) for i in self.general_idxs]
+            self._name_tables[key] = (chars, general)
+        return self._name_tables[key]
+
+    def _plan(self, opts: DecodeOptions) -> tuple:
+        """
+        (char_idx, char_out, gen_idx, gen_out, rating_out) for *opts*:
+        label indices that survive the undesired filter and their final
+        output names after replacement.
+        """
+        plan = self._plans.get(opts)
+        if plan is not None:
+            return plan
+
+        rep_map = dict(opts.replacement)
+        chars, general = self.name_table(opts.remove_underscore, opts.char_expand)
+
+        def keep(idxs: np.ndarray, names: list[str]) -> tuple[np.ndarray, np.ndarray]:
+            final = [rep_map.get(n, n) for n in names]
+            mask = np.fromiter((n not in opts.undesired for n in final), dtype=bool, count=len(final))
+            return idxs[mask], np.array(final, dtype=object)[mask]
+
+        char_idx, char_out = keep(self.char_idxs, chars)
+        gen_idx,  gen_out  = keep(self.general_idxs, general)
+
+        rating_out: dict[int, str] = {}
+        for i in self.rating_idxs:
+            name = RATING_TAGS.get(self.names[i], self.names[i])
+            name = rep_map.get(name, name)
+            if name not in opts.undesired:
+                rating_out[int(i)] = name
+
+        plan = (char_idx, char_out, gen_idx, gen_out, rating_out)
+        self._plans[opts] = plan
+        return plan
+
+    def decode(self, probs: np.ndarray, opts: DecodeOptions) -> list[list[str]]:
+        """Decode probability rows, shape (N, num_tags), into N tag lists."""
+        probs = np.atleast_2d(probs)
+        n = probs.shape[0]
+        char_idx, char_out, gen_idx, gen_out, rating_out = self._plan(opts)
+
+        def hits(idx: np.ndarray, names: np.ndarray, thresh: float) -> list[list[str]]:
+            rows, cols = np.nonzero(probs[:, idx] >= thresh)
+            bounds = np.searchsorted(rows, np.arange(n + 1))
+            return [names[cols[bounds[r]:bounds[r + 1]]].tolist() for r in range(n)]
+
+        char_hits = hits(char_idx, char_out, opts.char_threshold)
+        gen_hits  = hits(gen_idx,  gen_out,  opts.gen_threshold)
+
+        ratings: list[list[str]] = [[] for _ in range(n)]
+        if opts.use_rating and self.rating_idxs.size:
+            best = self.rating_idxs[probs[:, self.rating_idxs].argmax(axis=1)]
+            ratings = [[rating_out[int(i)]] if int(i) in rating_out else [] for i in best]
+
+        batch: list[list[str]] = []
+        for row in range(n):
+            all_tags = char_hits[row] + gen_hits[row]
+            if opts.use_rating:
+                all_tags = (all_tags + ratings[row]) if opts.rating_as_last else (ratings[row] + all_tags)
+
+            # Deduplicate while preserving order, then prepend prefix tags
+            deduped = list(dict.fromkeys(all_tags))
+            seen = set(deduped)
+            batch.append([p for p in opts.prefix_tags if p and p not in seen] + deduped)
+        return batch
 
 
 def _clean_tag(name: str, remove_underscore: bool) -> str:
@@ -503,6 +1834,11 @@ def _caption_path(img_path: Path, config: dict) -> Path:
     return img_path.parent / filename
 
 
+def _read_caption(path: Path) -> list[str]:
+    content = path.read_text(encoding="utf-8").strip()
+    return [tag.strip() for tag in content.split(",") if tag.strip()]
+
+
 def _write_caption(
     out_path: Path,
     tags:     list[str],
@@ -521,7 +1857,18 @@ def _write_caption(
     else:
         content = sep.join(tags)
 
-    out_path.write_text(content, encoding="utf-8")
+    # Write to a temp file next to the caption and swap it in, so an
+    # interrupted run never leaves a half-written caption behind.
+    tmp = out_path.with_name(f".{out_path.name}.tmp")
+    try:
+        tmp.write_text(content, encoding="utf-8")
+        os.replace(tmp, out_path)
+    except BaseException:
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+        raise
 
 
 # ──────────────────────────────────────────────────────────────
@@ -542,7 +1889,8 @@ def _collect_images(config: dict) -> list[Path]:
     if include_sub:
         base = root_folder if root_folder.is_dir() else target_folder
         paths: list[Path] = []
-        for dirpath, _dirs, files in os.walk(base):
+        for dirpath, dirs, files in os.walk(base):
+            dirs[:] = [d for d in dirs if d != CACHE_DIRNAME]
             for f in sorted(files):
                 p = Path(dirpath) / f
                 if p.suffix.lower() in IMAGE_EXTENSIONS:
@@ -570,6 +1918,20 @@ def check_dependencies() -> dict[str, bool]:
     }
 
 
+def get_diagnostics() -> dict:
+    """
+    Runtime details for the UI / bug reports: onnxruntime build, available
+    execution providers and the models currently kept by the registry.
+    """
+    return {
+        "dependencies":        check_dependencies(),
+        "onnxruntime_version": ort.__version__ if _HAS_ORT else None,
+        "device":              ort.get_device() if _HAS_ORT else None,
+        "available_providers": available_providers(),
+        "loaded_models":       MODEL_REGISTRY.describe(),
+    }
+
+
 # ──────────────────────────────────────────────────────────────
 #  Quick CLI test
 # ──────────────────────────────────────────────────────────────
@@ -588,6 +1950,14 @@ if __name__ == "__main__":
         "target_folder":      sys.argv[1] if len(sys.argv) > 1 else ".",
         "root_folder":        sys.argv[1] if len(sys.argv) > 1 else ".",
         "include_subfolders": False,
+        "batch_size":         4,
+        "max_data_loader_n_workers": 4,
+        "num_processes":      1,
+        "prob_cache":         True,
+        "only_new":           False,
+        "providers":          "auto",
+        "intra_op_threads":   0,
+        "graph_opt_level":    "all",
         "gen_threshold":      0.35,
         "char_threshold":     0.35,
         "char_expand":        False,
@@ -603,5 +1973,6 @@ if __name__ == "__main__":
     def progress(cur, total, msg):
         print(f"[{cur}/{total}] {msg}")
 
+    print(json.dumps(get_diagnostics(), indent=2))
     results = run_tagger(test_config, progress_cb=progress)
     print(json.dumps(results, indent=2, ensure_ascii=False))
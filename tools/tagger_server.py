@@ -0,0 +1,193 @@
+"""
+tagger_server.py
+────────────────
+Local stand-in for a remote WD14 tagging service.  Implements the contract
+used by tagger_logic.HttpTaggerBackend, so the API path of the Waifu Tagger
+can be tested and benchmarked offline:
+
+    GET  /health → {"ok": true, "model": str, "max_batch": int}
+    POST /tag    {"options": {...}, "images": [{"name": str, "data": base64}]}
+               → {"results": [{"tags": [str], "error": str | null}]}
+                 (413 if more than max_batch images)
+
+Two modes:
+  - mock (default): deterministic fake model outputs derived from the image
+    bytes, optional artificial latency per request – no model needed.
+  - model: --onnx/--csv given → real WD14 inference through tagger_logic
+    (same pre-processing as local mode).
+
+Both decode with tagger_logic.TagDecoder and the client's option defaults,
+so the tag options give the same captions as local tagging.
+
+Usage:
+    python tools/tagger_server.py --port 7861
+    python tools/tagger_server.py --port 7861 --latency 0.05
+    python tools/tagger_server.py --onnx model.onnx --csv selected_tags.csv
+
+Then choose "External API", backend "TKtagger HTTP", URL http://127.0.0.1:7861
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import tagger_logic as tl                      # noqa: E402
+
+MOCK_VOCAB = (
+    "1girl", "solo", "long_hair", "short_hair", "smile", "blue_eyes", "red_eyes",
+    "blonde_hair", "black_hair", "dress", "school_uniform", "outdoors", "indoors",
+    "simple_background", "white_background", "looking_at_viewer", "open_mouth",
+)
+MOCK_RATINGS = ("general", "sensitive")
+
+
+class MockTagger:
+    """Fake model outputs chosen from the image hash – stable for the same file."""
+
+    name = "mock"
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.decoder = tl.TagDecoder(
+            [{"name": n, "category": 9} for n in MOCK_RATINGS]
+            + [{"name": n, "category": 0} for n in MOCK_VOCAB]
+        )
+
+    def tag(self, blobs: list[bytes], options: dict) -> list[dict]:
+        if self.latency:
+            time.sleep(self.latency)
+        if not blobs:
+            return []
+        probs = np.zeros((len(blobs), len(self.decoder.names)), dtype=np.float32)
+        for row, blob in enumerate(blobs):
+            digest = hashlib.sha1(blob).digest()
+            probs[row, 0 if digest[4] % 2 else 1] = 1.0
+            probs[row, [len(MOCK_RATINGS) + b % len(MOCK_VOCAB) for b in digest[:4]]] = 1.0
+        tag_lists = self.decoder.decode(probs, tl.DecodeOptions.from_config(options))
+        return [{"tags": tags, "error": None} for tags in tag_lists]
+
+
+class ModelTagger:
+    """Real inference with a local ONNX model (kept loaded for the server's life)."""
+
+    def __init__(self, onnx_path: str, csv_path: str | None):
+        self.model = tl.MODEL_REGISTRY.get({"onnx_path": onnx_path, "csv_path": csv_path})
+        self.name = os.path.basename(self.model.onnx_path)
+
+    def tag(self, blobs: list[bytes], options: dict) -> list[dict]:
+        alpha = bool(options.get("alpha_to_white", False))
+        slots, tensors = [], []
+        for blob in blobs:
+            slot = {"error": None}
+            try:
+                tensors.append(tl._preprocess_image(io.BytesIO(blob), alpha_to_white=alpha))
+                slot["row"] = len(tensors) - 1
+            except Exception as exc:
+                slot["error"] = str(exc)
+            slots.append(slot)
+
+        probs = tl._run_batch(self.model.session, self.model.input_name, tensors, slots)
+        ready = [s for s in slots if s["error"] is None and "row" in s and probs is not None]
+        tag_lists = self.model.decoder.decode(
+            probs[[s["row"] for s in ready]], tl.DecodeOptions.from_config(options)
+        ) if ready else []
+        for slot, tags in zip(ready, tag_lists):
+            slot["tags"] = tags
+        return [{"tags": s.get("tags", []), "error": s["error"]} for s in slots]
+
+
+def make_handler(tagger, max_batch: int):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"          # keep-alive, matches the pooled client
+
+        def _send(self, status: int, payload: dict) -> None:
+            body = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/health":
+                self._send(200, {"ok": True, "model": tagger.name, "max_batch": max_batch})
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/tag":
+                self._send(404, {"error": "not found"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length))
+                images = request.get("images", [])
+                if len(images) > max_batch:
+                    self._send(413, {"error": f"at most {max_batch} images per request"})
+                    return
+                blobs = [base64.b64decode(img["data"]) for img in images]
+                results = tagger.tag(blobs, request.get("options", {}))
+            except (ValueError, KeyError) as exc:
+                self._send(400, {"error": str(exc)})
+                return
+            except Exception as exc:
+                self._send(500, {"error": str(exc)})
+                return
+            self._send(200, {"results": results})
+
+        def log_message(self, fmt, *args):      # quiet unless --verbose
+            if self.server.verbose:
+                super().log_message(fmt, *args)
+
+    return Handler
+
+
+def serve(
+    host: str = "127.0.0.1",
+    port: int = 7861,
+    tagger=None,
+    max_batch: int = 64,
+    verbose: bool = False,
+) -> ThreadingHTTPServer:
+    """Start the server on a background thread and return it (port 0 = any free port)."""
+    server = ThreadingHTTPServer((host, port), make_handler(tagger or MockTagger(), max_batch))
+    server.daemon_threads = True
+    server.verbose = verbose
+    threading.Thread(target=server.serve_forever, daemon=True, name="tktagger-server").start()
+    return server
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Local TKtagger tagging server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--onnx", help="serve a real model instead of mock tags")
+    parser.add_argument("--csv", help="selected_tags.csv for --onnx (default: next to it)")
+    parser.add_argument("--latency", type=float, default=0.0, help="mock: seconds added per request")
+    parser.add_argument("--max-batch", type=int, default=64, help="max images per request")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    tagger = ModelTagger(args.onnx, args.csv) if args.onnx else MockTagger(args.latency)
+    server = serve(args.host, args.port, tagger, args.max_batch, args.verbose)
+    print(f"Serving {tagger.name} tagger on http://{args.host}:{server.server_address[1]}  (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
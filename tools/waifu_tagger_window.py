@@ -7,7 +7,7 @@ green primary action button consistent with resort_tag_window_operation.py
 import os
 from PySide6.QtWidgets import (
     QDialog, QVBoxLayout, QHBoxLayout, QGridLayout, QLabel,
-    QLineEdit, QCheckBox, QSlider, QComboBox, QPushButton,
+    QLineEdit, QCheckBox, QSlider, QComboBox, QPushButton, QSpinBox,
     QGroupBox, QScrollArea, QFileDialog, QWidget, QFrame
 )
 from PySide6.QtCore import Qt, Signal
@@ -94,14 +94,28 @@ class WaifuTaggerWindow(QDialog):
         v_mode.addLayout(mode_row)
 
         self.api_url_frame = QWidget()
-        api_row = QHBoxLayout(self.api_url_frame)
-        api_row.setContentsMargins(0, 0, 0, 0)
+        api_grid = QGridLayout(self.api_url_frame)
+        api_grid.setContentsMargins(0, 0, 0, 0)
+        api_grid.setColumnStretch(1, 1)
+        self._api_backend_lbl = QLabel()
+        self.api_backend = QComboBox()
+        api_grid.addWidget(self._api_backend_lbl, 0, 0)
+        api_grid.addWidget(self.api_backend, 0, 1)
         self._api_url_lbl = QLabel()
-        api_row.addWidget(self._api_url_lbl)
         self.api_url = QLineEdit("http://127.0.0.1:7860/")
-        api_row.addWidget(self.api_url)
+        api_grid.addWidget(self._api_url_lbl, 1, 0)
+        api_grid.addWidget(self.api_url, 1, 1)
+        self._api_conc_lbl = QLabel()
+        self.api_concurrency = QSpinBox()
+        self.api_concurrency.setRange(1, 32)
+        self.api_concurrency.setValue(4)
+        api_grid.addWidget(self._api_conc_lbl, 2, 0)
+        api_grid.addWidget(self.api_concurrency, 2, 1)
         v_mode.addWidget(self.api_url_frame)
 
+        # Kohya_ss mặc định ở cổng 7860, tools/tagger_server.py ở 7861
+        self.api_backend.currentIndexChanged.connect(self._on_api_backend_changed)
+
         self.run_mode.currentIndexChanged.connect(
             lambda i: self.api_url_frame.setVisible(i == 1)
         )
@@ -164,6 +178,10 @@ class WaifuTaggerWindow(QDialog):
         self.alpha_to_white = QCheckBox()
         self.alpha_to_white.setChecked(True)
         v_scope.addWidget(self.alpha_to_white)
+
+        self.only_new = QCheckBox()
+        self.only_new.setChecked(False)
+        v_scope.addWidget(self.only_new)
         layout.addWidget(self._scope_group)
 
         # ── 4. Tag Processing ─────────────────────
@@ -219,6 +237,80 @@ class WaifuTaggerWindow(QDialog):
         t_grid.addWidget(self.char_val, 1, 2)
 
         layout.addWidget(self._thresh_group)
+
+        # ── 7. Performance ────────────────────────
+        self._perf_group = QGroupBox()
+        p_grid = QGridLayout(self._perf_group)
+        p_grid.setColumnStretch(1, 1)
+        p_grid.setVerticalSpacing(4)
+
+        self._batch_lbl = QLabel()
+        self.batch_size = QSpinBox()
+        self.batch_size.setRange(1, 64)
+        self.batch_size.setValue(4)
+        p_grid.addWidget(self._batch_lbl, 0, 0)
+        p_grid.addWidget(self.batch_size, 0, 1)
+
+        self._workers_lbl = QLabel()
+        self.loader_workers = QSpinBox()
+        self.loader_workers.setRange(0, max(1, os.cpu_count() or 1))
+        self.loader_workers.setValue(min(4, os.cpu_count() or 1))
+        p_grid.addWidget(self._workers_lbl, 1, 0)
+        p_grid.addWidget(self.loader_workers, 1, 1)
+
+        self.keep_model_loaded = QCheckBox()
+        self.keep_model_loaded.setChecked(True)
+        p_grid.addWidget(self.keep_model_loaded, 2, 0, 1, 2)
+
+        self.prob_cache = QCheckBox()
+        self.prob_cache.setChecked(True)
+        p_grid.addWidget(self.prob_cache, 3, 0, 1, 2)
+
+        # ONNX Runtime session profile
+        self._provider_lbl = QLabel()
+        self.provider = QComboBox()
+        p_grid.addWidget(self._provider_lbl, 4, 0)
+        p_grid.addWidget(self.provider, 4, 1)
+
+        self._intra_lbl = QLabel()
+        self.intra_threads = QSpinBox()
+        self.intra_threads.setRange(0, max(1, os.cpu_count() or 1))
+        p_grid.addWidget(self._intra_lbl, 5, 0)
+        p_grid.addWidget(self.intra_threads, 5, 1)
+
+        self._inter_lbl = QLabel()
+        self.inter_threads = QSpinBox()
+        self.inter_threads.setRange(0, max(1, os.cpu_count() or 1))
+        p_grid.addWidget(self._inter_lbl, 6, 0)
+        p_grid.addWidget(self.inter_threads, 6, 1)
+
+        self._graph_opt_lbl = QLabel()
+        self.graph_opt = QComboBox()
+        self.graph_opt.addItems(["disable", "basic", "extended", "all"])
+        self.graph_opt.setCurrentText("all")
+        p_grid.addWidget(self._graph_opt_lbl, 7, 0)
+        p_grid.addWidget(self.graph_opt, 7, 1)
+
+        self.cache_graph = QCheckBox()
+        p_grid.addWidget(self.cache_graph, 8, 0, 1, 2)
+
+        self.mem_arena = QCheckBox()
+        self.mem_arena.setChecked(True)
+        p_grid.addWidget(self.mem_arena, 9, 0, 1, 2)
+
+        self._processes_lbl = QLabel()
+        self.num_processes = QSpinBox()
+        self.num_processes.setRange(1, max(1, os.cpu_count() or 1))
+        self.num_processes.setValue(1)
+        p_grid.addWidget(self._processes_lbl, 10, 0)
+        p_grid.addWidget(self.num_processes, 10, 1)
+
+        self._providers_info = QLabel()
+        self._providers_info.setStyleSheet("color: #888; font-size: 11px;")
+        self._providers_info.setWordWrap(True)
+        p_grid.addWidget(self._providers_info, 11, 0, 1, 2)
+
+        layout.addWidget(self._perf_group)
         layout.addStretch()
 
         scroll.setWidget(body)
@@ -259,6 +351,16 @@ class WaifuTaggerWindow(QDialog):
         self.run_mode.setCurrentIndex(current_idx)
         self.run_mode.blockSignals(False)
         self._api_url_lbl.setText(tr("waifu_api_url_label"))
+        self._api_backend_lbl.setText(tr("waifu_api_backend"))
+        backend_idx = self.api_backend.currentIndex()
+        self.api_backend.blockSignals(True)
+        self.api_backend.clear()
+        self.api_backend.addItem(tr("waifu_api_backend_kohya"), "kohya")
+        self.api_backend.addItem(tr("waifu_api_backend_http"), "http")
+        self.api_backend.setCurrentIndex(max(0, backend_idx))
+        self.api_backend.blockSignals(False)
+        self._api_conc_lbl.setText(tr("waifu_api_concurrency"))
+        self.api_concurrency.setToolTip(tr("waifu_api_concurrency_tooltip"))
 
         # Model settings
         self._model_group.setTitle(tr("waifu_model_settings"))
@@ -280,6 +382,8 @@ class WaifuTaggerWindow(QDialog):
         self.include_subfolders.setToolTip(tr("waifu_include_sub_tooltip"))
         self.alpha_to_white.setText(tr("waifu_alpha_white"))
         self.alpha_to_white.setToolTip(tr("waifu_alpha_tooltip"))
+        self.only_new.setText(tr("waifu_only_new"))
+        self.only_new.setToolTip(tr("waifu_only_new_tooltip"))
 
         # Tag processing
         self._opt_group.setTitle(tr("waifu_tag_processing"))
@@ -299,6 +403,29 @@ class WaifuTaggerWindow(QDialog):
         self._gen_lbl.setText(tr("waifu_general"))
         self._char_lbl.setText(tr("waifu_character"))
 
+        # Performance
+        self._perf_group.setTitle(tr("waifu_performance"))
+        self._batch_lbl.setText(tr("waifu_batch_size"))
+        self.batch_size.setToolTip(tr("waifu_batch_size_tooltip"))
+        self._workers_lbl.setText(tr("waifu_loader_workers"))
+        self.loader_workers.setToolTip(tr("waifu_loader_workers_tooltip"))
+        self.keep_model_loaded.setText(tr("waifu_keep_model"))
+        self.keep_model_loaded.setToolTip(tr("waifu_keep_model_tooltip"))
+        self.prob_cache.setText(tr("waifu_prob_cache"))
+        self.prob_cache.setToolTip(tr("waifu_prob_cache_tooltip"))
+        self._provider_lbl.setText(tr("waifu_provider"))
+        self._fill_providers()
+        self._intra_lbl.setText(tr("waifu_intra_threads"))
+        self._inter_lbl.setText(tr("waifu_inter_threads"))
+        self.intra_threads.setSpecialValueText(tr("waifu_threads_auto"))
+        self.inter_threads.setSpecialValueText(tr("waifu_threads_auto"))
+        self._graph_opt_lbl.setText(tr("waifu_graph_opt"))
+        self.cache_graph.setText(tr("waifu_cache_graph"))
+        self.cache_graph.setToolTip(tr("waifu_cache_graph_tooltip"))
+        self.mem_arena.setText(tr("waifu_mem_arena"))
+        self._processes_lbl.setText(tr("waifu_processes"))
+        self.num_processes.setToolTip(tr("waifu_processes_tooltip"))
+
         # Buttons
         self._cancel_btn.setText(tr("ldl_cancel"))
         self.btn_run.setText(tr("waifu_run_btn"))
@@ -315,6 +442,34 @@ class WaifuTaggerWindow(QDialog):
         slider.valueChanged.connect(lambda v: val_lbl.setText(f"{v / 100:.2f}"))
         return slider, val_lbl
 
+    def _fill_providers(self):
+        """Provider combo: Auto + whatever the installed onnxruntime offers."""
+        try:
+            from tagger_logic import get_diagnostics
+            available = get_diagnostics()["available_providers"]
+        except ImportError:
+            available = []
+
+        current = self.provider.currentData()
+        self.provider.blockSignals(True)
+        self.provider.clear()
+        self.provider.addItem(tr("waifu_provider_auto"), "auto")
+        for name in available:
+            self.provider.addItem(name.replace("ExecutionProvider", ""), name)
+        idx = self.provider.findData(current)
+        self.provider.setCurrentIndex(max(0, idx))
+        self.provider.blockSignals(False)
+
+        self._providers_info.setText(
+            tr("waifu_available_providers", providers=", ".join(available) or "—")
+        )
+
+    def _on_api_backend_changed(self, _idx: int):
+        """Swap the default URL when the user hasn't typed their own."""
+        defaults = {"kohya": "http://127.0.0.1:7860/", "http": "http://127.0.0.1:7861/"}
+        if self.api_url.text().strip() in defaults.values():
+            self.api_url.setText(defaults.get(self.api_backend.currentData(), self.api_url.text()))
+
     def _browse_onnx(self):
         path, _ = QFileDialog.getOpenFileName(
             self,
@@ -348,6 +503,8 @@ class WaifuTaggerWindow(QDialog):
         config = {
             "mode":               "local" if self.run_mode.currentIndex() == 0 else "api",
             "api_url":            self.api_url.text().strip(),
+            "api_backend":        self.api_backend.currentData() or "kohya",
+            "api_concurrency":    self.api_concurrency.value(),
 
             "repo_id":            self.repo_id.text().strip(),
             "onnx_path":          onnx if onnx else None,
@@ -359,6 +516,20 @@ class WaifuTaggerWindow(QDialog):
             "target_folder":      self.current_folder,
             "root_folder":        self.root_folder,
             "include_subfolders": self.include_subfolders.isChecked(),
+            "only_new":           self.only_new.isChecked(),
+
+            "batch_size":         self.batch_size.value(),
+            "max_data_loader_n_workers": self.loader_workers.value(),
+            "keep_model_loaded":  self.keep_model_loaded.isChecked(),
+            "prob_cache":         self.prob_cache.isChecked(),
+
+            "providers":          self.provider.currentData() or "auto",
+            "intra_op_threads":   self.intra_threads.value(),
+            "inter_op_threads":   self.inter_threads.value(),
+            "graph_opt_level":    self.graph_opt.currentText(),
+            "cache_optimized_model": self.cache_graph.isChecked(),
+            "cpu_mem_arena":      self.mem_arena.isChecked(),
+            "num_processes":      self.num_processes.value(),
 
             "gen_threshold":      self.gen_slider.value() / 100,
             "char_threshold":     self.char_slider.value() / 100,